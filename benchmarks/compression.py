@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Benchmark CPU cost vs bytes saved for each output compression.
+
+usage: python -m benchmarks.compression [--file capture.json] [--count N]
+"""
+
+import os
+import argparse
+import shutil
+import tempfile
+from datetime import datetime
+
+from rotating_out_file import RotatingOutFile
+from utils.compression import available_compressions, DEFAULT_LEVELS
+from benchmarks.samples import generate_messages, load_messages
+
+
+# levels tried for each compression besides the default
+LEVELS = {
+    "gzip": (1, 9),
+    "bz2": (1, 9),
+    "lzma": (0, 9),
+    "zstd": (1, 19),
+}
+
+
+def cpu_time():
+    """return user + system cpu seconds for this process."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run_compression(messages, compression, level, base_dir):
+    """write messages and return (cpu seconds, bytes on disk)."""
+    out = RotatingOutFile(
+        base_dir=base_dir,
+        collection_name="bench",
+        buffer_size=256 * 1024,
+        compression=compression,
+        compression_level=level)
+    dt = datetime(1997, 10, 30, 12, 36)
+
+    start = cpu_time()
+    for message in messages:
+        out.write(message, datetime_=dt)
+    out.end_file()
+    elapsed = cpu_time() - start
+
+    size = 0
+    collection_dir = os.path.join(base_dir, "bench")
+    for name in os.listdir(collection_dir):
+        size += os.path.getsize(os.path.join(collection_dir, name))
+    shutil.rmtree(collection_dir)
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file",
+        default=None,
+        help="capture file to replay (one message per line)")
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=20000,
+        help="number of messages to write")
+    args = parser.parse_args()
+
+    if args.file is not None:
+        messages = load_messages(args.file, limit=args.count)
+    else:
+        messages = generate_messages(args.count)
+
+    base_dir = tempfile.mkdtemp(prefix="bench-compression-")
+    try:
+        raw_cpu, raw_size = run_compression(messages, None, None, base_dir)
+        raw_mb = raw_size / (1024.0 * 1024.0)
+        print("%d messages, %.1f MB uncompressed" % (len(messages), raw_mb))
+        print("%-6s %5s %10s %8s %10s" % (
+            "codec", "level", "cpu s", "ratio", "MB/cpu s"))
+        print("%-6s %5s %10.3f %8.2f %10s" % (
+            "none", "-", raw_cpu, 1.0, "-"))
+
+        for compression in available_compressions():
+            levels = sorted(set(
+                LEVELS[compression] + (DEFAULT_LEVELS[compression],)))
+            for level in levels:
+                cpu, size = run_compression(
+                    messages, compression, level, base_dir)
+                extra_cpu = max(cpu - raw_cpu, 1e-6)
+                print("%-6s %5d %10.3f %8.2f %10.1f" % (
+                    compression,
+                    level,
+                    cpu,
+                    raw_size / float(size),
+                    raw_mb / extra_cpu))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    main()
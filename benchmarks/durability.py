@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Benchmark write throughput for each durability mode.
+
+Shows what each fsync policy costs so the group commit settings can be
+picked against how much data a crash is allowed to lose.
+
+usage: python -m benchmarks.durability [--file capture.json] [--count N]
+       [--dir DIR]
+"""
+
+import shutil
+import argparse
+import tempfile
+from time import time
+from datetime import datetime
+
+from rotating_out_file import (
+    RotatingOutFile, DURABILITY_NONE, DURABILITY_ROTATE, DURABILITY_GROUP)
+from benchmarks.samples import generate_messages, load_messages
+
+
+# (label, durability, sync_interval ms, sync_bytes)
+MODES = (
+    ("none", DURABILITY_NONE, None, None),
+    ("rotate", DURABILITY_ROTATE, None, None),
+    ("group 1000ms", DURABILITY_GROUP, 1000, None),
+    ("group 100ms", DURABILITY_GROUP, 100, None),
+    ("group 10ms", DURABILITY_GROUP, 10, None),
+    ("group 1MB", DURABILITY_GROUP, None, 1024 * 1024),
+    ("group 64KB", DURABILITY_GROUP, None, 64 * 1024),
+    ("group 4KB", DURABILITY_GROUP, None, 4 * 1024),
+)
+
+
+def run_mode(messages, base_dir, durability, sync_interval, sync_bytes,
+             fdatasync, max_records):
+    """write messages and return (seconds, syncs)."""
+    out = RotatingOutFile(
+        base_dir=base_dir,
+        collection_name="bench",
+        buffer_size=256 * 1024,
+        max_records=max_records,
+        durability=durability,
+        sync_interval=sync_interval,
+        sync_bytes=sync_bytes,
+        fdatasync=fdatasync)
+    dt = datetime(1997, 10, 30, 12, 36)
+
+    start = time()
+    for message in messages:
+        out.write(message, datetime_=dt)
+    out.end_file()
+    elapsed = time() - start
+
+    shutil.rmtree(base_dir + "/bench")
+    return elapsed, out.sync_count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file",
+        default=None,
+        help="capture file to replay (one message per line)")
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=50000,
+        help="number of messages to write")
+    parser.add_argument(
+        "--dir",
+        default=None,
+        help="directory to write in (use the capture disk)")
+    parser.add_argument(
+        "--max-records",
+        type=int,
+        default=10000,
+        help="rotate every N messages so rotate mode syncs")
+    parser.add_argument(
+        "--fsync",
+        action="store_true",
+        help="use fsync instead of fdatasync")
+    args = parser.parse_args()
+
+    if args.file is not None:
+        messages = load_messages(args.file, limit=args.count)
+    else:
+        messages = generate_messages(args.count)
+
+    base_dir = tempfile.mkdtemp(prefix="bench-durability-", dir=args.dir)
+    try:
+        print("%d messages, %s" % (
+            len(messages), "fsync" if args.fsync else "fdatasync"))
+        print("%-14s %10s %8s %12s" % ("mode", "seconds", "syncs", "msgs/s"))
+        for label, durability, sync_interval, sync_bytes in MODES:
+            elapsed, syncs = run_mode(
+                messages,
+                base_dir,
+                durability,
+                sync_interval,
+                sync_bytes,
+                not args.fsync,
+                args.max_records)
+            print("%-14s %10.3f %8d %12.0f" % (
+                label,
+                elapsed,
+                syncs,
+                len(messages) / max(elapsed, 1e-6)))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    main()
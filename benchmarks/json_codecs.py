@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Replay a capture file through on_data with each installed json backend.
+
+usage: python -m benchmarks.json_codecs [--file capture.json] [--count N]
+"""
+
+import argparse
+from time import time
+
+from listeners.base import CLASSIFY_PARSE
+from utils.jsoncodec import available_codecs, default_codec
+from benchmarks.on_data import CountingListener
+from benchmarks.samples import generate_messages, load_messages
+
+
+def run_codec(codec, messages, repeat):
+    """return the best messages/sec over repeat runs."""
+    best = 0.0
+    for _ in range(repeat):
+        listener = CountingListener(CLASSIFY_PARSE)
+        listener.codec = codec
+        on_data = listener.on_data
+        start = time()
+        for raw_data in messages:
+            on_data(raw_data)
+        elapsed = time() - start
+        if elapsed > 0:
+            best = max(best, len(messages) / elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file",
+        default=None,
+        help="capture file to replay (one message per line)")
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=20000,
+        help="number of messages to replay")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.file is not None:
+        messages = load_messages(args.file, limit=args.count)
+    else:
+        messages = generate_messages(args.count)
+
+    print("%d messages, default backend: %s" % (
+        len(messages), default_codec.name))
+    for codec in available_codecs():
+        rate = run_codec(codec, messages, args.repeat)
+        print("%-10s %12.0f msgs/sec" % (codec.name, rate))
+
+
+if __name__ == "__main__":
+    main()
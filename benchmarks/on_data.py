@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Benchmark BaseListener.on_data classification modes.
+
+usage: python -m benchmarks.on_data [--file capture.json] [--count N]
+"""
+
+import argparse
+from time import time
+
+from listeners.base import BaseListener, CLASSIFY_PARSE, CLASSIFY_SNIFF
+from benchmarks.samples import generate_messages, load_messages
+
+
+class CountingListener(BaseListener):
+
+    """Listener that only counts what it receives."""
+
+    def __init__(self, classify_mode):
+        """construct counting listener."""
+        super(CountingListener, self).__init__(classify_mode=classify_mode)
+        self.connected = True
+        self.bytes_written = 0
+
+    def on_status(self, status, raw_data):
+        """count status the way RotatingFileListener would write it."""
+        self.bytes_written += len(raw_data)
+        return super(CountingListener, self).on_status(status, raw_data)
+
+    def on_limit(self, limit, data, raw_data):
+        """skip the debug logging."""
+        return not self.terminate
+
+
+def run_mode(classify_mode, messages, repeat):
+    """return the best messages/sec over repeat runs."""
+    best = 0.0
+    for _ in range(repeat):
+        listener = CountingListener(classify_mode)
+        on_data = listener.on_data
+        start = time()
+        for raw_data in messages:
+            on_data(raw_data)
+        elapsed = time() - start
+        if elapsed > 0:
+            best = max(best, len(messages) / elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file",
+        default=None,
+        help="capture file to replay (one message per line)")
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=20000,
+        help="number of generated messages if no file is given")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.file is not None:
+        messages = load_messages(args.file, limit=args.count)
+    else:
+        messages = generate_messages(args.count)
+
+    print("%d messages" % len(messages))
+    rates = {}
+    for mode in (CLASSIFY_PARSE, CLASSIFY_SNIFF):
+        rates[mode] = run_mode(mode, messages, args.repeat)
+        print("%-6s %12.0f msgs/sec" % (mode, rates[mode]))
+
+    if rates[CLASSIFY_PARSE] > 0:
+        print("speedup: %.1fx" % (
+            rates[CLASSIFY_SNIFF] / rates[CLASSIFY_PARSE]))
+
+
+if __name__ == "__main__":
+    main()
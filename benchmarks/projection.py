@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Benchmark projected vs raw output size and downstream parse time.
+
+usage: python -m benchmarks.projection [--file capture.json] [--count N]
+       [--path user.screen_name --path text ...]
+"""
+
+import argparse
+from time import time
+
+from utils.jsoncodec import default_codec
+from utils.projection import Projection
+from utils.sniff import is_status
+from benchmarks.samples import generate_messages, load_messages
+
+
+# a typical slim collection
+DEFAULT_PATHS = [
+    "id_str",
+    "text",
+    "lang",
+    "timestamp_ms",
+    "in_reply_to_status_id",
+    "user.id",
+    "user.screen_name",
+    "user.followers_count",
+    "entities.hashtags.text",
+    "entities.urls.expanded_url",
+    "coordinates",
+    "place.full_name",
+]
+
+
+def parse_time(lines):
+    """return seconds to decode every line."""
+    loads = default_codec.loads
+    start = time()
+    for line in lines:
+        loads(line)
+    return time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file",
+        default=None,
+        help="capture file to replay (one message per line)")
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=20000,
+        help="number of messages to project")
+    parser.add_argument(
+        "--path",
+        action="append",
+        default=None,
+        help="field path to keep (repeat; default is a typical set)")
+    args = parser.parse_args()
+
+    if args.file is not None:
+        messages = load_messages(args.file, limit=args.count)
+    else:
+        messages = generate_messages(args.count)
+    statuses = [raw for raw in messages if is_status(raw)]
+
+    projection = Projection(args.path or DEFAULT_PATHS)
+    start = time()
+    projected = [projection.project_raw(raw) for raw in statuses]
+    project_seconds = time() - start
+
+    raw_bytes = sum(len(raw) + 1 for raw in statuses)
+    projected_bytes = sum(len(line) + 1 for line in projected)
+    raw_parse = parse_time(statuses)
+    projected_parse = parse_time(projected)
+
+    print("%d statuses, json backend %s" % (
+        len(statuses), default_codec.name))
+    print("projection: %.1f us/status" % (
+        project_seconds * 1e6 / max(len(statuses), 1)))
+    print("%-10s %12s %12s" % ("", "MB", "parse s"))
+    print("%-10s %12.2f %12.3f" % (
+        "raw", raw_bytes / 1048576.0, raw_parse))
+    print("%-10s %12.2f %12.3f" % (
+        "projected", projected_bytes / 1048576.0, projected_parse))
+    print("%-10s %12.1fx %11.1fx" % (
+        "reduction",
+        raw_bytes / float(max(projected_bytes, 1)),
+        raw_parse / max(projected_parse, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Sample stream messages for the benchmarks."""
+
+from collections import OrderedDict
+import simplejson as json
+
+
+def make_status(status_id):
+    """build a status dict shaped like a v1.1 streaming tweet."""
+    user = {
+        "id": 1000 + status_id % 5000,
+        "id_str": str(1000 + status_id % 5000),
+        "name": "Sample User %d" % (status_id % 5000),
+        "screen_name": "sample_user_%d" % (status_id % 5000),
+        "location": "Seattle, WA",
+        "url": None,
+        "description": "just a sample account used for benchmarking " * 2,
+        "protected": False,
+        "verified": False,
+        "followers_count": 1234,
+        "friends_count": 321,
+        "listed_count": 12,
+        "favourites_count": 4567,
+        "statuses_count": 8910,
+        "created_at": "Thu Oct 30 12:36:00 +0000 1997",
+        "utc_offset": -25200,
+        "time_zone": "Pacific Time (US & Canada)",
+        "geo_enabled": True,
+        "lang": "en",
+        "profile_background_color": "C0DEED",
+        "profile_image_url":
+            "http://pbs.twimg.com/profile_images/1/sample_normal.jpg",
+        "default_profile": True,
+        "default_profile_image": False,
+    }
+
+    # twitter sends created_at first; keep that order so sniffing works
+    return OrderedDict([
+        ("created_at", "Thu Oct 30 12:36:%02d +0000 1997" % (status_id % 60)),
+        ("id", 520000000000000000 + status_id),
+        ("id_str", str(520000000000000000 + status_id)),
+        ("text", "sample tweet #%d about #benchmarks http://t.co/abcdef" % (
+            status_id)),
+        ("source", "<a href=\"http://twitter.com\">Twitter Web Client</a>"),
+        ("truncated", False),
+        ("in_reply_to_status_id", None),
+        ("in_reply_to_status_id_str", None),
+        ("in_reply_to_user_id", None),
+        ("in_reply_to_user_id_str", None),
+        ("in_reply_to_screen_name", None),
+        ("user", user),
+        ("geo", None),
+        ("coordinates", None),
+        ("place", None),
+        ("contributors", None),
+        ("retweet_count", 0),
+        ("favorite_count", 0),
+        ("entities", {
+            "hashtags": [{"text": "benchmarks", "indices": [24, 35]}],
+            "trends": [],
+            "urls": [{
+                "url": "http://t.co/abcdef",
+                "expanded_url": "http://example.com/a/long/path",
+                "display_url": "example.com/a/long/path",
+                "indices": [36, 54]
+            }],
+            "user_mentions": [],
+            "symbols": []
+        }),
+        ("favorited", False),
+        ("retweeted", False),
+        ("possibly_sensitive", False),
+        ("filter_level", "low"),
+        ("lang", "en"),
+        ("timestamp_ms", str(877000000000 + status_id))
+    ])
+
+
+def make_delete(status_id):
+    """build a delete notice."""
+    return {
+        "delete": {
+            "status": {
+                "id": 520000000000000000 + status_id,
+                "id_str": str(520000000000000000 + status_id),
+                "user_id": 1000 + status_id % 5000,
+                "user_id_str": str(1000 + status_id % 5000)
+            },
+            "timestamp_ms": str(877000000000 + status_id)
+        }
+    }
+
+
+def make_limit(count):
+    """build a limit notice."""
+    return {
+        "limit": {
+            "track": count,
+            "timestamp_ms": str(877000000000 + count)
+        }
+    }
+
+
+def generate_messages(count, control_every=50):
+    """return a list of raw messages, mostly statuses.
+
+    Every control_every-th message is a delete or limit notice.
+    """
+    messages = []
+    for i in range(count):
+        if control_every and i % control_every == 0:
+            if (i // control_every) % 2:
+                msg = make_delete(i)
+            else:
+                msg = make_limit(i)
+        else:
+            msg = make_status(i)
+        messages.append(json.dumps(msg))
+    return messages
+
+
+def load_messages(filename, limit=None):
+    """load raw messages from a capture file (one json object per line)."""
+    messages = []
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line:
+                messages.append(line)
+                if limit is not None and len(messages) >= limit:
+                    break
+    return messages
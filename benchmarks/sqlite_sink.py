@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Benchmark sustained SQLite sink insert rate for each batch size.
+
+Messages are stamped as if they arrived at --rate statuses/sec, so the
+run crosses rotation windows like a real stream would.
+
+usage: python -m benchmarks.sqlite_sink [--file capture.json] [--count N]
+       [--rate R] [--dir DIR]
+"""
+
+import shutil
+import argparse
+import tempfile
+from time import time
+
+from sinks.sqlite import SQLiteSink
+from utils.sniff import is_status
+from benchmarks.samples import generate_messages, load_messages
+
+
+BATCH_SIZES = (1, 10, 100, 1000, 10000)
+
+
+def run_batch_size(statuses, base_dir, batch_size, rate, synchronous):
+    """insert statuses and return seconds taken."""
+    sink = SQLiteSink(
+        base_dir,
+        "bench",
+        batch_size=batch_size,
+        minute_interval=1,
+        synchronous=synchronous)
+    received = 877000000.0
+    step = 1.0 / rate
+
+    start = time()
+    for raw in statuses:
+        sink.write(raw, timestamp=received)
+        received += step
+    sink.close()
+    elapsed = time() - start
+
+    shutil.rmtree(base_dir + "/bench")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file",
+        default=None,
+        help="capture file to replay (one message per line)")
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=50000,
+        help="number of messages to insert")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=500.0,
+        help="stream rate (statuses/sec) the run simulates")
+    parser.add_argument(
+        "--synchronous",
+        default="NORMAL",
+        help="sqlite synchronous pragma (OFF, NORMAL, FULL)")
+    parser.add_argument(
+        "--dir",
+        default=None,
+        help="directory to write in (use the capture disk)")
+    args = parser.parse_args()
+
+    if args.file is not None:
+        messages = load_messages(args.file, limit=args.count)
+    else:
+        messages = generate_messages(args.count)
+    statuses = [raw for raw in messages if is_status(raw)]
+
+    base_dir = tempfile.mkdtemp(prefix="bench-sqlite-", dir=args.dir)
+    try:
+        print("%d statuses at a simulated %.0f/s, synchronous=%s" % (
+            len(statuses), args.rate, args.synchronous))
+        print("%-8s %10s %12s %10s" % (
+            "batch", "seconds", "rows/s", "headroom"))
+        for batch_size in BATCH_SIZES:
+            elapsed = run_batch_size(
+                statuses,
+                base_dir,
+                batch_size,
+                args.rate,
+                args.synchronous)
+            rows_per_sec = len(statuses) / max(elapsed, 1e-6)
+            print("%-8d %10.3f %12.0f %9.1fx" % (
+                batch_size,
+                elapsed,
+                rows_per_sec,
+                rows_per_sec / args.rate))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    main()
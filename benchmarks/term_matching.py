@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Benchmark term matching throughput for a full track list.
+
+usage: python -m benchmarks.term_matching [--file capture.json] [--count N]
+       [--terms N] [--boxes N]
+"""
+
+import random
+import argparse
+from time import time
+
+from term_matcher import TermMatcher
+from utils.jsoncodec import default_codec
+from utils.sniff import is_status
+from benchmarks.samples import generate_messages, load_messages
+
+
+def make_terms(count):
+    """return count made up terms, a few of them phrases."""
+    rng = random.Random(count)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    terms = ["benchmarks", "sample tweet"]
+    while len(terms) < count:
+        word = "".join(rng.choice(letters) for _ in range(rng.randint(4, 9)))
+        if rng.random() < 0.2:
+            word += " " + "".join(rng.choice(letters) for _ in range(5))
+        terms.append(word)
+    return terms[:count]
+
+
+def make_locations(count):
+    """return count boxes as a flat location list."""
+    locations = []
+    for i in range(count):
+        west = -180 + i * 10
+        locations.extend([west, -10, west + 5, 10])
+    return locations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file",
+        default=None,
+        help="capture file to replay (one message per line)")
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=20000,
+        help="number of messages to match")
+    parser.add_argument(
+        "--terms",
+        type=int,
+        default=400,
+        help="number of track terms")
+    parser.add_argument(
+        "--boxes",
+        type=int,
+        default=25,
+        help="number of location boxes")
+    args = parser.parse_args()
+
+    if args.file is not None:
+        messages = load_messages(args.file, limit=args.count)
+    else:
+        messages = generate_messages(args.count)
+    raw_statuses = [raw for raw in messages if is_status(raw)]
+
+    matcher = TermMatcher()
+    start = time()
+    matcher.update(make_terms(args.terms), make_locations(args.boxes))
+    matcher.automaton.relink()
+    build_seconds = time() - start
+
+    start = time()
+    statuses = [default_codec.loads(raw) for raw in raw_statuses]
+    decode_seconds = time() - start
+
+    start = time()
+    for status in statuses:
+        matcher.match(status)
+    match_seconds = time() - start
+
+    count = max(len(statuses), 1)
+    print("%d statuses, %d terms, %d boxes, json backend %s" % (
+        len(statuses), args.terms, args.boxes, default_codec.name))
+    print("build:  %10.3f ms" % (build_seconds * 1e3))
+    print("%-8s %10s %12s" % ("step", "us/status", "statuses/s"))
+    for name, seconds in (
+            ("decode", decode_seconds),
+            ("match", match_seconds),
+            ("total", decode_seconds + match_seconds)):
+        print("%-8s %10.1f %12.0f" % (
+            name,
+            seconds * 1e6 / count,
+            count / max(seconds, 1e-6)))
+    print("matched %d, unmatched %d" % (matcher.matched, matcher.unmatched))
+
+
+if __name__ == "__main__":
+    main()
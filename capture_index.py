@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Sparse byte-offset index sidecars for capture files.
+
+Each index entry is a fixed-width record of tweet id, receive time
+(epoch seconds) and the byte offset of the line in the uncompressed
+capture file. Entries are in write order, so they're sorted by receive
+time and (close enough to) sorted by id.
+"""
+
+import os
+import struct
+import bisect
+import unittest
+
+
+# tweet id, receive timestamp, byte offset
+ENTRY_FORMAT = "<QdQ"
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+
+# extension added after the capture file's name
+INDEX_EXTENSION = ".idx"
+
+
+def index_filename(filename):
+    """return the index sidecar name for a capture filename."""
+    return filename + INDEX_EXTENSION
+
+
+class IndexWriter(object):
+
+    """Append entries to an index file as a capture file is written."""
+
+    def __init__(self, filename):
+        """open the index file."""
+        self.filename = filename
+        self.file = open(filename, "wb")
+        self.pack = struct.Struct(ENTRY_FORMAT).pack
+
+    def add(self, status_id, timestamp, offset):
+        """add an entry."""
+        self.file.write(self.pack(status_id, timestamp, offset))
+
+    def close(self):
+        """close the index file."""
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+
+def trim_index(filename, max_offset):
+    """drop entries at or past max_offset and any torn last entry.
+
+    Used when a capture file was cut short. Returns the number of
+    entries kept.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    count = len(data) // ENTRY_SIZE
+    unpack = struct.Struct(ENTRY_FORMAT).unpack_from
+    kept = 0
+    while kept < count and unpack(data, kept * ENTRY_SIZE)[2] < max_offset:
+        kept += 1
+
+    if kept * ENTRY_SIZE != len(data):
+        with open(filename, "r+b") as f:
+            f.truncate(kept * ENTRY_SIZE)
+    return kept
+
+
+class CaptureIndex(object):
+
+    """Read side of an index sidecar."""
+
+    def __init__(self, filename):
+        """load the index file."""
+        with open(filename, "rb") as f:
+            data = f.read()
+
+        count = len(data) // ENTRY_SIZE
+        unpack = struct.Struct(ENTRY_FORMAT).unpack_from
+        entries = [unpack(data, i * ENTRY_SIZE) for i in range(count)]
+
+        self.ids = [entry[0] for entry in entries]
+        self.timestamps = [entry[1] for entry in entries]
+        self.offsets = [entry[2] for entry in entries]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def offset_for_time(self, timestamp):
+        """return an offset at or before the first line received at
+        timestamp."""
+        i = bisect.bisect_left(self.timestamps, timestamp) - 1
+        return self.offsets[i] if i >= 0 else 0
+
+    def offset_after_time(self, timestamp):
+        """return the offset of the first indexed line received at or
+        after timestamp, or None if there isn't one."""
+        i = bisect.bisect_left(self.timestamps, timestamp)
+        return self.offsets[i] if i < len(self.offsets) else None
+
+    def offset_for_id(self, status_id):
+        """return an offset at or before the line for status_id.
+
+        Ids aren't strictly ordered by receive time, so callers should
+        scan forward a little past the returned offset.
+        """
+        i = bisect.bisect_left(self.ids, status_id) - 1
+        return self.offsets[i] if i >= 0 else 0
+
+
+#
+# unittests
+#
+#
+class IndexTest(unittest.TestCase):
+
+    """Index round trip tests."""
+
+    def setUp(self):
+        """set up the test."""
+        self.filename = ".unittest-index-%d.idx" % os.getpid()
+
+    def tearDown(self):
+        """remove the index."""
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def test_round_trip(self):
+        """entries can be looked up by id and time."""
+        writer = IndexWriter(self.filename)
+        for i in range(10):
+            writer.add(1000 + i * 10, 100.0 + i, i * 500)
+        writer.close()
+
+        self.assertEqual(os.path.getsize(self.filename), 10 * ENTRY_SIZE)
+
+        index = CaptureIndex(self.filename)
+        self.assertEqual(len(index), 10)
+        self.assertEqual(index.offset_for_id(1035), 3 * 500)
+        self.assertEqual(index.offset_for_time(104.5), 4 * 500)
+        self.assertEqual(index.offset_for_time(50.0), 0)
+        self.assertEqual(index.offset_after_time(104.5), 5 * 500)
+        self.assertEqual(index.offset_after_time(200.0), None)
+
+    def test_trim(self):
+        """trimming drops entries past the cut and torn entries."""
+        writer = IndexWriter(self.filename)
+        for i in range(10):
+            writer.add(i, float(i), i * 100)
+        writer.file.write(b"xyz")
+        writer.close()
+
+        self.assertEqual(trim_index(self.filename, 450), 5)
+        self.assertEqual(len(CaptureIndex(self.filename)), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
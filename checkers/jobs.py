@@ -28,12 +28,11 @@ class JobChecker(object):
 
             # if we get results
             if count > 0:
-                # we should never get more than one, so warn
+                # only the first is used here, so warn (see getActiveJobs)
                 if count > 1:
                     self.log.warn(
-                        "more than one active_job. got %d for id %d",
-                        count,
-                        self.client_id
+                        "more than one active_job. got %d",
+                        count
                     )
                     self.log.warn(active_jobs)
 
@@ -45,6 +44,13 @@ class JobChecker(object):
     def getFirstActiveJob(self):
         return self.requestFirstActiveJob()
 
+    def getActiveJobs(self):
+        """return every active job the server assigned to this client."""
+        active_jobs = self.server_messenger.getActiveJobs()
+        if active_jobs is None:
+            return []
+        return active_jobs.get("results", [])
+
     def activateJob(self, job):
         if job is None:
             self.log.error("attempt to activate job that is None.")
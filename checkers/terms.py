@@ -8,9 +8,14 @@ class TermChecker(object):
 
     """Term Checker"""
 
-    def __init__(self, server_messenger):
-        """Initialize the termchecker."""
+    def __init__(self, server_messenger, job_id=None):
+        """Initialize the termchecker.
+
+        job_id is the job whose terms are checked, the messenger's active
+        job if it's None.
+        """
         self.server_messenger = server_messenger
+        self.job_id = job_id
 
         self.current_terms = []
         self.current_terms_set = set()
@@ -26,7 +31,7 @@ class TermChecker(object):
     def requestTerms(self):
         """request terms from server. used internally."""
 
-        status_msg = self.server_messenger.getStatus()
+        status_msg = self.server_messenger.getStatus(self.job_id)
         keywords = status_msg.get('twitter_keywords', None)
         return (
             [kw.strip() for kw in
@@ -7,27 +7,40 @@ import time
 from datetime import datetime
 import exceptions
 import functools
+import unittest
 
 from configfile import ConfigFile
 from server_messenger import ServerMessenger, CaptureStatus
 from checkers.jobs import JobChecker
 from checkers.terms import TermChecker
 from listeners.file import RotatingFileListener
+from listeners.fanout import FanoutListener
+from listeners.routing import RoutingListener
+from retention import RetentionManager
+from sharding import unique
 
 from clients.twitter import TwitterClient
 
 import simplejson as json
 
 
+# id filter size when sharding and the output config doesn't set one
+SHARDED_DEDUP_MEMORY = 8 * 1024 * 1024
+
+
 class PipeMessenger(object):
     """ Wrapper for pipe communication """
 
 
-    def __init__(self, pipe, status_callback=None, update_callback=None):
+    def __init__(
+            self, pipe, status_callback=None, update_callback=None,
+            terms_callback=None, jobs_callback=None):
         """ initialize the messenger """
         self.pipe = pipe
         self.status_callback = status_callback
         self.update_callback = update_callback
+        self.terms_callback = terms_callback
+        self.jobs_callback = jobs_callback
         self.log = logging.getLogger(self.__class__.__name__)
 
     def sendStatus(self, status):
@@ -37,18 +50,39 @@ class PipeMessenger(object):
             "data": status
         })
 
-    def sendUpdate(self, time, received, rate, total):
-        """ sends an update """
+    def sendUpdate(
+            self, time, received, rate, total, writer=None, duplicates=0,
+            sinks=None, tap=None, job=None):
+        """ sends an update, for one job if the process has several """
         self.pipe.send({
             "type": "update",
             "data": {
                 "time": time,
                 "received": received,
                 "rate": rate,
-                "total": total
+                "total": total,
+                "writer": writer,
+                "duplicates": duplicates,
+                "sinks": sinks,
+                "tap": tap,
+                "job": job
             }
         })
 
+    def sendTerms(self, terms):
+        """ sends new terms to the worker """
+        self.pipe.send({
+            "type": "terms",
+            "data": terms
+        })
+
+    def sendJobs(self, jobs):
+        """ sends a shared worker its new jobs """
+        self.pipe.send({
+            "type": "jobs",
+            "data": jobs
+        })
+
     def receive(self):
         """ receive messages """
         if not self.pipe.poll():
@@ -83,6 +117,16 @@ class PipeMessenger(object):
                 self.update_callback(msg["data"])
             else:
                 self.log.debug("update message but no callback")
+        elif msg_type == "terms":
+            if self.terms_callback is not None:
+                self.terms_callback(msg["data"])
+            else:
+                self.log.debug("terms message but no callback")
+        elif msg_type == "jobs":
+            if self.jobs_callback is not None:
+                self.jobs_callback(msg["data"])
+            else:
+                self.log.debug("jobs message but no callback")
 
 
 
@@ -103,26 +147,61 @@ class ClientWorker(object):
         self.config = ConfigFile(config_data=self.config_data)
         self.initial_total = total if total is not None else 0
 
-        self.pipe = PipeMessenger(self.raw_pipe)
+        self.pipe = PipeMessenger(
+            self.raw_pipe,
+            terms_callback=self.on_terms)
 
         self.client_status = CaptureStatus(CaptureStatus.STATUS_UNKNOWN)
 
+    def output_config(self):
+        """return the output config the listeners are built from."""
+        output_config = dict(self.config.getValue("output", {}))
+
+        # shards overlap, so their merged output needs the id filter
+        if (isinstance(self.config.getValue("twitter_auth", None), list) and
+                not output_config.get("dedup_memory")):
+            output_config["dedup_memory"] = SHARDED_DEDUP_MEMORY
+
+        return output_config
+
+    def make_listener(self, collection_name, output_config):
+        """return the listener writing a collection's output."""
+        if output_config.get("sinks"):
+            # fan out to the configured sinks instead of one file
+            options = dict(
+                (key, value) for key, value in output_config.items()
+                if key in FanoutListener.OPTIONS)
+            return FanoutListener(
+                collection_name=collection_name,
+                **options
+            )
+
+        options = dict(
+            (key, value) for key, value in output_config.items()
+            if key != "sinks")
+        return RotatingFileListener(
+            collection_name=collection_name,
+            **options
+        )
+
     def initialize(self):
         """initialize the worker."""
+        self.listener = self.make_listener(
+            self.collection_name,
+            self.output_config())
+        self.listener.stats.total = self.initial_total
 
-        output_config = self.config.getValue("output", {})
+        self.create_client()
+        if self.terms:
+            self.listener.set_terms(**self.client.split_keyword_args())
 
-        self.listener = RotatingFileListener(
-            collection_name=self.collection_name,
-            **output_config
-        )
+    def create_client(self):
+        """create the client streaming into self.listener."""
         self.listener.data_callback = functools.partial(
             self.dataCallback,
             (self,)
         )
-        self.listener.stats.total = self.initial_total
 
-        # create client
         self.client = TwitterClient(
             listener=self.listener,
             keywords=self.terms
@@ -167,6 +246,14 @@ class ClientWorker(object):
         # self.updateStatus(CaptureStatus.STATUS_STOPPED)
 
 
+    def on_terms(self, terms):
+        """change the running stream's terms."""
+        self.terms = terms
+        if not self.client.update_keywords(terms):
+            self.log.warn("stream can't change terms without a restart")
+        self.listener.set_terms(**self.client.split_keyword_args())
+
+
     def dataCallback(self, listener, stats):
         """handle data callback by sending periodic updates."""
         # self.log.debug("worker callback!")
@@ -184,13 +271,128 @@ class ClientWorker(object):
         now = datetime.now()
         delta = now - self.last_stat_update_time
         if delta.total_seconds() > 5:
-            received = stats.received
-            stats.calculate_rate()
-            self.pipe.sendUpdate(now, received, stats.rate, stats.total)
+            self.send_updates(now)
             self.last_stat_update_time = now
 
+            # new terms from the parent
+            while self.pipe.receive():
+                pass
+
         return True
 
+    def send_updates(self, now):
+        """send the parent the listener's stats."""
+        self.send_update(now, self.listener)
+
+    def send_update(self, now, listener, job_id=None):
+        """send the parent one listener's stats."""
+        stats = listener.stats
+        received = stats.received
+        stats.calculate_rate()
+        writer_stats = listener.writer_stats()
+        sink_stats = listener.sink_stats()
+        if sink_stats is not None:
+            sink_stats = dict(
+                (name, sink.as_dict())
+                for name, sink in sink_stats.items())
+        self.pipe.sendUpdate(
+            now,
+            received,
+            stats.rate,
+            stats.total,
+            writer_stats.as_dict() if writer_stats is not None else None,
+            stats.duplicates,
+            sink_stats,
+            listener.tap_stats(),
+            job_id)
+
+
+
+def union_terms(jobs):
+    """return every job's terms without repeats, in job id order."""
+    return unique(
+        term
+        for job_id in sorted(jobs)
+        for term in jobs[job_id]["terms"] or ())
+
+
+class SharedClientWorker(ClientWorker):
+
+    """Capture several jobs from one stream on the union of their terms.
+
+    A RoutingListener passes each status to the listeners of the jobs
+    whose terms it matched, so every job still gets its own output files
+    and counts. jobs maps job id -> {"name", "terms", "total"}.
+    """
+
+    # output keys used by the router instead of the job listeners
+    ROUTER_OPTIONS = ("dedup_memory", "dedup_error_rate", "dedup_window")
+
+    def __init__(self, jobs, event, pipe, config_data):
+        super(SharedClientWorker, self).__init__(
+            None, union_terms(jobs), event, pipe, 0, config_data)
+        self.jobs = {}
+        self.initial_jobs = jobs
+        self.job_output_config = None
+        self.pipe.jobs_callback = self.on_jobs
+
+    def initialize(self):
+        """initialize the router, the client and every job's listener."""
+        output_config = self.output_config()
+
+        # filter duplicates once for all the jobs
+        options = dict(
+            (key, output_config.pop(key))
+            for key in self.ROUTER_OPTIONS
+            if key in output_config)
+        for key in ("classify_mode", "json_codec"):
+            if key in output_config:
+                options[key] = output_config[key]
+        self.job_output_config = output_config
+        self.listener = RoutingListener(**options)
+
+        self.create_client()
+        self.on_jobs(self.initial_jobs)
+
+    def on_jobs(self, jobs):
+        """add, remove and retarget routes to match jobs."""
+        for job_id in sorted(set(self.jobs) - set(jobs)):
+            self.log.info("removing job %d", job_id)
+            try:
+                self.listener.remove_route(job_id).shutdown()
+            except Exception:
+                self.log.exception("exception removing job %d", job_id)
+
+        for job_id, job in sorted(jobs.items()):
+            args = self.client.split_keyword_args(job["terms"] or [])
+            if job_id not in self.jobs:
+                self.log.info("adding job %d (%s)", job_id, job["name"])
+                listener = self.make_listener(
+                    job["name"],
+                    self.job_output_config)
+                listener.stats.total = job["total"] or 0
+                listener.set_terms(**args)
+                self.listener.add_route(job_id, listener, **args)
+            elif job["terms"] != self.jobs[job_id]["terms"]:
+                self.listener.routes[job_id].set_terms(**args)
+                self.listener.set_route_terms(job_id, **args)
+
+        self.jobs = jobs
+        terms = union_terms(jobs)
+        if terms != self.terms:
+            self.terms = terms
+            if not self.client.update_keywords(terms):
+                self.log.warn("stream can't change terms without a restart")
+
+    def on_terms(self, terms):
+        """the shared stream's terms only change through on_jobs."""
+        self.log.warn("terms message for a shared worker ignored")
+
+    def send_updates(self, now):
+        """send the parent every job's stats."""
+        for job_id, listener in sorted(self.listener.routes.items()):
+            self.send_update(now, listener, job_id)
+
 
 #
 # worker thread function
@@ -241,24 +443,55 @@ def process_worker(
     pipe.close()
 
 
+def shared_process_worker(args, event, jobs, pipe, config_data):
 
-class MultiprocessClientBase(object):
+    client = None
+    try:
+        log = logging.getLogger("shared_process")
 
-    """Base class for a multi-processing task"""
+        log.info("Starting jobs %s (%s)", sorted(jobs), repr(event))
 
-    def __init__(self, config):
-        """initialize the multiprocess client"""
-        self.client = None
-        self.listener = None
-        self.config = config
-        self.log = logging.getLogger(self.__class__.__name__)
+        client = SharedClientWorker(jobs, event, pipe, config_data)
+        client.initialize()
+        client.run()
+
+    except exceptions.KeyboardInterrupt:
+        log.warn("--keyboard interrupt")
+    finally:
+        if client is not None:
+            client.shutdown()
+
+    log.info("PROCESS ENDING")
+
+    pipe.close()
+
+
+
+class JobRunner(object):
+
+    """One active job: its capture process, pipe and server status."""
+
+    def __init__(self, client, job):
+        """initialize the runner for a job dict from the server"""
+        self.client = client
+        self.config = client.config
+        self.messenger = client.messenger
+        self.job_id = job["id"]
+        self.log = logging.getLogger(
+            "%s.%d" % (self.__class__.__name__, self.job_id))
         self.event = multiprocessing.Event()
         self.process = None
-        self.messenger = None
-        self.shutting_down = False
+        self.finished = False
+        self.restart_pending = False
 
-        self.create_server_messenger()
-        self.job_checker = JobChecker(self.messenger)
+        # sharded streams take new terms without a restart
+        self.live_terms = isinstance(
+            self.config.getValue("twitter_auth", None), list)
+
+        # the first terms are what the process starts with, not a change
+        self.term_checker = TermChecker(self.messenger, self.job_id)
+        self.term_checker.checkTerms()
+        self.term_checker.resetTermsChanged()
 
         self.client_pipe, self.worker_pipe = multiprocessing.Pipe()
         self.pipe = PipeMessenger(
@@ -268,18 +501,6 @@ class MultiprocessClientBase(object):
 
         self.client_status = CaptureStatus(CaptureStatus.STATUS_UNKNOWN)
 
-    def create_server_messenger(self):
-        """create the server messenger object"""
-        base_url = self.config.getValue("server.base_url", None)
-        auth_token = self.config.getValue("server.auth_token", None)
-        self.messenger = ServerMessenger(
-            base_url,
-            auth_token)
-
-    def build_client(self):
-        """build, initialize, and configure the client."""
-        pass
-
     def start_process(
             self, collection_name, initial_terms=None, initial_total=0):
         """start the separate capture process"""
@@ -288,9 +509,8 @@ class MultiprocessClientBase(object):
         # reset event
         self.event.clear()
 
-        children = multiprocessing.active_children()
-        if children is not None and len(children) > 0:
-            self.log.debug("%d active children", len(children))
+        if self.process is not None and self.process.is_alive():
+            self.log.debug("capture process is still running")
             return
 
         self.process = multiprocessing.Process(
@@ -323,9 +543,42 @@ class MultiprocessClientBase(object):
     def on_update(self, data):
         """receive update message"""
         self.log.debug("on update %s", repr(data))
+        writer = data.get("writer", None)
+        if writer is not None and writer["depth"] > 0:
+            self.log.info(
+                "writer backpressure: depth %d, lag %.3fs, stalled %.3fs, "
+                "dropped %d, spilled %d",
+                writer["depth"],
+                writer["lag"],
+                writer["stall_time"],
+                writer["dropped"],
+                writer["spilled"])
+        sinks = data.get("sinks", None) or {}
+        for name, sink in sorted(sinks.items()):
+            self.log.info(
+                "sink %s: %.1f/s, depth %d, lag %.3fs, dropped %d, "
+                "sink dropped %d",
+                name,
+                sink["rate"],
+                sink["depth"],
+                sink["lag"],
+                sink["dropped"],
+                sink["sink_dropped"])
+        tap = data.get("tap", None) or ()
+        for i, subscriber in enumerate(tap):
+            if subscriber["depth"] > 0 or subscriber["dropped"] > 0:
+                self.log.info(
+                    "tap subscriber %d: depth %d, lag %.3fs, dropped %d",
+                    i,
+                    subscriber["depth"],
+                    subscriber["lag"],
+                    subscriber["dropped"])
+        if data.get("duplicates", 0) > 0:
+            self.log.info("duplicates dropped: %d", data["duplicates"])
         self.messenger.pingServer(
             data["total"],
-            data["rate"])
+            data["rate"],
+            self.job_id)
         #self.messenger.putUpdate(
         #    data["received"],
         #    data["total"],
@@ -345,147 +598,503 @@ class MultiprocessClientBase(object):
             # self.messenger.updateStatus(CaptureStatus.STATUS_STOPPED)
 
 
+    def receive(self):
+        """handle a message from the process, False if there wasn't one"""
+        return self.pipe.receive()
+
+    def send_terms(self, terms):
+        """pass new terms to the running process"""
+        self.pipe.sendTerms(terms)
+
+
+    def check(self):
+        """reconcile the job with the server once.
+
+        Sets finished once the capture has been stopped.
+        """
+        if self.event.is_set():
+            self.log.debug("quitting job %d", self.job_id)
+            self.finished = True
+            return
+
+        # check status
+        job_status = self.messenger.getStatus(self.job_id)
+        self.log.debug("Job status: %s", json.dumps(job_status))
+        if job_status is None:
+            return
+
+        status = CaptureStatus(job_status["status"])
+
+        # recheck terms
+        term_checker = self.term_checker
+        term_checker.checkTerms()
+        if term_checker.haveTermsChanged():
+            term_checker.resetTermsChanged()
+            if (self.live_terms and
+                    self.client_status == CaptureStatus.STATUS_STARTED):
+                self.log.info("terms changed, updating shards...")
+                self.send_terms(term_checker.terms)
+            else:
+                self.log.info("terms changed...")
+                self.restart_pending = True
+
+        # attempt to reconcile the two statuses
+        new_status = None
+        if status != self.client_status:
+            self.log.info(
+                "different statuses (server:%s, client:%s)",
+                status,
+                self.client_status)
+
+
+            if status.stopped:
+                if self.client_status.running:
+                    self.log.info("stopping capture")
+                    self.stop_process()
+                    if status.value == CaptureStatus.STATUS_STOPPING:
+                        new_status = CaptureStatus(
+                            CaptureStatus.STATUS_STOPPED)
+            elif status.running:
+                if self.client_status == CaptureStatus.STATUS_STARTED:
+                    new_status = self.client_status
+                else:
+                    self.start_process(
+                        job_status["name"],
+                        term_checker.terms,
+                        job_status["total_count"])
+                    self.restart_pending = False
+
+        # update server status
+        if new_status is not None:
+            self.log.debug("changing status to %s", new_status)
+            self.messenger.updateStatus(new_status.value, self.job_id)
+
+
+        # check for restart
+        if self.restart_pending:
+            self.log.info("restarting...")
+            self.stop_process()
+
+            term_checker.checkTerms()
+            self.start_process(
+                job_status["name"],
+                term_checker.terms,
+                job_status["total_count"])
+            term_checker.resetTermsChanged()
+
+            self.restart_pending = False
+
+
+
+class SharedJobRunner(JobRunner):
+
+    """A job captured by the SharedCapture process with other jobs.
+
+    Starting and stopping the job adds it to and removes it from the
+    shared capture; the process's status applies to all of its jobs.
+    """
+
+    def __init__(self, client, job, capture):
+        """initialize the runner for a job dict from the server"""
+        self.capture = capture
+        super(SharedJobRunner, self).__init__(client, job)
+
+    def start_process(
+            self, collection_name, initial_terms=None, initial_total=0):
+        """add the job to the shared capture"""
+        self.event.clear()
+        self.capture.add_job(
+            self, collection_name, initial_terms, initial_total)
+
+    def stop_process(self):
+        """remove the job from the shared capture"""
+        self.event.set()
+        self.capture.remove_job(self.job_id)
+
+    def receive(self):
+        """the shared capture receives the process's messages"""
+        return False
+
+    def send_terms(self, terms):
+        """change the job's terms in the shared capture"""
+        self.capture.update_terms(self.job_id, terms)
+
+
+
+def job_route(job):
+    """return what decides where a job's statuses go, None for no job.
+
+    The total only seeds the job's count when its listener is created,
+    so a newer total from the server isn't a change.
+    """
+    if job is None:
+        return None
+    return (job["name"], job["terms"])
+
+
+def job_routes(jobs):
+    """return {job id: job_route(job)}"""
+    return dict((job_id, job_route(job)) for job_id, job in jobs.items())
+
+
+class SharedCapture(object):
+
+    """One capture process streaming the union of several jobs' terms.
+
+    Jobs are added and removed by their SharedJobRunners; sync() then
+    brings the process up to date once per loop. Sharded streams take
+    the new jobs live, otherwise the process is restarted with them.
+    """
+
+    def __init__(self, client):
+        """initialize without a process"""
+        self.config = client.config
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.event = multiprocessing.Event()
+        self.process = None
+
+        # job id -> {"name", "terms", "total"}, and its runner
+        self.jobs = {}
+        self.runners = {}
+        # the jobs the process has, None if it isn't running
+        self.running_jobs = None
+
+        self.live_jobs = isinstance(
+            self.config.getValue("twitter_auth", None), list)
+
+        self.client_pipe, self.worker_pipe = multiprocessing.Pipe()
+        self.pipe = PipeMessenger(
+            self.client_pipe,
+            status_callback=self.on_status,
+            update_callback=self.on_update)
+
+        self.status = CaptureStatus(CaptureStatus.STATUS_UNKNOWN)
+
+    def add_job(self, runner, name, terms=None, total=0):
+        """capture a job from the next sync()"""
+        job = {"name": name, "terms": list(terms or []), "total": total}
+        self.jobs[runner.job_id] = job
+        self.runners[runner.job_id] = runner
+
+        # already being captured, it's as started as the process
+        if (self.running_jobs is not None and
+                job_route(self.running_jobs.get(runner.job_id)) ==
+                job_route(job)):
+            runner.client_status = self.status
+
+    def remove_job(self, job_id):
+        """stop capturing a job from the next sync()"""
+        self.jobs.pop(job_id, None)
+        self.runners.pop(job_id, None)
+
+    def update_terms(self, job_id, terms):
+        """change a job's terms from the next sync()"""
+        if job_id in self.jobs:
+            self.jobs[job_id]["terms"] = list(terms or [])
+
+    def sync(self):
+        """start, update or stop the process to capture the jobs"""
+        if self.running_jobs is not None and (
+                job_routes(self.jobs) == job_routes(self.running_jobs)):
+            return
+
+        if not self.jobs:
+            self.log.info("no jobs left, stopping shared capture")
+            self.stop()
+            return
+
+        jobs = dict(
+            (job_id, dict(job)) for job_id, job in self.jobs.items())
+        if (self.live_jobs and self.process is not None and
+                self.process.is_alive()):
+            self.log.info("updating shared capture: jobs %s", sorted(jobs))
+            self.pipe.sendJobs(jobs)
+            for runner in self.runners.values():
+                runner.client_status = self.status
+        else:
+            self.log.info("restarting shared capture: jobs %s", sorted(jobs))
+            self.stop()
+            self.start(jobs)
+        self.running_jobs = jobs
+
+    def start(self, jobs):
+        """start the capture process"""
+        self.event.clear()
+        self.process = multiprocessing.Process(
+            target=shared_process_worker,
+            args=(self,),
+            kwargs={
+                "event": self.event,
+                "jobs": jobs,
+                "pipe": self.worker_pipe,
+                "config_data": self.config.config_data
+            })
+        self.process.daemon = True
+        self.process.start()
+
+    def stop(self):
+        """stop the capture process"""
+        self.event.set()
+        if self.process is not None:
+            while self.process.is_alive():
+                time.sleep(0.5)
+            self.process.join()
+            self.process = None
+
+        # whatever the old process sent last
+        while self.pipe.receive():
+            pass
+        self.running_jobs = None
+
+    def on_status(self, status):
+        """pass the process's status to every job"""
+        self.status = CaptureStatus(status)
+        for runner in self.runners.values():
+            runner.on_status(status)
+
+    def on_update(self, data):
+        """pass a job's update to its runner"""
+        runner = self.runners.get(data.get("job"))
+        if runner is not None:
+            runner.on_update(data)
+
+    def receive(self):
+        """handle a message from the process, False if there wasn't one"""
+        return self.pipe.receive()
+
+
+
+class MultiprocessClientBase(object):
+
+    """Base class for a multi-processing task
+
+    Runs up to max_jobs of the client's active jobs at once, each in its
+    own capture process with its own stream, listener and output files.
+    Every job's status is reconciled with the server independently.
+
+    With "shared_stream" set, the jobs share one SharedCapture process
+    and stream instead, each still with its own listener and files.
+    """
+
+    def __init__(self, config):
+        """initialize the multiprocess client"""
+        self.config = config
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.messenger = None
+        self.shutting_down = False
+        self.max_jobs = config.getValue("max_jobs", 1)
+
+        # job id -> JobRunner
+        self.runners = {}
+
+        self.shared = None
+        if config.getValue("shared_stream", False):
+            self.shared = SharedCapture(self)
+
+        self.create_server_messenger()
+        self.job_checker = JobChecker(self.messenger)
+
+        self.retention = None
+        self.create_retention_manager()
+
+    def create_server_messenger(self):
+        """create the server messenger object"""
+        base_url = self.config.getValue("server.base_url", None)
+        auth_token = self.config.getValue("server.auth_token", None)
+        self.messenger = ServerMessenger(
+            base_url,
+            auth_token)
+
+    def create_retention_manager(self):
+        """create the retention manager if a quota is configured"""
+        retention_config = dict(self.config.getValue("retention", None) or {})
+        if not retention_config:
+            return
+        self.retention_interval = retention_config.pop("interval", 60.0)
+
+        # only the capture files the listeners write can be evicted
+        for key in ("extension", "temporary_extension"):
+            value = self.config.getValue("output.%s" % key, None)
+            if value is not None:
+                retention_config.setdefault(key, value)
+
+        self.retention = RetentionManager(
+            self.config.getValue("output.base_dir", "./captures/"),
+            notify=self.on_retention,
+            **retention_config)
+
+    def on_retention(self, level, message):
+        """pass quota warnings on to the server.
+
+        putLogMessage is a stub (the server API has no endpoint that takes
+        a message), so the server doesn't hear about these yet; the
+        retention manager has already logged them locally.
+        """
+        self.messenger.putLogMessage(message, level)
+
+    def build_client(self):
+        """build, initialize, and configure the client."""
+        pass
+
+    def stop_process(self):
+        """stop every job's capture process"""
+        for runner in self.runners.values():
+            runner.stop_process()
+        if self.shared is not None:
+            self.shared.stop()
+
+
     def run(self):
         """run capture"""
         self.log.debug("starting client")
 
+        if self.retention is not None:
+            self.retention.start(self.retention_interval)
+
         while not self.shutting_down:
-            self.wait_for_job()
+            self.check_jobs()
 
-            if (not self.shutting_down and
-                    self.job_checker.activeJob is not None):
-                self.log.info("wait for active job -> starting collection")
+            # wait loop, check messages during this
+            self.wait_for_messages(5)
+
+            for job_id, runner in self.runners.items():
+                runner.check()
+                if runner.finished:
+                    self.log.info(
+                        "stopping collection -> job %d finished", job_id)
+                    del self.runners[job_id]
 
-                self.do_job()
+            if self.shared is not None:
+                self.shared.sync()
 
-                self.log.info("stopping collection -> waiting for active job")
+        self.stop_process()
+
+        if self.retention is not None:
+            self.retention.stop()
 
         self.log.info("exiting run")
 
 
-    def wait_for_job(self):
-        """waits for an active job from the server"""
-        # deactivate any job
-        self.job_checker.deactivateJob()
-        active_job = None
+    def check_jobs(self):
+        """start a runner for each new running job, up to max_jobs"""
+        for job in self.job_checker.getActiveJobs():
+            if job["id"] in self.runners:
+                continue
 
-        # progress while we're not
-        while not self.shutting_down:
-            # grab the first active job
-            active_job = self.job_checker.getFirstActiveJob()
-            if active_job is not None:
-                status = CaptureStatus(active_job["status"])
-                if status.running:
-                    self.job_checker.activateJob(active_job)
-                    break
-                else:
-                    self.log.debug("active job is stopped")
-            else:
-                self.log.debug("no active job")
+            status = CaptureStatus(job["status"])
+            if not status.running:
+                self.log.debug("active job %d is stopped", job["id"])
+                continue
 
-            # pause for a while
-            time.sleep(5)
+            if len(self.runners) >= self.max_jobs:
+                self.log.debug(
+                    "not starting job %d, already running %d jobs",
+                    job["id"],
+                    len(self.runners))
+                continue
 
+            self.log.info("active job %d -> starting collection", job["id"])
+            if self.shared is not None:
+                runner = SharedJobRunner(self, job, self.shared)
+            else:
+                runner = JobRunner(self, job)
+            self.runners[job["id"]] = runner
 
-    def handle_message(self, msg):
-        """ handle a message from the process """
-        pass
 
+    def wait_for_messages(self, seconds):
+        """handle messages from the processes for a while"""
+        time_before = datetime.now()
+        now = datetime.now()
+        while (now - time_before).total_seconds() < seconds:
+
+            # handle messages or sleep
+            received = False
+            for runner in self.runners.values():
+                if runner.receive():
+                    received = True
+            if self.shared is not None and self.shared.receive():
+                received = True
+            if not received:
+                time.sleep(1)
+
+            # update time
+            now = datetime.now()
 
-    def do_job(self):
-        self.log.debug("starting collection")
 
-        # create term checker
-        term_checker = TermChecker(self.messenger)
-        term_checker.checkTerms()
+#
+# unittests
+#
+#
+class RecordingCapture(SharedCapture):
 
-        # reset event
-        self.event.clear()
+    """SharedCapture that records starts and stops instead of forking."""
 
-        # start process
-        # self.start_process(term_checker.terms)
+    def __init__(self, client):
+        """construct the capture."""
+        super(RecordingCapture, self).__init__(client)
+        self.calls = []
 
-        # restart flag
-        restart_pending = False
+    def start(self, jobs):
+        """record the start."""
+        self.calls.append(("start", sorted(jobs)))
 
-        while not self.shutting_down and not self.event.is_set():
+    def stop(self):
+        """record the stop."""
+        self.calls.append("stop")
+        self.running_jobs = None
 
-            # wait loop, check messages during this
-            time_before = datetime.now()
-            now = datetime.now()
-            while (now - time_before).total_seconds() < 5:
 
-                # handle messages or sleep
-                received = self.pipe.receive()
-                if not received:
-                    time.sleep(1)
+class FakeRunner(object):
 
-                # update time
-                now = datetime.now()
+    """Stands in for a SharedJobRunner."""
 
-            # check status
-            job_status = self.messenger.getStatus()
-            self.log.debug("Job status: %s", json.dumps(job_status))
-            if job_status is None:
-                continue
+    def __init__(self, job_id):
+        """construct the runner."""
+        self.job_id = job_id
+        self.client_status = CaptureStatus(CaptureStatus.STATUS_UNKNOWN)
 
-            status = CaptureStatus(job_status["status"])
+    def on_status(self, status):
+        """take the process status."""
+        self.client_status = CaptureStatus(status)
 
-            # recheck terms
-            term_checker.checkTerms()
-            if term_checker.haveTermsChanged():
-                self.log.info("terms changed...")
-                restart_pending = True
-                term_checker.resetTermsChanged()
 
-            # attempt to reconcile the two statuses
-            new_status = None
-            if status != self.client_status:
-                self.log.info(
-                    "different statuses (server:%s, client:%s)",
-                    status,
-                    self.client_status)
-
-
-                if status.stopped:
-                    if self.client_status.running:
-                        self.log.info("stopping capture")
-                        self.stop_process()
-                        if status.value == CaptureStatus.STATUS_STOPPING:
-                            new_status = CaptureStatus(
-                                CaptureStatus.STATUS_STOPPED)
-                elif status.running:
-                    if self.client_status == CaptureStatus.STATUS_STARTED:
-                        new_status = self.client_status
-                    else:
-                        self.start_process(
-                            job_status["name"],
-                            term_checker.terms,
-                            job_status["total_count"])
-                        restart_pending = False
-
-            # update server status
-            if new_status is not None:
-                self.log.debug("changing status to %s", new_status)
-                self.messenger.updateStatus(new_status.value)
-
-
-            # check for restart
-            if restart_pending:
-                self.log.info("restarting...")
-                self.stop_process()
-
-                term_checker.checkTerms()
-                self.start_process(
-                    job_status["name"],
-                    term_checker.terms,
-                    job_status["total_count"])
-                term_checker.resetTermsChanged()
-
-                restart_pending = False
-
-        # quitting
-        self.log.debug(
-            "quitting job (%s,%s)",
-            repr(self.shutting_down),
-            repr(self.event.is_set()))
+class SharedCaptureTest(unittest.TestCase):
+
+    """SharedCapture tests."""
+
+    def setUp(self):
+        """create a capture with two jobs running."""
+        client = FakeRunner(0)
+        client.config = ConfigFile(config_data={})
+        self.capture = RecordingCapture(client)
+        self.runners = [FakeRunner(1), FakeRunner(2)]
+        self.capture.add_job(self.runners[0], "one", ["a"], 10)
+        self.capture.add_job(self.runners[1], "two", ["b"], 0)
+        self.capture.sync()
+        self.capture.on_status(CaptureStatus.STATUS_STARTED)
+        del self.capture.calls[:]
+
+    def test_new_total_keeps_process(self):
+        """re-adding a job with a newer total doesn't restart."""
+        self.runners[0].client_status = CaptureStatus(
+            CaptureStatus.STATUS_STOPPED)
+        self.capture.add_job(self.runners[0], "one", ["a"], 500)
+        self.capture.sync()
+        self.assertEqual(self.capture.calls, [])
+        self.assertEqual(
+            self.runners[0].client_status, CaptureStatus.STATUS_STARTED)
+
+    def test_changes_restart(self):
+        """new terms restart the process; no jobs stop it."""
+        self.capture.update_terms(2, ["c"])
+        self.capture.sync()
+        self.assertEqual(self.capture.calls, ["stop", ("start", [1, 2])])
+
+        self.capture.remove_job(1)
+        self.capture.remove_job(2)
+        self.capture.sync()
+        self.assertEqual(self.capture.calls[-1], "stop")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,8 @@ from listeners.file import RotatingFileListener
 from configfile import ConfigFile
 from server_messenger import ServerMessenger
 from streamer import SourceAddrStreamer
+from stream_engine import EngineStream
+from sharding import ShardedStream, MAX_TERMS, MAX_LOCATIONS
 
 import re
 
@@ -23,6 +25,8 @@ class TwitterClient(object):
         self.update_interval = 10
         self.twitter_auth = None
         self.source_addr = None
+        self.stream_engine = "tweepy"
+        self.sharding = {}
 
         self.listener = listener
         self.stream = None
@@ -40,25 +44,55 @@ class TwitterClient(object):
         """configure the client"""
         self.twitter_auth = config.getValue("twitter_auth", None)
         self.source_addr = config.getValue("source_addr", None)
+        self.stream_engine = config.getValue("stream_engine", "tweepy")
+        self.sharding = config.getValue("sharding", None) or {}
         self.update_interval = config.getValue("server.update_interval", 60.0)
 
 
-    def initialize(self):
-        """initialize the client"""
+    def make_auth(self, twitter_auth):
+        """return an OAuthHandler for a twitter_auth config dict"""
+        auth = tweepy.OAuthHandler(
+            twitter_auth["api_key"],
+            twitter_auth["api_secret"])
+        auth.set_access_token(
+            twitter_auth["access_token"],
+            twitter_auth["access_token_secret"])
+        return auth
+
 
-        api_key = self.twitter_auth["api_key"]
-        api_secret = self.twitter_auth["api_secret"]
-        access_token = self.twitter_auth["access_token"]
-        access_token_secret = self.twitter_auth["access_token_secret"]
+    def initialize(self):
+        """initialize the client
 
+        A list of twitter_auth credential sets shards the terms across one
+        connection per set (see sharding).
+        """
 
         # auth
         self.log.debug("doAuth")
-        self.auth = tweepy.OAuthHandler(api_key, api_secret)
-        self.auth.set_access_token(access_token, access_token_secret)
+        if isinstance(self.twitter_auth, list):
+            auths = [self.make_auth(a) for a in self.twitter_auth]
+            self.auth = auths[0]
+            self.stream = ShardedStream(
+                auths,
+                self.listener,
+                source_addr=self.source_addr,
+                stall_warnings=True,
+                max_terms=self.sharding.get("max_terms", MAX_TERMS),
+                max_locations=self.sharding.get(
+                    "max_locations", MAX_LOCATIONS),
+                timeout=300,
+                retry_count=10)
+            return
+
+        self.auth = self.make_auth(self.twitter_auth)
 
         # create streamer
-        self.stream = SourceAddrStreamer(
+        stream_class = SourceAddrStreamer
+        if self.stream_engine == "engine":
+            stream_class = EngineStream
+        elif self.stream_engine != "tweepy":
+            raise ValueError("invalid stream_engine: %s" % self.stream_engine)
+        self.stream = stream_class(
             self.auth,
             self.listener,
             source_addr=self.source_addr,
@@ -82,6 +116,20 @@ class TwitterClient(object):
         else:
             self.stream.sample()
 
+    def update_keywords(self, keywords):
+        """change the keywords of a running stream
+
+        Returns False if the stream can't change them in place and has to
+        be restarted.
+        """
+        self.keywords = keywords
+        if not isinstance(self.stream, ShardedStream):
+            return False
+        track_args = self.split_keyword_args()
+        self.log.debug("updating keywords: %s", repr(track_args))
+        self.stream.update(**track_args)
+        return True
+
     def parse_geo_rect(self, geo_string):
         m = self.geo_regex.match(geo_string)
         if m is not None:
@@ -98,23 +146,28 @@ class TwitterClient(object):
 
         return None
 
-    def split_keyword_args(self):
-        """parse out geo terms"""
-        keywords = []
+    def split_keyword_args(self, keywords=None):
+        """parse out geo terms
+
+        keywords defaults to the client's own.
+        """
+        if keywords is None:
+            keywords = self.keywords
+        track = []
         locations = []
         ret = {}
 
-        for k in self.keywords:
+        for k in keywords:
             parsed = self.parse_geo_rect(k)
             if parsed is None:
                 if k is not None and len(k.strip()) > 0:
                     #self.log.info("keyword", repr(k))
-                    keywords.append(k)
+                    track.append(k)
             else:
                 locations.extend(parsed)
 
-        if len(keywords) > 0:
-            ret["track"] = keywords
+        if len(track) > 0:
+            ret["track"] = track
 
         if len(locations) > 0:
             ret["locations"] = locations
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+"""Read side for collections written by RotatingOutFile.
+
+Finished files are memory-mapped and their lines are handed out as
+zero-copy views (memoryview, or buffer on python 2) in time order.
+"""
+
+import os
+import mmap
+import unittest
+from datetime import datetime, timedelta
+from time import mktime
+
+from capture_index import CaptureIndex, index_filename, INDEX_EXTENSION
+from utils.compression import (
+    compression_for_filename, open_decompressed, zstandard)
+from utils.jsoncodec import get_codec
+from rotating_out_file import stream_path, split_suffix
+
+try:
+    _buffer = buffer
+except NameError:
+    _buffer = None
+
+
+def to_timestamp(datetime_):
+    """return a local datetime as epoch seconds."""
+    return mktime(datetime_.timetuple()) + datetime_.microsecond / 1e6
+
+
+class CaptureFile(object):
+
+    """One finished file in a collection."""
+
+    def __init__(self, path, start, suffix):
+        """construct the capture file."""
+        self.path = path
+        self.start = start
+        self.suffix = suffix
+        self.compression = compression_for_filename(path)
+
+    @property
+    def sort_key(self):
+        """files sort by window, then by no-clobber suffix."""
+        return (self.start, self.suffix)
+
+    def load_index(self):
+        """return the file's CaptureIndex or None if it has none."""
+        name = index_filename(self.path)
+        if os.path.exists(name):
+            return CaptureIndex(name)
+        return None
+
+    def __repr__(self):
+        return "CaptureFile(%s)" % (self.path)
+
+
+class CollectionReader(object):
+
+    """Iterate over the finished files of a collection in time order."""
+
+    def __init__(
+            self,
+            base_dir,
+            collection_name,
+            extension=".json",
+            minute_interval=10,
+            filename_timefmt="%Y%m%d_%H%M",
+            json_codec=None,
+            stream_name=None):
+        """construct the reader. settings should match the writer's.
+
+        stream_name reads one of the collection's other streams (eg.
+        "deletes") instead of the statuses.
+        """
+        self.base_dir = base_dir
+        self.collection_name = collection_name
+        self.stream_name = stream_name
+        self.collection_dir, self.file_prefix = stream_path(
+            base_dir,
+            collection_name,
+            stream_name)
+        self.extension = extension
+        self.minute_interval = minute_interval
+        self.filename_timefmt = filename_timefmt
+        self.codec = get_codec(json_codec)
+
+    def parse_filename(self, path):
+        """return a CaptureFile for path, or None if it isn't one."""
+        name = os.path.basename(path)
+        if not name.startswith(self.file_prefix):
+            return None
+        name = name[len(self.file_prefix):]
+
+        # strip the extension and any compression extension after it
+        compression = compression_for_filename(name)
+        if compression is not None:
+            name = os.path.splitext(name)[0]
+        if not name.endswith(self.extension):
+            return None
+        name = name[:-len(self.extension)]
+
+        name, suffix = split_suffix(name, self.filename_timefmt)
+        if suffix is None:
+            suffix = -1
+
+        try:
+            start = datetime.strptime(name, self.filename_timefmt)
+        except ValueError:
+            return None
+
+        return CaptureFile(path, start, suffix)
+
+    def list_paths(self):
+        """return every path under the collection directory."""
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.collection_dir):
+            for filename in filenames:
+                if not filename.endswith(INDEX_EXTENSION):
+                    paths.append(os.path.join(dirpath, filename))
+        return paths
+
+    def files(self, start=None, end=None):
+        """return finished files overlapping [start, end) in time order."""
+        interval = timedelta(minutes=self.minute_interval)
+        files = []
+        for path in self.list_paths():
+            capture_file = self.parse_filename(path)
+            if capture_file is None:
+                continue
+            if end is not None and capture_file.start >= end:
+                continue
+            if start is not None and capture_file.start + interval <= start:
+                continue
+            files.append(capture_file)
+
+        files.sort(key=lambda f: f.sort_key)
+        return files
+
+    def file_range(self, capture_file, start, end):
+        """return the (first, last) byte offsets to read for a time range.
+
+        Uses the file's index if it has one, so the range is exact to the
+        index interval. last is None to read to the end.
+        """
+        first = 0
+        last = None
+        if start is None and end is None:
+            return first, last
+
+        index = capture_file.load_index()
+        if index is None:
+            return first, last
+
+        if start is not None:
+            first = index.offset_for_time(to_timestamp(start))
+        if end is not None:
+            last = index.offset_after_time(to_timestamp(end))
+        return first, last
+
+    def lines(self, start=None, end=None):
+        """yield each line (without newline) as a zero-copy view.
+
+        Compressed files can't be mapped, their lines are yielded as
+        byte strings instead.
+        """
+        for capture_file in self.files(start, end):
+            first, last = self.file_range(capture_file, start, end)
+            if capture_file.compression is None:
+                lines = self.mapped_lines(capture_file.path, first, last)
+            else:
+                lines = self.compressed_lines(capture_file, first, last)
+
+            for line in lines:
+                yield line
+
+    def objects(self, start=None, end=None):
+        """yield each line decoded, one at a time."""
+        loads = self.codec.loads
+        for line in self.lines(start, end):
+            yield loads(bytes(line) if _buffer is None else str(line))
+
+    def mapped_lines(self, path, first=0, last=None):
+        """yield views of the lines in an uncompressed file."""
+        if os.path.getsize(path) == 0:
+            return
+
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            size = len(mapped) if last is None else min(last, len(mapped))
+            view = None if _buffer is not None else memoryview(mapped)
+            pos = first
+            while pos < size:
+                newline = mapped.find(b"\n", pos)
+                if newline < 0:
+                    # torn last line, not finished
+                    break
+                if newline > pos:
+                    if view is None:
+                        yield _buffer(mapped, pos, newline - pos)
+                    else:
+                        yield view[pos:newline]
+                pos = newline + 1
+        finally:
+            view = None
+            try:
+                mapped.close()
+            except BufferError:
+                # the caller still holds views, let gc close it
+                pass
+
+    def compressed_lines(self, capture_file, first=0, last=None):
+        """yield the lines of a compressed file as byte strings."""
+        f = open_decompressed(capture_file.path, capture_file.compression)
+        try:
+            # read up to first rather than seek, not every decompressing
+            # reader can seek
+            pos = 0
+            while pos < first:
+                chunk = f.read(min(first - pos, 64 * 1024))
+                if not chunk:
+                    break
+                pos += len(chunk)
+            for line in f:
+                if last is not None and pos >= last:
+                    break
+                pos += len(line)
+                line = line.rstrip(b"\n")
+                if line:
+                    yield line
+        finally:
+            f.close()
+
+
+#
+# unittests
+#
+#
+class CollectionReaderTest(unittest.TestCase):
+
+    """Reader tests."""
+
+    def setUp(self):
+        """write a small collection."""
+        from rotating_out_file import RotatingOutFile
+
+        self.base_dir = ".unittest-reader"
+        self.collection = "test"
+        out = RotatingOutFile(
+            base_dir=self.base_dir,
+            collection_name=self.collection,
+            index_interval=1)
+        self.times = [
+            datetime(1997, 10, 30, 12, 45),
+            datetime(1997, 10, 30, 12, 31),
+            datetime(1997, 10, 30, 12, 52),
+        ]
+        for i, dt in enumerate(self.times):
+            out.write('{"created_at":"x","id":%d}' % i, datetime_=dt)
+            out.end_file()
+        out.write('{"created_at":"x","id":3}', datetime_=self.times[1])
+        out.end_file()
+
+        self.reader = CollectionReader(self.base_dir, self.collection)
+
+    def tearDown(self):
+        """remove the collection."""
+        import shutil
+        shutil.rmtree(self.base_dir)
+
+    def test_time_order(self):
+        """lines come back in window then suffix order."""
+        ids = [obj["id"] for obj in self.reader.objects()]
+        self.assertEqual(ids, [1, 3, 0, 2])
+
+    def test_time_range(self):
+        """time ranges select whole windows."""
+        ids = [obj["id"] for obj in self.reader.objects(
+            start=datetime(1997, 10, 30, 12, 40),
+            end=datetime(1997, 10, 30, 12, 50))]
+        self.assertEqual(ids, [0])
+
+    def test_views(self):
+        """lines are views, not copies."""
+        view_type = memoryview if _buffer is None else _buffer
+        for line in self.reader.lines():
+            self.assertTrue(isinstance(line, view_type))
+
+    def test_streams(self):
+        """other streams are read separately from the statuses."""
+        from rotating_out_file import RotatingOutFile
+
+        out = RotatingOutFile(
+            base_dir=self.base_dir,
+            collection_name=self.collection,
+            stream_name="deletes")
+        out.write('{"delete":{"status":{"id":9}}}', datetime_=self.times[0])
+        out.end_file()
+
+        ids = [obj["id"] for obj in self.reader.objects()]
+        self.assertEqual(ids, [1, 3, 0, 2])
+
+        reader = CollectionReader(
+            self.base_dir,
+            self.collection,
+            stream_name="deletes")
+        deletes = [obj["delete"]["status"]["id"] for obj in reader.objects()]
+        self.assertEqual(deletes, [9])
+
+    def test_hour_format(self):
+        """a format ending in _%H isn't read as a suffix."""
+        reader = CollectionReader(
+            self.base_dir,
+            self.collection,
+            minute_interval=60,
+            filename_timefmt="%Y%m%d_%H")
+
+        capture_file = reader.parse_filename("test19971030_12.json")
+        self.assertEqual(capture_file.start, datetime(1997, 10, 30, 12))
+        self.assertEqual(capture_file.suffix, -1)
+
+        capture_file = reader.parse_filename("test19971030_12_03.json")
+        self.assertEqual(capture_file.start, datetime(1997, 10, 30, 12))
+        self.assertEqual(capture_file.suffix, 3)
+
+
+class CompressedReaderTest(unittest.TestCase):
+
+    """Reading compressed collections."""
+
+    def setUp(self):
+        """set up the test."""
+        self.base_dir = ".unittest-reader-compressed"
+        self.collection = "test"
+
+    def tearDown(self):
+        """remove the collection."""
+        import shutil
+        if os.path.exists(self.base_dir):
+            shutil.rmtree(self.base_dir)
+
+    def check_compression(self, compression):
+        """lines come back whole, from the index offset on."""
+        from rotating_out_file import RotatingOutFile
+
+        out = RotatingOutFile(
+            base_dir=self.base_dir,
+            collection_name=self.collection,
+            compression=compression,
+            index_interval=1)
+        for i, minute in enumerate((31, 33, 35)):
+            out.write(
+                '{"created_at":"x","id":%d}' % i,
+                datetime_=datetime(1997, 10, 30, 12, minute))
+        out.end_file()
+
+        reader = CollectionReader(self.base_dir, self.collection)
+        self.assertEqual(
+            [obj["id"] for obj in reader.objects()], [0, 1, 2])
+        self.assertEqual(
+            [obj["id"] for obj in reader.objects(
+                start=datetime(1997, 10, 30, 12, 34))],
+            [1, 2])
+
+    def test_gzip(self):
+        """gzip files are read line by line."""
+        self.check_compression("gzip")
+
+    @unittest.skipIf(zstandard is None, "zstandard isn't installed")
+    def test_zstd(self):
+        """zstd files are read line by line."""
+        self.check_compression("zstd")
+
+
+if __name__ == '__main__':
+    unittest.main()
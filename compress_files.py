@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+"""Compress finished capture files, verifying and replacing each one.
+
+usage: python compress_files.py [--compression gzip] [--level N] file ...
+
+This is what CompressionPool runs in its niced child processes.
+"""
+
+import argparse
+
+from compression_pool import compress_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compression", default="gzip")
+    parser.add_argument("--level", type=int, default=None)
+    parser.add_argument("filenames", nargs="+")
+    args = parser.parse_args()
+
+    for name in args.filenames:
+        compress_file(name, args.compression, args.level)
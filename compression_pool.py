@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""Background compression of finished capture files.
+
+Finished files are handed to a small pool of niced child processes that
+compress them, verify the result and then replace the original. Pending
+files are kept in a journal so they're picked up again after a restart.
+"""
+
+import os
+import sys
+import zlib
+import logging
+import threading
+import subprocess
+import unittest
+from Queue import Queue, Empty
+
+from utils.compression import (
+    check_compression, compression_extension, open_compressed,
+    open_decompressed)
+from capture_index import index_filename
+
+
+log = logging.getLogger(__name__)
+
+
+# bytes read at a time while compressing and verifying
+CHUNK_SIZE = 1024 * 1024
+
+# the child processes' script
+COMPRESS_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "compress_files.py")
+
+# extension of journal files, kept as dot-files next to the data
+JOURNAL_EXTENSION = ".compress"
+
+
+def stream_checksum(f):
+    """return (crc32, length) of everything left in file object f."""
+    crc = 0
+    length = 0
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        crc = zlib.crc32(chunk, crc)
+        length += len(chunk)
+    return crc, length
+
+
+def compress_file(filename, compression, level=None):
+    """compress filename, verify it and replace the original.
+
+    The compressed data is written to a temporary name and only renamed
+    into place once it decompresses to the same bytes, then the original
+    is removed. Returns the compressed filename.
+    """
+    final_filename = filename + compression_extension(compression)
+    tmp_filename = final_filename + ".tmp"
+
+    # compress
+    crc = 0
+    length = 0
+    out = open_compressed(tmp_filename, compression, level)
+    try:
+        with open(filename, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                length += len(chunk)
+                out.write(chunk)
+        out.flush()
+    finally:
+        out.close()
+
+    # verify
+    f = open_decompressed(tmp_filename, compression)
+    try:
+        verify = stream_checksum(f)
+    finally:
+        f.close()
+
+    if verify != (crc, length):
+        os.remove(tmp_filename)
+        raise IOError("verification failed for %s" % (tmp_filename))
+
+    # replace, keeping any index sidecar next to the data
+    os.rename(tmp_filename, final_filename)
+    if os.path.exists(index_filename(filename)):
+        os.rename(index_filename(filename), index_filename(final_filename))
+    os.remove(filename)
+    return final_filename
+
+
+class CompressionJournal(object):
+
+    """Append-only record of files waiting to be compressed."""
+
+    def __init__(self, filename):
+        """construct the journal."""
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def pending(self):
+        """return pending filenames in the order they were added.
+
+        Only reads the journal, so it's safe while a pool is using it.
+        """
+        pending = []
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                for line in f:
+                    action, _, name = line.rstrip("\n").partition("\t")
+                    if action == "add" and name not in pending:
+                        pending.append(name)
+                    elif action == "done" and name in pending:
+                        pending.remove(name)
+        return pending
+
+    def load(self):
+        """return pending filenames in the order they were added.
+
+        Rewrites the journal so it only holds pending entries whose file
+        still exists.
+        """
+        pending = []
+        for name in self.pending():
+            if os.path.exists(name):
+                pending.append(name)
+            else:
+                log.warn("%s is gone, dropping it from the journal", name)
+
+        self.lock.acquire()
+        try:
+            tmp_filename = self.filename + ".tmp"
+            with open(tmp_filename, "w") as f:
+                for name in pending:
+                    f.write("add\t%s\n" % name)
+            os.rename(tmp_filename, self.filename)
+        finally:
+            self.lock.release()
+
+        return pending
+
+    def record(self, action, filename):
+        """append an add/done entry."""
+        self.lock.acquire()
+        try:
+            with open(self.filename, "a") as f:
+                f.write("%s\t%s\n" % (action, filename))
+        finally:
+            self.lock.release()
+
+
+class CompressionPool(object):
+
+    """Compress finished files in niced child processes."""
+
+    def __init__(
+            self,
+            journal_filename,
+            compression="gzip",
+            compression_level=None,
+            max_workers=1,
+            niceness=10):
+        """construct the pool and resume any pending files."""
+        check_compression(compression)
+        self.compression = compression
+        self.compression_level = compression_level
+        self.niceness = niceness
+        self.journal = CompressionJournal(journal_filename)
+        self.queue = Queue()
+        self.stopping = False
+
+        for filename in self.journal.load():
+            log.info("resuming compression of %s", filename)
+            self.queue.put(filename)
+
+        self.threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(
+                target=self.run,
+                name="CompressionPool-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, filename):
+        """queue a finished file for compression."""
+        self.journal.record("add", filename)
+        self.queue.put(filename)
+
+    def close(self):
+        """stop after the files being compressed now are done.
+
+        Anything still queued stays in the journal for next time.
+        """
+        self.stopping = True
+        for thread in self.threads:
+            thread.join()
+
+    def command(self, filename):
+        """return the command line that compresses filename."""
+        cmd = [
+            sys.executable,
+            COMPRESS_SCRIPT,
+            "--compression", self.compression,
+        ]
+        if self.compression_level is not None:
+            cmd.extend(["--level", str(self.compression_level)])
+        cmd.append(filename)
+        return cmd
+
+    def lower_priority(self):
+        """child process setup, drops the cpu priority."""
+        if self.niceness:
+            os.nice(self.niceness)
+
+    def compress(self, filename):
+        """compress one file in a child process. returns True if done."""
+        if not os.path.exists(filename):
+            # finished before a restart but the journal wasn't updated,
+            # or removed (retention) or moved (migrate_partitions) since
+            # it was queued; either way there's nothing left to do
+            log.warn("%s is gone, not compressing it", filename)
+            return True
+
+        returncode = subprocess.call(
+            self.command(filename),
+            preexec_fn=self.lower_priority)
+        if returncode != 0:
+            log.error(
+                "compression of %s failed (exit %d)", filename, returncode)
+            return False
+        return True
+
+    def run(self):
+        """worker thread loop."""
+        while not self.stopping:
+            try:
+                filename = self.queue.get(timeout=0.5)
+            except Empty:
+                continue
+
+            try:
+                if self.compress(filename):
+                    self.journal.record("done", filename)
+            except Exception:
+                log.exception("exception compressing %s", filename)
+
+
+#
+# unittests
+#
+#
+class CompressFileTest(unittest.TestCase):
+
+    """compress_file tests."""
+
+    def setUp(self):
+        """write a file to compress."""
+        self.filename = ".unittest-compress-%d.json" % os.getpid()
+        with open(self.filename, "w") as f:
+            for i in range(1000):
+                f.write('{"id": %d}\n' % i)
+
+    def tearDown(self):
+        """remove test files."""
+        for fn in (self.filename, self.filename + ".gz",
+                   self.filename + ".journal"):
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def test_compress_replaces(self):
+        """the compressed file replaces the original."""
+        with open(self.filename, "rb") as f:
+            expected = f.read()
+
+        final_filename = compress_file(self.filename, "gzip")
+        self.assertFalse(os.path.exists(self.filename))
+
+        f = open_decompressed(final_filename, "gzip")
+        try:
+            self.assertEqual(f.read(), expected)
+        finally:
+            f.close()
+
+    def test_journal_resume(self):
+        """pending journal entries survive a reload."""
+        journal = CompressionJournal(self.filename + ".journal")
+        journal.record("add", "a")
+        journal.record("add", self.filename)
+        journal.record("done", "a")
+        self.assertEqual(journal.load(), [self.filename])
+        self.assertEqual(journal.load(), [self.filename])
+
+    def test_missing_file(self):
+        """a queued file that disappears leaves the journal."""
+        journal_filename = self.filename + ".journal"
+        journal = CompressionJournal(journal_filename)
+        journal.record("add", self.filename)
+        os.remove(self.filename)
+
+        # on startup
+        self.assertEqual(journal.load(), [])
+
+        # while running
+        pool = CompressionPool(journal_filename)
+        try:
+            pool.submit(self.filename)
+            for _ in range(100):
+                if not journal.pending():
+                    break
+                threading.Event().wait(0.05)
+        finally:
+            pool.close()
+        self.assertEqual(journal.pending(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""Bounded-memory filter for dropping duplicate statuses.
+
+Reconnects and restarts replay statuses we've already written. IdFilter
+remembers recent tweet ids in two generations of Bloom filter: new ids
+go in the current generation and lookups check both. When the current
+generation holds as many ids as it was sized for, it becomes the old one
+and the old one is cleared, so memory stays fixed and the most recent
+capacity..2 * capacity ids are always remembered.
+
+With a time window the generations also swap once the current one is
+window seconds old, so ids are remembered for window..2 * window seconds
+unless the capacity runs out first.
+"""
+
+import os
+import math
+import struct
+import unittest
+from time import time
+
+
+# header of a saved filter: bits per generation, hashes, count
+HEADER_FORMAT = "<QII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+MASK64 = (1 << 64) - 1
+
+
+class IdFilter(object):
+
+    """Two-generation Bloom filter keyed on tweet id."""
+
+    def __init__(self, memory_bytes, error_rate=0.001, window=None):
+        """construct the filter.
+
+        memory_bytes is split between the two generations. error_rate is
+        the chance an id we haven't seen is reported as a duplicate (and
+        dropped) while both generations are full. window is the most
+        seconds a generation is kept current, None for no limit.
+        """
+        if memory_bytes < 16:
+            raise ValueError("invalid memory_bytes: %s" % memory_bytes)
+        if not 0 < error_rate < 1:
+            raise ValueError("invalid error_rate: %s" % error_rate)
+        if window is not None and window <= 0:
+            raise ValueError("invalid window: %s" % window)
+
+        self.memory_bytes = memory_bytes
+        self.error_rate = error_rate
+        self.window = window
+
+        # each generation gets half the budget and half the error rate
+        generation_rate = error_rate / 2.0
+        self.num_bits = (memory_bytes // 2) * 8
+        self.num_hashes = max(1, int(round(-math.log(generation_rate, 2))))
+        self.capacity = max(1, int(
+            self.num_bits * (math.log(2) ** 2) / -math.log(generation_rate)))
+
+        self.current = bytearray(self.num_bits // 8)
+        self.old = bytearray(self.num_bits // 8)
+        self.count = 0
+        self.started = time()
+
+    def positions(self, status_id):
+        """return the bit positions for status_id."""
+        h1 = (status_id * 0x9E3779B97F4A7C15) & MASK64
+        h1 ^= h1 >> 31
+        h2 = ((status_id ^ h1) * 0xBF58476D1CE4E5B9) & MASK64
+        h2 = (h2 ^ (h2 >> 29)) | 1
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+    def seen(self, status_id):
+        """check status_id and remember it.
+
+        Returns True if status_id was (probably) seen before.
+        """
+        if self.window is not None:
+            self.expire(time())
+
+        positions = self.positions(status_id)
+        current = self.current
+        old = self.old
+
+        in_current = True
+        in_old = True
+        for pos in positions:
+            byte = pos >> 3
+            bit = 1 << (pos & 7)
+            if not current[byte] & bit:
+                in_current = False
+            if not old[byte] & bit:
+                in_old = False
+
+        if in_current:
+            return True
+
+        for pos in positions:
+            current[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+        if self.count >= self.capacity:
+            self.rotate()
+
+        return in_old
+
+    def __contains__(self, status_id):
+        """return True if status_id was (probably) seen, without adding."""
+        for generation in (self.current, self.old):
+            for pos in self.positions(status_id):
+                if not generation[pos >> 3] & (1 << (pos & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def rotate(self):
+        """start a new generation, forgetting the oldest ids."""
+        self.old = self.current
+        self.current = bytearray(self.num_bits // 8)
+        self.count = 0
+        self.started = time()
+
+    def expire(self, now):
+        """forget the generations that are past the time window."""
+        age = now - self.started
+        if age >= 2 * self.window:
+            self.rotate()
+            self.old = bytearray(self.num_bits // 8)
+        elif age >= self.window:
+            self.rotate()
+
+    def save(self, filename):
+        """write the filter to filename (atomically)."""
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(struct.pack(
+                HEADER_FORMAT,
+                self.num_bits,
+                self.num_hashes,
+                self.count))
+            f.write(self.current)
+            f.write(self.old)
+        os.rename(tmp_filename, filename)
+
+    def load(self, filename):
+        """restore a filter saved by save().
+
+        The current generation's time window starts over. Raises
+        ValueError if it was saved with different settings.
+        """
+        with open(filename, "rb") as f:
+            data = f.read()
+
+        size = self.num_bits // 8
+        if len(data) != HEADER_SIZE + 2 * size:
+            raise ValueError("filter size mismatch: %s" % filename)
+        num_bits, num_hashes, count = struct.unpack_from(HEADER_FORMAT, data)
+        if (num_bits, num_hashes) != (self.num_bits, self.num_hashes):
+            raise ValueError("filter settings mismatch: %s" % filename)
+
+        self.current = bytearray(data[HEADER_SIZE:HEADER_SIZE + size])
+        self.old = bytearray(data[HEADER_SIZE + size:])
+        self.count = count
+        self.started = time()
+
+
+#
+# unittests
+#
+#
+class IdFilterTest(unittest.TestCase):
+
+    """IdFilter tests."""
+
+    def setUp(self):
+        """set up the test."""
+        self.filename = ".unittest-dedup-%d" % os.getpid()
+
+    def tearDown(self):
+        """remove the saved filter."""
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def test_duplicates(self):
+        """ids are reported the second time they're seen."""
+        id_filter = IdFilter(4096)
+        ids = [658000000000000000 + i * 7919 for i in range(500)]
+        self.assertEqual([id_filter.seen(i) for i in ids], [False] * 500)
+        self.assertEqual([id_filter.seen(i) for i in ids], [True] * 500)
+
+    def test_bounded(self):
+        """old ids are forgotten once two generations have filled."""
+        id_filter = IdFilter(1024, error_rate=0.01)
+        id_filter.seen(1)
+        for i in range(2, 2 + 2 * id_filter.capacity):
+            id_filter.seen(i)
+        self.assertFalse(1 in id_filter)
+        self.assertEqual(len(id_filter.current), 512)
+
+    def test_window(self):
+        """generations also swap once they're window seconds old."""
+        id_filter = IdFilter(4096, window=60)
+        id_filter.seen(1)
+        id_filter.started -= 60
+        id_filter.seen(2)
+        self.assertTrue(1 in id_filter)
+
+        id_filter.started -= 120
+        self.assertFalse(id_filter.seen(2))
+        self.assertFalse(1 in id_filter)
+        self.assertRaises(ValueError, IdFilter, 4096, window=0)
+
+    def test_error_rate(self):
+        """false positives stay near the configured rate."""
+        id_filter = IdFilter(64 * 1024, error_rate=0.01)
+        for i in range(id_filter.capacity - 1):
+            id_filter.seen(i)
+        false_positives = sum(
+            1 for i in range(10 ** 7, 10 ** 7 + 10000) if i in id_filter)
+        self.assertTrue(false_positives < 200)
+
+    def test_save_load(self):
+        """a saved filter remembers its ids."""
+        id_filter = IdFilter(4096)
+        id_filter.seen(12345)
+        id_filter.save(self.filename)
+
+        loaded = IdFilter(4096)
+        loaded.load(self.filename)
+        self.assertTrue(12345 in loaded)
+        self.assertRaises(ValueError, IdFilter(8192).load, self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,14 +2,21 @@
 """Base Listener for handling streaming events."""
 
 
+import os
 import logging
 from time import time
 from tweepy.streaming import StreamListener
-import simplejson as json
+from utils.jsoncodec import get_codec
+from utils.sniff import is_status, status_id
+from dedup import IdFilter
 
 
 log = logging.getLogger(__name__)
 
+# classification modes for on_data
+CLASSIFY_PARSE = "parse"
+CLASSIFY_SNIFF = "sniff"
+
 
 class ListenerStats(object):
 
@@ -21,6 +28,7 @@ class ListenerStats(object):
         self.total = initial_total
         self.since = time()
         self.rate = 0
+        self.duplicates = 0
 
     def increment(self, amount=1):
         """increment the current received and total counts."""
@@ -38,16 +46,52 @@ class ListenerStats(object):
             self.received = 0
 
     def __str__(self):
-        return "Total: %d (Rate %s)" % (self.total, self.rate)
+        return "Total: %d (Rate %s, Duplicates %d)" % (
+            self.total,
+            self.rate,
+            self.duplicates)
 
 
 class BaseListener(StreamListener):
 
     """Base listener that implements some counting mechanisms."""
 
-    def __init__(self, api=None):
-        """Construct base listener for tweepy."""
+    def __init__(
+            self,
+            api=None,
+            classify_mode=CLASSIFY_PARSE,
+            json_codec=None,
+            dedup_memory=None,
+            dedup_error_rate=0.001,
+            dedup_window=None):
+        """Construct base listener for tweepy.
+
+        classify_mode selects how on_data routes messages. "parse" decodes
+        every message. "sniff" looks at the first key of the raw data and
+        passes statuses to on_status unparsed (status is None); only
+        control messages get decoded.
+
+        json_codec names the json backend used to decode messages. The
+        fastest installed backend is used if it's None.
+
+        If dedup_memory is set, statuses whose id was already seen are
+        dropped (and counted in stats.duplicates) using an IdFilter of
+        that many bytes with dedup_error_rate false positives, which
+        also forgets ids after dedup_window..2 * dedup_window seconds if
+        dedup_window is set.
+        """
         super(BaseListener, self).__init__(api)
+        if classify_mode not in (CLASSIFY_PARSE, CLASSIFY_SNIFF):
+            raise ValueError("invalid classify_mode: %s" % classify_mode)
+        self.classify_mode = classify_mode
+        self.codec = get_codec(json_codec)
+        self.dedup = None
+        self.dedup_filename = None
+        if dedup_memory:
+            self.dedup = IdFilter(
+                dedup_memory,
+                dedup_error_rate,
+                window=dedup_window)
         self.terminate = False
         self.connected = False
         self.error = False
@@ -59,6 +103,41 @@ class BaseListener(StreamListener):
         """shutdown the listener."""
         pass
 
+    def load_dedup(self, filename):
+        """pick up the ids seen by the last run, saved in filename."""
+        self.dedup_filename = filename
+        if self.dedup is None or not os.path.exists(filename):
+            return
+        try:
+            self.dedup.load(filename)
+        except ValueError:
+            log.warning("ignoring %s, saved with other settings", filename)
+
+    def save_dedup(self):
+        """save the seen ids for the next run to load_dedup's file."""
+        if self.dedup is None or self.dedup_filename is None:
+            return
+        directory = os.path.dirname(self.dedup_filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.dedup.save(self.dedup_filename)
+
+    def writer_stats(self):
+        """return the queued writer's WriterStats, None if there isn't one."""
+        return None
+
+    def sink_stats(self):
+        """return {sink name: WriterStats}, None if there are no sinks."""
+        return None
+
+    def tap_stats(self):
+        """return per-subscriber tap stats, None if there's no tap."""
+        return None
+
+    def set_terms(self, track=None, locations=None):
+        """take the stream's current terms and boxes."""
+        pass
+
     def on_connect(self):
         """handle on_connect event."""
         super(BaseListener, self).on_connect()
@@ -67,9 +146,9 @@ class BaseListener(StreamListener):
 
     def on_disconnect(self, notice):
         """handle on_disconnect event."""
-        super(BaseListener, self).on_disconnect()
+        super(BaseListener, self).on_disconnect(notice)
         self.connected = False
-        log.info("stream disconnect: ", notice)
+        log.info("stream disconnect: %s", notice)
         return True
 
     def on_error(self, status_code):
@@ -96,10 +175,31 @@ class BaseListener(StreamListener):
         Status class.
         """
 
-        data = json.loads(raw_data)
+        if self.classify_mode == CLASSIFY_SNIFF and is_status(raw_data):
+            if self.handle_status(None, raw_data) is False:
+                return False
+        elif self.dispatch_message(
+                self.codec.loads(raw_data), raw_data) is False:
+            return False
+
+        if self.error or not self.connected:
+            log.info(
+                "listener returning false (%s,%s)",
+                self.error,
+                self.connected)
+            return False
+
+        if self.data_callback:
+            return self.data_callback(self.stats)
+
+        return True
+
+
+    def dispatch_message(self, data, raw_data):
+        """call the on_* handler for a decoded message."""
 
         if 'in_reply_to_status_id' in data:
-            if self.on_status(data, raw_data) is False:
+            if self.handle_status(data, raw_data) is False:
                 return False
         elif 'delete' in data:
             delete = data['delete']['status']
@@ -133,17 +233,22 @@ class BaseListener(StreamListener):
         else:
             log.error("Unknown message type: " + str(raw_data))
 
-        if self.error or not self.connected:
-            log.info(
-                "listener returning false (%s,%s)",
-                self.error,
-                self.connected)
-            return False
+        return True
 
-        if self.data_callback:
-            return self.data_callback(self.stats)
 
-        return True
+    def handle_status(self, status, raw_data):
+        """drop duplicate statuses, pass the rest to on_status."""
+        if self.dedup is not None:
+            if status is None:
+                id_ = status_id(raw_data)
+            else:
+                id_ = status.get('id')
+
+            if id_ is not None and self.dedup.seen(id_):
+                self.stats.duplicates += 1
+                return not self.terminate
+
+        return self.on_status(status, raw_data)
 
 
     def on_status(self, status, raw_data):
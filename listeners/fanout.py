@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""Listener that fans statuses out to several sinks."""
+
+import os
+import logging
+import threading
+import unittest
+
+from .base import BaseListener, CLASSIFY_PARSE
+from queued_writer import QueuedWriter, OVERFLOW_DROP_OLDEST
+from sinks import Sink, make_sink
+
+
+log = logging.getLogger(__name__)
+
+
+class FanoutListener(BaseListener):
+
+    """Write each status to every configured sink.
+
+    Every sink has its own bounded QueuedWriter and writer thread, so a
+    slow sink only fills (and overflows) its own queue; it can't stall
+    the stream or the other sinks.
+    """
+
+    # output config keys this listener takes (see ClientWorker)
+    OPTIONS = (
+        "base_dir",
+        "sinks",
+        "classify_mode",
+        "json_codec",
+        "dedup_memory",
+        "dedup_error_rate",
+        "dedup_window",
+        "writer_queue_size",
+        "overflow_policy",
+    )
+
+    def __init__(
+            self,
+            base_dir=None,
+            collection_name=None,
+            sinks=None,
+            classify_mode=CLASSIFY_PARSE,
+            json_codec=None,
+            dedup_memory=None,
+            dedup_error_rate=0.001,
+            dedup_window=None,
+            writer_queue_size=10000,
+            overflow_policy=OVERFLOW_DROP_OLDEST,
+            api=None):
+        """Construct the fan-out listener.
+
+        sinks is a list of sink config dicts (see sinks.make_sink). A
+        sink's queue_size and overflow_policy override writer_queue_size
+        and overflow_policy for that sink.
+        """
+        super(FanoutListener, self).__init__(
+            api,
+            classify_mode=classify_mode,
+            json_codec=json_codec,
+            dedup_memory=dedup_memory,
+            dedup_error_rate=dedup_error_rate,
+            dedup_window=dedup_window)
+        if not sinks:
+            raise ValueError("FanoutListener needs at least one sink")
+
+        self.base_dir = base_dir
+        self.collection_name = collection_name
+        self.sinks = []
+        self.writers = []
+        try:
+            # every sink is built and checked before any writer thread
+            # starts; whatever was built is closed if one fails
+            for config in sinks:
+                sink = make_sink(config, base_dir, collection_name)
+                self.sinks.append(sink)
+                if any(other.name == sink.name for other in self.sinks[:-1]):
+                    raise ValueError("duplicate sink name: %s" % sink.name)
+
+            for config, sink in zip(sinks, self.sinks):
+                policy = config.get("overflow_policy", overflow_policy)
+                # passed even without the spill policy so a previous
+                # run's spill file is still replayed
+                spill_filename = None
+                if base_dir is not None and collection_name is not None:
+                    spill_filename = os.path.join(
+                        base_dir,
+                        collection_name,
+                        ".%s-%s.spill" % (collection_name, sink.name))
+                self.writers.append(QueuedWriter(
+                    sink,
+                    max_size=config.get("queue_size", writer_queue_size),
+                    overflow_policy=policy,
+                    spill_filename=spill_filename))
+        except Exception:
+            self.close_sinks()
+            raise
+
+        # pick up the ids seen by the last run, like RotatingFileListener
+        if base_dir is not None and collection_name is not None:
+            self.load_dedup(os.path.join(
+                base_dir,
+                collection_name,
+                "." + collection_name + ".dedup"))
+
+    def close_sinks(self):
+        """drain the writers' queues, then close the sinks."""
+        for writer in self.writers:
+            writer.close()
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception:
+                log.exception("exception closing sink %s", sink.name)
+
+    def shutdown(self):
+        """drain every sink's queue and close the sinks."""
+        self.close_sinks()
+        self.save_dedup()
+
+    def sink_stats(self):
+        """return {sink name: WriterStats} and update their rates.
+
+        The stats include the drops of the sink itself as sink_dropped.
+        """
+        stats = {}
+        for writer, sink in zip(self.writers, self.sinks):
+            writer.stats.calculate_rate()
+            writer.stats.sink_dropped = sink.dropped
+            stats[sink.name] = writer.stats
+        return stats
+
+    def print_status(self):
+        """Log the tweet rate and each sink's queue."""
+        super(FanoutListener, self).print_status()
+        for name, stats in sorted(self.sink_stats().items()):
+            log.info(
+                "sink %s: %.1f/s %s sink dropped: %d",
+                name,
+                stats.rate,
+                str(stats),
+                stats.sink_dropped)
+
+    def on_disconnect(self, notice=None):
+        """end the current output of every sink."""
+        retval = super(FanoutListener, self).on_disconnect(notice)
+        for writer in self.writers:
+            writer.end_file()
+        return retval
+
+    def on_status(self, status, raw_data):
+        """queue the status for every sink."""
+        for writer in self.writers:
+            writer.write(raw_data)
+        return super(FanoutListener, self).on_status(status, raw_data)
+
+
+#
+# unittests
+#
+#
+class GatedSink(Sink):
+
+    """Sink that blocks until its gate is opened."""
+
+    def __init__(self, name=None):
+        """construct the sink."""
+        super(GatedSink, self).__init__(name)
+        self.gate = threading.Event()
+        self.lines = []
+
+    def write(self, line, datetime_=None, timestamp=None):
+        """wait for the gate, then record the line."""
+        self.gate.wait()
+        self.lines.append(line)
+
+
+class FanoutListenerTest(unittest.TestCase):
+
+    """FanoutListener tests."""
+
+    def test_slow_sink_is_isolated(self):
+        """a stuck sink drops its own lines without stalling the others."""
+        listener = FanoutListener(
+            collection_name="test",
+            sinks=[
+                {"type": "null", "name": "fast"},
+                {"type": "null", "name": "slow", "queue_size": 2}])
+        slow = GatedSink("slow")
+        listener.writers[1].target = slow
+        listener.sinks[1] = slow
+
+        for i in range(100):
+            listener.on_status(None, '{"id": %d}' % i)
+        slow.gate.set()
+        listener.shutdown()
+
+        stats = listener.sink_stats()
+        self.assertEqual(listener.sinks[0].lines, 100)
+        self.assertEqual(stats["fast"].dropped, 0)
+        self.assertTrue(stats["slow"].dropped > 0)
+        self.assertEqual(len(slow.lines) + stats["slow"].dropped, 100)
+
+    def test_sink_drops_are_reported(self):
+        """lines a sink couldn't deliver show up in its stats."""
+        listener = FanoutListener(
+            collection_name="test",
+            sinks=[{
+                "type": "unix_socket",
+                "path": ".unittest-no-such-socket-%d" % os.getpid()}])
+        for i in range(10):
+            listener.on_status(None, '{"id": %d}' % i)
+        listener.shutdown()
+
+        stats = listener.sink_stats()["unix_socket"]
+        self.assertEqual(stats.dropped, 0)
+        self.assertEqual(stats.sink_dropped, 10)
+        self.assertEqual(stats.as_dict()["sink_dropped"], 10)
+
+    def test_dedup_survives_restart(self):
+        """ids seen before a restart are still dropped after it."""
+        import shutil
+
+        base_dir = ".unittest-fanout-%d" % os.getpid()
+        options = dict(
+            base_dir=base_dir,
+            collection_name="test",
+            sinks=[{"type": "null"}],
+            dedup_memory=1024)
+        try:
+            listener = FanoutListener(**options)
+            listener.handle_status({"id": 1}, '{"id": 1}')
+            listener.shutdown()
+
+            listener = FanoutListener(**options)
+            listener.handle_status({"id": 1}, '{"id": 1}')
+            listener.handle_status({"id": 2}, '{"id": 2}')
+            listener.shutdown()
+        finally:
+            shutil.rmtree(base_dir)
+
+        self.assertEqual(listener.stats.duplicates, 1)
+        self.assertEqual(listener.sinks[0].lines, 1)
+
+    def test_invalid_sinks(self):
+        """unknown types and duplicate names are rejected."""
+        self.assertRaises(
+            ValueError,
+            FanoutListener,
+            collection_name="test",
+            sinks=[{"type": "carrier_pigeon"}])
+        self.assertRaises(
+            ValueError,
+            FanoutListener,
+            collection_name="test",
+            sinks=[{"type": "null"}, {"type": "null"}])
+
+    def test_invalid_sink_closes_the_rest(self):
+        """a bad sink config leaves no writer threads running."""
+        import threading
+
+        before = threading.active_count()
+        self.assertRaises(
+            ValueError,
+            FanoutListener,
+            collection_name="test",
+            sinks=[
+                {"type": "null", "name": "a"},
+                {"type": "null", "name": "b", "overflow_policy": "shrug"}])
+        self.assertEqual(threading.active_count(), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,36 @@
 import os
 import logging
 
-from .base import BaseListener
-from rotating_out_file import RotatingOutFile
+from .base import BaseListener, CLASSIFY_PARSE
+from rotating_out_file import (
+    RotatingOutFile, FileFlusher, DURABILITY_NONE, DURABILITY_GROUP)
+from queued_writer import QueuedWriter, OVERFLOW_BLOCK
+from compression_pool import CompressionPool, JOURNAL_EXTENSION
+from utils.projection import Projection
+from status_tap import StatusTap, SLOW_SAMPLE
+from term_matcher import (
+    TermMatcher, MATCH_MODES, MATCH_ANNOTATE, ANNOTATION_KEY)
 
 
 log = logging.getLogger(__name__)
 
+# message types that can be written to their own streams
+STREAM_DELETES = "deletes"
+STREAM_LIMITS = "limits"
+STREAM_WARNINGS = "warnings"
+STREAM_DISCONNECTS = "disconnects"
+STREAM_EVENTS = "events"
+
+MESSAGE_STREAMS = (
+    STREAM_DELETES,
+    STREAM_LIMITS,
+    STREAM_WARNINGS,
+    STREAM_DISCONNECTS,
+    STREAM_EVENTS)
+
+# per-status match tags (see term_matcher)
+STREAM_MATCHES = "matches"
+
 
 class FileListener(BaseListener):
 
@@ -64,20 +88,302 @@ class RotatingFileListener(BaseListener):
             temporary_extension=".tmp",
             minute_interval=10,
             filename_timefmt="%Y%m%d_%H%M",
+            classify_mode=CLASSIFY_PARSE,
+            json_codec=None,
+            dedup_memory=None,
+            dedup_error_rate=0.001,
+            dedup_window=None,
+            projection=None,
+            buffer_size=0,
+            flush_interval=None,
+            compression=None,
+            compression_level=None,
+            index_interval=None,
+            max_bytes=None,
+            max_records=None,
+            partition_format=None,
+            durability=DURABILITY_NONE,
+            sync_interval=None,
+            sync_bytes=None,
+            background_compression=None,
+            background_compression_level=None,
+            compression_workers=1,
+            compression_niceness=10,
+            writer_queue_size=0,
+            overflow_policy=OVERFLOW_BLOCK,
+            recover_orphans=True,
+            streams=None,
+            tap_path=None,
+            tap_queue_size=1000,
+            tap_slow_policy=SLOW_SAMPLE,
+            match_mode=None,
             api=None):
-        """Construct rotating file listener."""
-        super(RotatingFileListener, self).__init__(api)
+        """Construct rotating file listener.
+
+        buffer_size and flush_interval control write batching in the
+        RotatingOutFile. Without a writer queue, buffering needs a
+        flush_interval, and a thread flushes that often so a quiet stream
+        doesn't hold lines in memory. compression and compression_level
+        turn on inline compression of the output files.
+        background_compression instead compresses each finished file in
+        up to compression_workers niced child processes. index_interval
+        writes a sparse id/time/offset index next to each file. max_bytes
+        and max_records rotate files early on size or line count.
+        partition_format (eg. "%Y/%m/%d") puts files in dated
+        subdirectories. durability ("none", "rotate" or "group"),
+        sync_interval (ms) and sync_bytes control when output is forced
+        to disk.
+
+        If writer_queue_size is > 0, statuses are queued and written by a
+        separate writer thread so disk stalls don't block the stream.
+        overflow_policy is what happens when that queue fills: "block",
+        "drop_oldest" or "spill" (to a file in the collection directory).
+
+        dedup_memory, dedup_error_rate and dedup_window turn on duplicate
+        dropping (see BaseListener). The filter is saved in the collection
+        directory on shutdown so restarts don't write duplicates either.
+
+        projection is a list of dotted field paths (eg. "user.screen_name").
+        If it's set only those fields are written, otherwise statuses are
+        written raw.
+
+        If recover_orphans is True, temporary files left by a previous
+        run that died are truncated to whole lines and finished first.
+
+        streams lists control message types ("deletes", "limits",
+        "warnings", "disconnects", "events") to keep. Each is written to
+        its own RotatingOutFile under collection/<stream>/ with its own
+        queue, so control messages never wait on status writes.
+
+        tap_path publishes every status on a local Unix socket for live
+        consumers (see status_tap). Subscribers more than tap_queue_size
+        messages behind are sampled or dropped per tap_slow_policy.
+        %(collection)s in tap_path is replaced with the collection name,
+        so each of several jobs gets its own socket.
+
+        match_mode tags each status with the track terms and boxes it
+        matched (see set_terms): "annotate" adds them to the status under
+        "_matched", "sidecar" writes {id, terms, boxes} lines to a
+        "matches" stream next to the statuses.
+        """
+        super(RotatingFileListener, self).__init__(
+            api,
+            classify_mode=classify_mode,
+            json_codec=json_codec,
+            dedup_memory=dedup_memory,
+            dedup_error_rate=dedup_error_rate,
+            dedup_window=dedup_window)
         self.base_dir = base_dir
         self.collection_name = collection_name
+        if match_mode is not None and match_mode not in MATCH_MODES:
+            raise ValueError("invalid match_mode: %s" % match_mode)
+        if (buffer_size > 0 and writer_queue_size <= 0 and
+                flush_interval is None):
+            raise ValueError(
+                "buffer_size needs flush_interval or writer_queue_size")
+        self.match_mode = match_mode
+        self.matcher = None
+        if match_mode is not None:
+            self.matcher = TermMatcher(json_codec=json_codec)
+        self.projection = None
+        if projection:
+            self.projection = Projection(projection, json_codec=json_codec)
+        file_options = dict(
+            extension=extension,
+            temporary_extension=temporary_extension,
+            minute_interval=minute_interval,
+            filename_timefmt=filename_timefmt,
+            buffer_size=buffer_size,
+            flush_interval=flush_interval,
+            compression=compression,
+            compression_level=compression_level,
+            index_interval=index_interval,
+            max_bytes=max_bytes,
+            max_records=max_records,
+            partition_format=partition_format,
+            durability=durability,
+            sync_interval=sync_interval,
+            sync_bytes=sync_bytes
+        )
         self.file = RotatingOutFile(
             base_dir=self.base_dir,
-            collection_name=self.collection_name
-        )
+            collection_name=self.collection_name,
+            **file_options)
+
+        # other message types, each in its own stream
+        self.stream_files = {}
+        for stream_name in streams or ():
+            if stream_name not in MESSAGE_STREAMS:
+                raise ValueError("invalid stream: %s" % stream_name)
+            self.stream_files[stream_name] = RotatingOutFile(
+                base_dir=self.base_dir,
+                collection_name=self.collection_name,
+                stream_name=stream_name,
+                **file_options)
+        if self.matcher is not None and match_mode != MATCH_ANNOTATE:
+            self.stream_files[STREAM_MATCHES] = RotatingOutFile(
+                base_dir=self.base_dir,
+                collection_name=self.collection_name,
+                stream_name=STREAM_MATCHES,
+                **file_options)
+        all_files = [self.file] + list(self.stream_files.values())
+
+        # compress finished files in the background
+        self.compression_pool = None
+        if background_compression is not None:
+            if compression is not None:
+                raise ValueError(
+                    "compression and background_compression are exclusive")
+            journal_filename = os.path.join(
+                self.base_dir,
+                self.collection_name,
+                "." + self.collection_name + JOURNAL_EXTENSION)
+            self.compression_pool = CompressionPool(
+                journal_filename,
+                compression=background_compression,
+                compression_level=background_compression_level,
+                max_workers=compression_workers,
+                niceness=compression_niceness)
+            for out_file in all_files:
+                out_file.finished_callback = self.compression_pool.submit
+
+        # finish anything a dead worker left behind
+        if recover_orphans:
+            for out_file in all_files:
+                out_file.recover_orphans()
+
+        # pick up the ids seen by the last run
+        self.load_dedup(os.path.join(
+            self.base_dir,
+            self.collection_name,
+            "." + self.collection_name + ".dedup"))
+
+        # writer is either the file itself or a queue in front of it
+        self.writer = self.make_writer(
+            self.file,
+            writer_queue_size,
+            overflow_policy)
+        self.stream_writers = {}
+        for stream_name, out_file in self.stream_files.items():
+            self.stream_writers[stream_name] = self.make_writer(
+                out_file,
+                writer_queue_size,
+                overflow_policy)
+
+        # direct writes only flush on write; flush quiet files on a timer
+        self.flusher = None
+        if writer_queue_size <= 0:
+            intervals = []
+            # (a flush_interval of 0 flushes on every write already)
+            if buffer_size > 0 and flush_interval:
+                intervals.append(flush_interval)
+            if durability == DURABILITY_GROUP and sync_interval:
+                intervals.append(sync_interval / 1000.0)
+            if intervals:
+                self.flusher = FileFlusher(all_files, min(intervals))
+
+        # live tap for local consumers
+        self.tap = None
+        if tap_path is not None:
+            self.tap = StatusTap(
+                tap_path % {"collection": collection_name},
+                max_queue=tap_queue_size,
+                slow_policy=tap_slow_policy)
+
+    def make_writer(self, out_file, writer_queue_size, overflow_policy):
+        """return the writer for a file, queued if writer_queue_size > 0."""
+        if writer_queue_size <= 0:
+            return out_file
+
+        spill_filename = os.path.join(
+            out_file.collection_dir,
+            "." + out_file.file_prefix + ".spill")
+        return QueuedWriter(
+            out_file,
+            max_size=writer_queue_size,
+            overflow_policy=overflow_policy,
+            spill_filename=spill_filename)
 
     def shutdown(self):
         """shutdown the listener."""
-        if self.file is not None:
-            self.file.end_file()
+        if self.tap is not None:
+            self.tap.close()
+        if self.flusher is not None:
+            self.flusher.close()
+        writers = [(self.writer, self.file)]
+        for stream_name, out_file in self.stream_files.items():
+            writers.append((self.stream_writers[stream_name], out_file))
+
+        for writer, out_file in writers:
+            if writer is not out_file:
+                writer.close()
+            if out_file is not None:
+                out_file.end_file()
+        if self.compression_pool is not None:
+            self.compression_pool.close()
+        self.save_dedup()
+
+    def writer_stats(self):
+        """return the queued writer stats, or None if writes are direct."""
+        if self.writer is self.file:
+            return None
+        return self.writer.stats
+
+    def tap_stats(self):
+        """return per-subscriber tap stats, or None without a tap."""
+        if self.tap is None:
+            return None
+        return self.tap.stats()
+
+    def set_terms(self, track=None, locations=None):
+        """set the terms and boxes statuses are tagged with."""
+        if self.matcher is not None:
+            self.matcher.update(track, locations)
+
+    def tag_status(self, status, raw_data):
+        """match a status, returning the status and raw data to write.
+
+        annotate mode tags a copy of status; the caller's dict may be
+        shared with other jobs' listeners.
+        """
+        if self.match_mode == MATCH_ANNOTATE:
+            raw_data, tags = self.matcher.annotate_raw(raw_data, status)
+            if status is not None:
+                status = dict(status)
+                status[ANNOTATION_KEY] = {
+                    "terms": tags["terms"],
+                    "boxes": tags["boxes"]}
+        else:
+            if status is None:
+                status = self.codec.loads(raw_data)
+            self.write_stream(
+                STREAM_MATCHES,
+                self.codec.dumps(self.matcher.tags(status)))
+        return status, raw_data
+
+    def print_status(self):
+        """Log the current tweet rate and writer backpressure."""
+        super(RotatingFileListener, self).print_status()
+        if self.matcher is not None:
+            log.info(
+                "matched %d, unmatched %d, top terms: %s",
+                self.matcher.matched,
+                self.matcher.unmatched,
+                ", ".join(
+                    "%s (%d)" % item for item in self.matcher.top_terms()))
+        writer_stats = self.writer_stats()
+        if writer_stats is not None:
+            log.info("writer queue: %s", str(writer_stats))
+        for stream_name, writer in self.stream_writers.items():
+            if writer is not self.stream_files[stream_name]:
+                log.info("%s queue: %s", stream_name, str(writer.stats))
+        for i, subscriber in enumerate(self.tap_stats() or ()):
+            log.info(
+                "tap subscriber %d: depth %d lag %.3fs dropped %d",
+                i,
+                subscriber["depth"],
+                subscriber["lag"],
+                subscriber["dropped"])
 
     def on_connect(self):
         """handle connect message."""
@@ -85,17 +391,61 @@ class RotatingFileListener(BaseListener):
         self.connected = True
         return retval
 
-    def on_disconnect(self):
+    def on_disconnect(self, notice=None):
         """handle disconnect message."""
-        retval = super(RotatingFileListener, self).on_disconnect()
+        retval = super(RotatingFileListener, self).on_disconnect(notice)
         self.disconnected = True
         log.info("RotatingFileListener - disconnect")
-        self.file.end_file()
+        if notice is not None:
+            self.write_stream(
+                STREAM_DISCONNECTS,
+                self.codec.dumps({"disconnect": notice}))
+        self.writer.end_file()
+        for writer in self.stream_writers.values():
+            writer.end_file()
         return retval
 
+    def write_stream(self, stream_name, raw_data):
+        """write a control message to its stream if it's kept."""
+        writer = self.stream_writers.get(stream_name)
+        if writer is not None:
+            writer.write(raw_data)
+
+    def on_delete(self, id, user_id, data, raw_data):
+        """handle delete message."""
+        self.write_stream(STREAM_DELETES, raw_data)
+        return super(RotatingFileListener, self).on_delete(
+            id, user_id, data, raw_data)
+
+    def on_limit(self, limit, data, raw_data):
+        """handle limit message."""
+        self.write_stream(STREAM_LIMITS, raw_data)
+        return super(RotatingFileListener, self).on_limit(
+            limit, data, raw_data)
+
+    def on_warning(self, warning, data, raw_data):
+        """handle warning message."""
+        self.write_stream(STREAM_WARNINGS, raw_data)
+        return super(RotatingFileListener, self).on_warning(
+            warning, data, raw_data)
+
+    def on_event(self, data, raw_data):
+        """handle event message."""
+        self.write_stream(STREAM_EVENTS, raw_data)
+        return super(RotatingFileListener, self).on_event(data, raw_data)
+
     def on_status(self, status, raw_data):
         """handle status message."""
         # print repr(status)
         # print "\n"*4
-        self.file.write(raw_data)
+        if self.matcher is not None:
+            status, raw_data = self.tag_status(status, raw_data)
+        if self.tap is not None:
+            self.tap.publish(raw_data)
+        if self.projection is None:
+            self.writer.write(raw_data)
+        elif status is None:
+            self.writer.write(self.projection.project_raw(raw_data))
+        else:
+            self.writer.write(self.projection.dumps(status))
         return super(RotatingFileListener, self).on_status(status, raw_data)
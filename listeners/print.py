@@ -2,7 +2,6 @@
 """Listeners for handling streaming events."""
 
 import logging
-import simplejson as json
 
 
 from base import BaseListener
@@ -27,6 +26,6 @@ class PrintingListener(BaseListener):
             self,
             status,
             raw_data)
-        print json.dumps(status)
+        print self.codec.dumps(status)
 
         return retval
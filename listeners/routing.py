@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""Listener that routes one stream's statuses to several jobs."""
+
+import logging
+import os
+import unittest
+
+from .base import BaseListener, CLASSIFY_PARSE
+from term_matcher import TermMatcher
+
+
+log = logging.getLogger(__name__)
+
+
+class RoutingListener(BaseListener):
+
+    """Pass each status to the job listeners whose terms it matched.
+
+    The stream tracks the union of every job's terms; one TermMatcher
+    over that union finds the terms and boxes a status matched, and the
+    status goes to every job that tracks one of them. Control messages
+    (deletes, limits, warnings, disconnects) go to every job.
+
+    Statuses that match no job's terms (Twitter also matches urls and
+    mentions the matcher doesn't see) are dropped and counted in
+    unrouted.
+    """
+
+    def __init__(
+            self,
+            api=None,
+            classify_mode=CLASSIFY_PARSE,
+            json_codec=None,
+            dedup_memory=None,
+            dedup_error_rate=0.001,
+            dedup_window=None):
+        """Construct the router without any routes.
+
+        Duplicates are filtered here, once for every job, rather than by
+        each job's listener.
+        """
+        super(RoutingListener, self).__init__(
+            api,
+            classify_mode=classify_mode,
+            json_codec=json_codec,
+            dedup_memory=dedup_memory,
+            dedup_error_rate=dedup_error_rate,
+            dedup_window=dedup_window)
+        self.matcher = TermMatcher(json_codec)
+        # job id -> listener, job id -> (track, boxes)
+        self.routes = {}
+        self.route_terms = {}
+        # term or box -> ids of the jobs tracking it
+        self.term_jobs = {}
+        self.box_jobs = {}
+        self.unrouted = 0
+
+    def add_route(self, job_id, listener, track=None, locations=None):
+        """route statuses matching track and locations to listener."""
+        if job_id in self.routes:
+            raise ValueError("duplicate route: %s" % job_id)
+        self.routes[job_id] = listener
+        self.set_route_terms(job_id, track, locations)
+        if self.connected:
+            listener.on_connect()
+
+    def set_route_terms(self, job_id, track=None, locations=None):
+        """change the terms and boxes routed to a job."""
+        locations = list(locations or ())
+        self.route_terms[job_id] = (
+            list(track or ()),
+            [tuple(locations[i:i + 4])
+             for i in range(0, len(locations) - 3, 4)])
+        self.relink()
+
+    def remove_route(self, job_id):
+        """stop routing to a job, returning its listener."""
+        listener = self.routes.pop(job_id)
+        del self.route_terms[job_id]
+        self.relink()
+        return listener
+
+    def relink(self):
+        """rebuild the union matcher and the term -> jobs maps."""
+        self.term_jobs = {}
+        self.box_jobs = {}
+        for job_id, (track, boxes) in self.route_terms.items():
+            for term in track:
+                self.term_jobs.setdefault(term, set()).add(job_id)
+            for box in boxes:
+                self.box_jobs.setdefault(box, set()).add(job_id)
+        self.matcher.update(
+            sorted(self.term_jobs),
+            [value for box in sorted(self.box_jobs) for value in box])
+
+    def jobs_for(self, status):
+        """return the ids of the jobs a status should go to."""
+        terms, boxes = self.matcher.match(status)
+        jobs = set()
+        for term in terms:
+            jobs |= self.term_jobs[term]
+        for i in boxes:
+            jobs |= self.box_jobs[self.matcher.boxes[i]]
+        return jobs
+
+    def shutdown(self):
+        """shut down every job's listener."""
+        for job_id, listener in sorted(self.routes.items()):
+            try:
+                listener.shutdown()
+            except Exception:
+                log.exception("exception shutting down job %s", job_id)
+
+    def print_status(self):
+        """Log the stream's rate, then each job's."""
+        super(RoutingListener, self).print_status()
+        log.info("unrouted statuses: %d", self.unrouted)
+        for job_id, listener in sorted(self.routes.items()):
+            log.info("job %s:", job_id)
+            listener.print_status()
+
+    def on_connect(self):
+        """handle connect message."""
+        retval = super(RoutingListener, self).on_connect()
+        for listener in self.routes.values():
+            listener.on_connect()
+        return retval
+
+    def on_disconnect(self, notice=None):
+        """end every job's current output."""
+        retval = super(RoutingListener, self).on_disconnect(notice)
+        for listener in self.routes.values():
+            listener.on_disconnect(notice)
+        return retval
+
+    def on_delete(self, id, user_id, data, raw_data):
+        """pass the delete to every job."""
+        for listener in self.routes.values():
+            listener.on_delete(id, user_id, data, raw_data)
+        return super(RoutingListener, self).on_delete(
+            id, user_id, data, raw_data)
+
+    def on_limit(self, limit, data, raw_data):
+        """pass the limit notice to every job."""
+        for listener in self.routes.values():
+            listener.on_limit(limit, data, raw_data)
+        return super(RoutingListener, self).on_limit(limit, data, raw_data)
+
+    def on_warning(self, warning, data, raw_data):
+        """pass the warning to every job."""
+        for listener in self.routes.values():
+            listener.on_warning(warning, data, raw_data)
+        return super(RoutingListener, self).on_warning(
+            warning, data, raw_data)
+
+    def on_event(self, data, raw_data):
+        """pass the event to every job."""
+        for listener in self.routes.values():
+            listener.on_event(data, raw_data)
+        return super(RoutingListener, self).on_event(data, raw_data)
+
+    def on_status(self, status, raw_data):
+        """pass the status to the jobs it matched."""
+        if status is None:
+            status = self.codec.loads(raw_data)
+        jobs = self.jobs_for(status)
+        if not jobs:
+            self.unrouted += 1
+        for job_id in jobs:
+            self.routes[job_id].on_status(status, raw_data)
+        return super(RoutingListener, self).on_status(status, raw_data)
+
+
+#
+# unittests
+#
+#
+class RecordingListener(BaseListener):
+
+    """Listener that keeps the raw data it was given."""
+
+    def __init__(self):
+        """construct the listener."""
+        super(RecordingListener, self).__init__()
+        self.statuses = []
+        self.parsed = []
+        self.deletes = []
+
+    def on_status(self, status, raw_data):
+        """record the status."""
+        self.statuses.append(raw_data)
+        self.parsed.append(status)
+        return super(RecordingListener, self).on_status(status, raw_data)
+
+    def on_delete(self, id, user_id, data, raw_data):
+        """record the delete."""
+        self.deletes.append(id)
+        return super(RecordingListener, self).on_delete(
+            id, user_id, data, raw_data)
+
+
+class RoutingListenerTest(unittest.TestCase):
+
+    """RoutingListener tests."""
+
+    def status(self, id_, text, coordinates=None):
+        """return the raw data of a status."""
+        return (
+            '{"created_at": "Mon Oct 05 12:00:00 +0000 2015", "id": %d, '
+            '"text": "%s", "in_reply_to_status_id": null, '
+            '"coordinates": %s}' % (
+                id_,
+                text,
+                "null" if coordinates is None else
+                '{"type": "Point", "coordinates": [%f, %f]}' % coordinates))
+
+    def make_router(self, **kwargs):
+        """return a connected router with two overlapping jobs."""
+        router = RoutingListener(**kwargs)
+        self.first = RecordingListener()
+        self.second = RecordingListener()
+        router.add_route(1, self.first, track=["python", "cats"])
+        router.add_route(
+            2,
+            self.second,
+            track=["python"],
+            locations=[-75.0, 40.0, -73.0, 41.0])
+        router.on_connect()
+        return router
+
+    def test_route(self):
+        """statuses go to each job whose terms or boxes they matched."""
+        router = self.make_router()
+        router.on_data(self.status(1, "python and cats"))
+        router.on_data(self.status(2, "just cats"))
+        router.on_data(self.status(3, "dogs", (-74.0, 40.7)))
+        router.on_data(self.status(4, "dogs"))
+
+        self.assertEqual(len(self.first.statuses), 2)
+        self.assertEqual(len(self.second.statuses), 2)
+        self.assertEqual(self.first.stats.total, 2)
+        self.assertEqual(router.stats.total, 4)
+        self.assertEqual(router.unrouted, 1)
+
+    def test_control_messages(self):
+        """deletes go to every job."""
+        router = self.make_router(classify_mode="sniff")
+        router.on_data(
+            '{"delete": {"status": {"id": 5, "user_id": 6}}}')
+        self.assertEqual(self.first.deletes, [5])
+        self.assertEqual(self.second.deletes, [5])
+
+    def test_change_routes(self):
+        """removing a job stops its statuses; terms can change."""
+        router = self.make_router()
+        router.remove_route(2)
+        router.set_route_terms(1, track=["dogs"])
+        router.on_data(self.status(1, "python"))
+        router.on_data(self.status(2, "dogs"))
+
+        self.assertEqual(len(self.first.statuses), 1)
+        self.assertEqual(self.second.statuses, [])
+        self.assertEqual(sorted(router.term_jobs), ["dogs"])
+        self.assertRaises(
+            ValueError, router.add_route, 1, RecordingListener())
+
+    def test_dedup(self):
+        """a status seen twice is routed once."""
+        router = self.make_router(dedup_memory=1024)
+        router.on_data(self.status(1, "python"))
+        router.on_data(self.status(1, "python"))
+        self.assertEqual(len(self.first.statuses), 1)
+        self.assertEqual(router.stats.duplicates, 1)
+
+    def test_annotate_does_not_leak(self):
+        """a job's annotation stays out of the status other jobs get."""
+        import glob
+        import json
+        import shutil
+        from .file import RotatingFileListener
+        from term_matcher import ANNOTATION_KEY
+
+        base_dir = ".unittest-routing-%d" % os.getpid()
+        router = RoutingListener()
+        annotating = RotatingFileListener(
+            base_dir=base_dir,
+            collection_name="test",
+            match_mode="annotate",
+            projection=["id", ANNOTATION_KEY])
+        annotating.set_terms(track=["python"])
+        recording = RecordingListener()
+        router.add_route(1, annotating, track=["python"])
+        router.add_route(2, recording, track=["python"])
+        try:
+            router.on_connect()
+            router.on_data(self.status(1, "python"))
+            router.shutdown()
+            lines = []
+            for filename in glob.glob(os.path.join(base_dir, "test", "*")):
+                with open(filename) as f:
+                    lines.extend(f.read().splitlines())
+        finally:
+            shutil.rmtree(base_dir)
+
+        self.assertEqual(len(recording.parsed), 1)
+        self.assertNotIn(ANNOTATION_KEY, recording.parsed[0])
+        self.assertEqual(
+            [json.loads(line)[ANNOTATION_KEY]["terms"] for line in lines],
+            [["python"]])
+
+
+if __name__ == '__main__':
+    unittest.main()
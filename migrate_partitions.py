@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Move a flat collection directory into a partitioned layout.
+
+usage: python migrate_partitions.py base_dir collection_name
+           [--partition-format %Y/%m/%d] [--dry-run]
+
+Only finished files (and their index sidecars) directly in the
+collection directory are moved. Stop the capture for the collection
+before running this.
+"""
+
+import os
+import argparse
+import logging
+
+from collection_reader import CollectionReader
+from capture_index import index_filename
+
+
+log = logging.getLogger("migrate_partitions")
+
+
+def migrate_collection(
+        base_dir,
+        collection_name,
+        partition_format="%Y/%m/%d",
+        extension=".json",
+        filename_timefmt="%Y%m%d_%H%M",
+        dry_run=False):
+    """move finished files into partition directories.
+
+    Returns the number of files moved.
+    """
+    reader = CollectionReader(
+        base_dir,
+        collection_name,
+        extension=extension,
+        filename_timefmt=filename_timefmt)
+    collection_dir = os.path.join(base_dir, collection_name)
+
+    made_dirs = set()
+    moved = 0
+    for name in sorted(os.listdir(collection_dir)):
+        path = os.path.join(collection_dir, name)
+        capture_file = reader.parse_filename(path)
+        if capture_file is None or not os.path.isfile(path):
+            continue
+
+        dest_dir = os.path.join(
+            collection_dir,
+            capture_file.start.strftime(partition_format))
+        dest = os.path.join(dest_dir, name)
+        if os.path.exists(dest):
+            log.warning("%s already exists, leaving %s", dest, path)
+            continue
+
+        log.info("%s -> %s", path, dest)
+        if dry_run:
+            continue
+
+        if dest_dir not in made_dirs:
+            if not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir)
+            made_dirs.add(dest_dir)
+
+        os.rename(path, dest)
+        if os.path.exists(index_filename(path)):
+            os.rename(index_filename(path), index_filename(dest))
+        moved += 1
+
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base_dir")
+    parser.add_argument("collection_name")
+    parser.add_argument("--partition-format", default="%Y/%m/%d")
+    parser.add_argument("--extension", default=".json")
+    parser.add_argument("--filename-timefmt", default="%Y%m%d_%H%M")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only log what would be moved")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s",
+        level=logging.INFO)
+
+    count = migrate_collection(
+        args.base_dir,
+        args.collection_name,
+        partition_format=args.partition_format,
+        extension=args.extension,
+        filename_timefmt=args.filename_timefmt,
+        dry_run=args.dry_run)
+    log.info("moved %d files", count)
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""Queued writer that moves output off the stream's read loop."""
+
+import os
+import logging
+import threading
+import unittest
+from collections import deque
+from datetime import datetime
+from time import time, mktime
+
+
+log = logging.getLogger(__name__)
+
+
+# what to do when the queue is full
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_SPILL = "spill"
+
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL)
+
+# marker queued in place of a line to end the target file in order
+_END_FILE = object()
+
+
+class WriterStats(object):
+
+    """Backpressure stats for a queued writer."""
+
+    def __init__(self):
+        """initialize the stats."""
+        self.depth = 0
+        self.max_depth = 0
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        # lines the target dropped itself (see sinks.Sink.dropped)
+        self.sink_dropped = 0
+        self.stall_time = 0.0
+        self.lag = 0.0
+        self.rate = 0.0
+        self.since = time()
+        self.since_written = 0
+
+    def calculate_rate(self):
+        """update the lines/sec written since the last call."""
+        now = time()
+        diff = now - self.since
+        if diff > 0:
+            self.rate = (self.written - self.since_written) / diff
+            self.since = now
+            self.since_written = self.written
+
+    def as_dict(self):
+        """return the stats as a dict (for logging and the pipe)."""
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "written": self.written,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "sink_dropped": self.sink_dropped,
+            "stall_time": self.stall_time,
+            "lag": self.lag,
+            "rate": self.rate
+        }
+
+    def __str__(self):
+        return (
+            "depth: %d (max %d) lag: %.3fs stalled: %.3fs "
+            "dropped: %d spilled: %d" % (
+                self.depth,
+                self.max_depth,
+                self.lag,
+                self.stall_time,
+                self.dropped,
+                self.spilled))
+
+
+class QueuedWriter(object):
+
+    """Feed a target's write() from a bounded queue on a writer thread.
+
+    The target is anything with write(line, datetime_, timestamp) and
+    end_file(), normally a RotatingOutFile. Lines keep the time they were
+    queued so rotation follows receive time rather than write time.
+
+    Spill files a previous run left behind are written to the target
+    before the writer thread starts.
+    """
+
+    def __init__(
+            self,
+            target,
+            max_size=10000,
+            overflow_policy=OVERFLOW_BLOCK,
+            spill_filename=None):
+        """construct the queued writer."""
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError("invalid overflow_policy: %s" % overflow_policy)
+        if overflow_policy == OVERFLOW_SPILL and spill_filename is None:
+            raise ValueError("spill policy needs a spill_filename")
+
+        self.target = target
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.spill_filename = spill_filename
+        self.stats = WriterStats()
+
+        self.queue = deque()
+        self.cond = threading.Condition(threading.Lock())
+        self.spilling = False
+        self.spill_file = None
+        self.stopping = False
+
+        self.recover_spill()
+
+        self.thread = threading.Thread(
+            target=self.run,
+            name="QueuedWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def depth(self):
+        """current number of queued items."""
+        return len(self.queue)
+
+    def write(self, line, datetime_=None):
+        """queue a line for writing.
+
+        Never blocks unless the overflow policy is block and the queue is
+        full.
+        """
+        received = time() if datetime_ is None else datetime_
+        self.cond.acquire()
+        try:
+            if self.spilling:
+                self.spill(line, received)
+                return
+
+            if len(self.queue) >= self.max_size:
+                if self.overflow_policy == OVERFLOW_BLOCK:
+                    stall_start = time()
+                    while (len(self.queue) >= self.max_size and
+                            not self.stopping):
+                        self.cond.wait(0.5)
+                    self.stats.stall_time += time() - stall_start
+                elif self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                    self.drop_oldest()
+                else:
+                    self.spilling = True
+                    self.spill(line, received)
+                    return
+
+            self.queue.append((line, received))
+            self.update_depth()
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def end_file(self):
+        """end the target file once everything queued so far is written."""
+        self.cond.acquire()
+        try:
+            if self.spilling:
+                self.spill(_END_FILE, None)
+                return
+
+            self.queue.append((_END_FILE, None))
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def close(self):
+        """write out everything queued and stop the writer thread."""
+        self.cond.acquire()
+        try:
+            self.stopping = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+        self.thread.join()
+
+    def update_depth(self):
+        """update depth stats. called with the lock held."""
+        depth = len(self.queue)
+        self.stats.depth = depth
+        if depth > self.stats.max_depth:
+            self.stats.max_depth = depth
+
+    def drop_oldest(self):
+        """drop the oldest queued line. lock must be held."""
+        for i, (line, _) in enumerate(self.queue):
+            if line is not _END_FILE:
+                del self.queue[i]
+                self.stats.dropped += 1
+                return
+
+    def spill(self, line, received):
+        """append an overflow line to the spill file. lock must be held."""
+        if self.spill_file is None:
+            self.spill_file = open(self.spill_filename, "a")
+
+        if line is _END_FILE:
+            self.spill_file.write("end\t\n")
+            return
+
+        if isinstance(received, datetime):
+            received = (
+                mktime(received.timetuple()) + received.microsecond / 1e6)
+        self.spill_file.write("%r\t%s\n" % (received, line))
+        self.stats.spilled += 1
+
+    def take_spill(self):
+        """hand the current spill file to the writer. lock must be held.
+
+        returns the name of the file to drain or None.
+        """
+        if self.spill_file is None:
+            self.spilling = False
+            return None
+
+        self.spill_file.close()
+        self.spill_file = None
+        drain_filename = self.spill_filename + ".drain"
+        os.rename(self.spill_filename, drain_filename)
+        return drain_filename
+
+    def recover_spill(self):
+        """replay spill files left by a run that died, oldest first.
+
+        A .drain file was being written out and the spill file was still
+        filling up when the process stopped.
+        """
+        if self.spill_filename is None:
+            return
+        for filename in (self.spill_filename + ".drain", self.spill_filename):
+            if os.path.exists(filename):
+                log.warning("replaying %s from a previous run", filename)
+                self.drain_spill(filename)
+
+    def drain_spill(self, drain_filename):
+        """write the contents of a spill file to the target."""
+        with open(drain_filename) as f:
+            for spilled in f:
+                if not spilled.endswith("\n") or "\t" not in spilled:
+                    log.warning(
+                        "dropping torn line at the end of %s",
+                        drain_filename)
+                    break
+                received, line = spilled.rstrip("\n").split("\t", 1)
+                if received == "end":
+                    self.target.end_file()
+                else:
+                    self.write_line(line, float(received))
+        os.remove(drain_filename)
+
+    def write_line(self, line, received):
+        """write one line to the target and update lag."""
+        if isinstance(received, datetime):
+            self.target.write(line, received)
+        else:
+            self.target.write(line, timestamp=received)
+            self.stats.lag = time() - received
+        self.stats.written += 1
+
+    def run(self):
+        """writer thread loop."""
+        while True:
+            drain_filename = None
+            line = None
+            idle = False
+
+            self.cond.acquire()
+            try:
+                if (not self.queue and not self.spilling and
+                        not self.stopping):
+                    self.cond.wait(0.5)
+
+                if self.queue:
+                    line, received = self.queue.popleft()
+                    self.update_depth()
+                    self.cond.notify_all()
+                elif self.spilling:
+                    drain_filename = self.take_spill()
+                elif self.stopping:
+                    # stopping and nothing left
+                    return
+                else:
+                    idle = True
+            finally:
+                self.cond.release()
+
+            try:
+                if drain_filename is not None:
+                    self.drain_spill(drain_filename)
+                elif line is _END_FILE:
+                    self.target.end_file()
+                elif line is not None:
+                    self.write_line(line, received)
+                elif idle and hasattr(self.target, "flush"):
+                    # nothing arrived for a while, push out buffered lines
+                    self.target.flush()
+            except Exception:
+                log.exception("QueuedWriter failed to write")
+
+
+#
+# unittests
+#
+#
+class ListTarget(object):
+
+    """Target that records what it's given."""
+
+    def __init__(self):
+        """construct the target."""
+        self.lines = []
+        self.ended = 0
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def write(self, line, datetime_=None, timestamp=None):
+        """record the line."""
+        self.gate.wait()
+        self.lines.append(line)
+
+    def end_file(self):
+        """record the end."""
+        self.ended += 1
+
+
+class QueuedWriterTest(unittest.TestCase):
+
+    """QueuedWriter tests."""
+
+    def setUp(self):
+        """set up the test."""
+        self.target = ListTarget()
+        self.spill_filename = ".unittest-spill-%d" % os.getpid()
+
+    def tearDown(self):
+        """remove spill leftovers."""
+        for fn in (self.spill_filename, self.spill_filename + ".drain"):
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def test_order(self):
+        """lines and end markers are written in order."""
+        writer = QueuedWriter(self.target, max_size=4)
+        for i in range(20):
+            writer.write(str(i))
+        writer.end_file()
+        writer.close()
+        self.assertEqual(self.target.lines, [str(i) for i in range(20)])
+        self.assertEqual(self.target.ended, 1)
+
+    def test_drop_oldest(self):
+        """drop_oldest keeps the newest lines and counts the drops."""
+        self.target.gate.clear()
+        writer = QueuedWriter(
+            self.target,
+            max_size=2,
+            overflow_policy=OVERFLOW_DROP_OLDEST)
+        for i in range(10):
+            writer.write(str(i))
+        self.target.gate.set()
+        writer.close()
+        self.assertEqual(self.target.lines[-2:], ["8", "9"])
+        self.assertEqual(
+            len(self.target.lines) + writer.stats.dropped,
+            10)
+
+    def test_spill(self):
+        """spilled lines come back in order."""
+        self.target.gate.clear()
+        writer = QueuedWriter(
+            self.target,
+            max_size=2,
+            overflow_policy=OVERFLOW_SPILL,
+            spill_filename=self.spill_filename)
+        for i in range(10):
+            writer.write(str(i))
+        self.target.gate.set()
+        writer.close()
+        self.assertEqual(self.target.lines, [str(i) for i in range(10)])
+        self.assertTrue(writer.stats.spilled > 0)
+        self.assertFalse(os.path.exists(self.spill_filename))
+
+    def test_restart_over_spill(self):
+        """spill files left by a crash are written first, drain first."""
+        with open(self.spill_filename + ".drain", "w") as f:
+            f.write("1.0\t0\nend\t\n2.0\t1\n")
+        with open(self.spill_filename, "w") as f:
+            f.write("3.0\t2\n4.0\t3")
+
+        writer = QueuedWriter(self.target, spill_filename=self.spill_filename)
+        writer.write("4")
+        writer.close()
+
+        self.assertEqual(self.target.lines, ["0", "1", "2", "4"])
+        self.assertEqual(self.target.ended, 1)
+        self.assertFalse(os.path.exists(self.spill_filename))
+        self.assertFalse(os.path.exists(self.spill_filename + ".drain"))
+
+
+if __name__ == '__main__':
+    unittest.main()
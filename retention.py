@@ -0,0 +1,565 @@
+#!/usr/bin/env python
+"""Disk quota and retention for the capture base_dir.
+
+UsageTracker keeps per-directory file sizes and only lists directories
+whose mtime changed since the last pass (plus re-stats the few files that
+are still being written), so a check costs one stat per directory rather
+than a walk of every file.
+
+RetentionManager checks usage against a global quota, per-collection
+quotas and the disk's free space, and once a scope goes over its high
+water mark it compresses and/or deletes that scope's oldest finished
+files until it's back under the low water mark.
+
+Only finished capture files inside a collection directory are ever
+touched: files with the output extension, compressed or not, that no
+compression journal still lists. Sockets, sink databases, state files
+and anything else under base_dir count towards usage but are left alone.
+"""
+
+import os
+import logging
+import threading
+import unittest
+from time import time
+
+from capture_index import index_filename
+from compression_pool import (
+    CompressionJournal, CompressionPool, JOURNAL_EXTENSION)
+from utils.compression import (
+    check_compression, compression_for_filename, EXTENSIONS)
+
+
+log = logging.getLogger(__name__)
+
+
+# what to do with the oldest files when over quota
+POLICY_DELETE = "delete"
+POLICY_COMPRESS = "compress"
+
+POLICIES = (POLICY_DELETE, POLICY_COMPRESS)
+
+# suffixes of files sqlite is still writing
+SQLITE_LOG_SUFFIXES = ("-wal", "-shm", "-journal")
+
+# rough compressed size of status json, as a fraction of the original.
+# queued files are counted as freed by this much; the next check sees
+# the real sizes
+COMPRESSED_FRACTION = 0.2
+
+
+class DirectoryEntry(object):
+
+    """What we know about one directory."""
+
+    def __init__(self):
+        """construct the entry."""
+        self.mtime = None
+        self.files = {}
+        self.subdirs = []
+
+
+class UsageTracker(object):
+
+    """Incremental disk usage of a directory tree."""
+
+    def __init__(
+            self,
+            base_dir,
+            extension=".json",
+            temporary_extension=".tmp",
+            full_rescan_every=60):
+        """construct the tracker.
+
+        extension is the capture files' extension, before any
+        compression extension. Every full_rescan_every updates
+        everything is listed again, in case an mtime change was missed.
+        """
+        self.base_dir = base_dir
+        self.finished_suffixes = (extension,) + tuple(
+            extension + suffix for suffix in EXTENSIONS.values())
+        self.temporary_extension = temporary_extension
+        self.full_rescan_every = full_rescan_every
+        self.dirs = {}
+        self.updates = 0
+        self.rescanned = 0
+
+    def is_growing(self, name):
+        """return True if a file may still change size in place."""
+        return (name.startswith(".") or
+                name.endswith(self.temporary_extension) or
+                name.endswith(SQLITE_LOG_SUFFIXES))
+
+    def is_evictable(self, name):
+        """return True if a file is finished capture data."""
+        return (not self.is_growing(name) and
+                name.endswith(self.finished_suffixes))
+
+    def is_journal(self, name):
+        """return True if a file is a compression journal."""
+        return name.startswith(".") and name.endswith(JOURNAL_EXTENSION)
+
+    def update(self):
+        """bring the usage up to date."""
+        full = (self.full_rescan_every and
+                self.updates % self.full_rescan_every == 0)
+        self.updates += 1
+        self.rescanned = 0
+
+        seen = set()
+        self.scan(self.base_dir, full, seen)
+        for path in list(self.dirs):
+            if path not in seen:
+                del self.dirs[path]
+
+    def scan(self, path, full, seen):
+        """update path and everything under it."""
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return
+        seen.add(path)
+
+        entry = self.dirs.get(path)
+        if entry is None:
+            entry = self.dirs[path] = DirectoryEntry()
+
+        if full or entry.mtime != mtime:
+            # something was added, removed or renamed; list it again
+            self.rescanned += 1
+            entry.mtime = mtime
+            entry.files = {}
+            entry.subdirs = []
+            try:
+                names = os.listdir(path)
+            except OSError:
+                names = []
+            for name in names:
+                file_path = os.path.join(path, name)
+                if os.path.isdir(file_path):
+                    entry.subdirs.append(name)
+                else:
+                    self.stat_file(entry, path, name)
+        else:
+            # only files still being written can have changed size
+            for name in entry.files:
+                if self.is_growing(name):
+                    self.stat_file(entry, path, name)
+
+        for name in entry.subdirs:
+            self.scan(os.path.join(path, name), full, seen)
+
+    def stat_file(self, entry, path, name):
+        """record a file's size and mtime."""
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            entry.files.pop(name, None)
+            return
+        entry.files[name] = (st.st_size, st.st_mtime)
+
+    def forget(self, file_path):
+        """drop a file we've removed."""
+        entry = self.dirs.get(os.path.dirname(file_path))
+        if entry is not None:
+            entry.files.pop(os.path.basename(file_path), None)
+
+    def collection_of(self, path):
+        """return the collection (top directory) path is in, or None."""
+        rel = os.path.relpath(path, self.base_dir)
+        if rel == os.curdir:
+            return None
+        return rel.split(os.sep, 1)[0]
+
+    def usage(self):
+        """return (total bytes, {collection: bytes})."""
+        total = 0
+        collections = {}
+        for path, entry in self.dirs.items():
+            size = sum(file_size for file_size, _ in entry.files.values())
+            total += size
+            collection = self.collection_of(path)
+            if collection is not None:
+                collections[collection] = (
+                    collections.get(collection, 0) + size)
+        return total, collections
+
+    def compressing(self):
+        """return the absolute paths every journal still lists."""
+        pending = set()
+        for path, entry in self.dirs.items():
+            for name in entry.files:
+                if self.is_journal(name):
+                    journal = CompressionJournal(os.path.join(path, name))
+                    try:
+                        names = journal.pending()
+                    except (IOError, OSError), e:
+                        log.error("can't read %s: %s", journal.filename, e)
+                        continue
+                    pending.update(os.path.abspath(n) for n in names)
+        return pending
+
+    def finished_files(self, collection=None):
+        """return [(mtime, path, size)] of finished files, oldest first.
+
+        Files waiting in a compression journal are left out, so the
+        compression pool and retention never work on the same file.
+        """
+        compressing = self.compressing()
+        files = []
+        for path, entry in self.dirs.items():
+            file_collection = self.collection_of(path)
+            if file_collection is None:
+                continue
+            if collection is not None and file_collection != collection:
+                continue
+            for name, (size, mtime) in entry.files.items():
+                file_path = os.path.join(path, name)
+                if (self.is_evictable(name) and
+                        os.path.abspath(file_path) not in compressing):
+                    files.append((mtime, file_path, size))
+        files.sort()
+        return files
+
+
+class RetentionManager(object):
+
+    """Keep base_dir under its quotas by compressing or evicting."""
+
+    def __init__(
+            self,
+            base_dir,
+            global_quota=None,
+            collection_quota=None,
+            collection_quotas=None,
+            min_free_bytes=None,
+            policy=POLICY_DELETE,
+            compression="gzip",
+            compression_workers=1,
+            compression_niceness=10,
+            high_water=0.95,
+            low_water=0.85,
+            extension=".json",
+            temporary_extension=".tmp",
+            notify=None):
+        """construct the manager.
+
+        Quotas are in bytes. collection_quota applies to every collection
+        not named in collection_quotas. min_free_bytes is the free space
+        to keep on base_dir's filesystem. With the compress policy, the
+        oldest uncompressed files are queued on a CompressionPool (with
+        compression_workers niced processes) first, and files are only
+        deleted if that isn't expected to be enough.
+
+        notify is called with (level, message) when a scope goes over its
+        high water mark and when space can't be freed. Telling the server
+        isn't done yet: the multiprocess client passes these to
+        ServerMessenger.putLogMessage, which is a stub until the server
+        has an endpoint for messages, so for now they're only logged.
+        """
+        if policy not in POLICIES:
+            raise ValueError("invalid policy: %s" % policy)
+        if policy == POLICY_COMPRESS:
+            check_compression(compression)
+        if not 0 < low_water <= high_water:
+            raise ValueError("invalid water marks: %s, %s" % (
+                low_water, high_water))
+
+        self.base_dir = base_dir
+        self.global_quota = global_quota
+        self.collection_quota = collection_quota
+        self.collection_quotas = collection_quotas or {}
+        self.min_free_bytes = min_free_bytes
+        self.policy = policy
+        self.compression = compression
+        self.high_water = high_water
+        self.low_water = low_water
+        self.notify = notify
+        self.tracker = UsageTracker(
+            base_dir,
+            extension=extension,
+            temporary_extension=temporary_extension)
+
+        # compress in niced child processes, not on the check thread
+        self.pool = None
+        if policy == POLICY_COMPRESS:
+            if not os.path.exists(base_dir):
+                os.makedirs(base_dir)
+            self.pool = CompressionPool(
+                os.path.join(base_dir, ".retention" + JOURNAL_EXTENSION),
+                compression=compression,
+                max_workers=compression_workers,
+                niceness=compression_niceness)
+
+        # scopes we've already warned about
+        self.warned = set()
+
+        self.deleted = 0
+        self.compressed = 0
+        self.freed = 0
+
+        self.thread = None
+        self.stopping = False
+
+    def quota_for(self, collection):
+        """return the quota for a collection or None."""
+        return self.collection_quotas.get(collection, self.collection_quota)
+
+    def free_bytes(self):
+        """return the free bytes on base_dir's filesystem."""
+        st = os.statvfs(self.base_dir)
+        return st.f_bavail * st.f_frsize
+
+    def check(self):
+        """update usage and enforce every quota once."""
+        self.tracker.update()
+        total, collections = self.tracker.usage()
+
+        for collection, used in sorted(collections.items()):
+            quota = self.quota_for(collection)
+            if quota:
+                self.enforce(collection, used, quota, collection)
+
+        if self.global_quota:
+            total, _ = self.tracker.usage()
+            self.enforce("global", total, self.global_quota)
+
+        if self.min_free_bytes:
+            free = self.free_bytes()
+            if free < self.min_free_bytes:
+                # pretend the disk's free space is the quota's headroom
+                total, _ = self.tracker.usage()
+                quota = total + free - self.min_free_bytes
+                self.enforce(
+                    "disk", total, max(quota, 1) / self.high_water)
+            elif "disk" in self.warned:
+                self.warned.discard("disk")
+                self.send(logging.INFO, "disk is back over min_free_bytes")
+
+    def enforce(self, scope, used, quota, collection=None):
+        """bring one scope under its low water mark if it's over high."""
+        if used <= quota * self.high_water:
+            if scope in self.warned:
+                self.warned.discard(scope)
+                self.send(logging.INFO, "%s is back under quota" % scope)
+            return
+
+        if scope not in self.warned:
+            self.warned.add(scope)
+            self.send(
+                logging.WARNING,
+                "%s is at %.0f%% of its %d byte quota, %s oldest files" % (
+                    scope,
+                    100.0 * used / quota,
+                    quota,
+                    "compressing" if self.policy == POLICY_COMPRESS
+                    else "deleting"))
+
+        target = quota * self.low_water
+        if self.policy == POLICY_COMPRESS:
+            used = self.evict(collection, used, target, compress=True)
+        if used > target:
+            used = self.evict(collection, used, target, compress=False)
+
+        if used > quota * self.high_water:
+            self.send(
+                logging.ERROR,
+                "%s can't be brought under quota (%d of %d bytes used)" % (
+                    scope,
+                    used,
+                    quota))
+
+    def evict(self, collection, used, target, compress):
+        """compress or delete oldest files until used <= target.
+
+        Returns the new usage, counting queued files as compressed.
+        """
+        for _, path, size in self.tracker.finished_files(collection):
+            if used <= target:
+                break
+
+            try:
+                if compress:
+                    if compression_for_filename(path) is not None:
+                        continue
+                    self.pool.submit(path)
+                    saved = int(size * (1 - COMPRESSED_FRACTION))
+                    self.compressed += 1
+                    log.info("queued %s for compression", path)
+                else:
+                    saved = size
+                    os.remove(path)
+                    if os.path.exists(index_filename(path)):
+                        saved += os.path.getsize(index_filename(path))
+                        os.remove(index_filename(path))
+                        self.tracker.forget(index_filename(path))
+                    self.deleted += 1
+                    log.info("deleted %s (%d bytes)", path, saved)
+            except (IOError, OSError), e:
+                log.error("can't free %s: %s", path, e)
+                continue
+
+            self.tracker.forget(path)
+            self.freed += saved
+            used -= saved
+
+        return used
+
+    def send(self, level, message):
+        """log a message and pass it to notify."""
+        log.log(level, message)
+        if self.notify is not None:
+            try:
+                self.notify(level, message)
+            except Exception:
+                log.exception("retention notify failed")
+
+    def start(self, interval=60.0):
+        """check every interval seconds on a background thread."""
+        self.stopping = False
+        self.thread = threading.Thread(
+            target=self.run,
+            args=(interval,),
+            name="RetentionManager")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """stop the background thread and the compression pool."""
+        self.stopping = True
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+        if self.pool is not None:
+            self.pool.close()
+
+    def run(self, interval):
+        """background thread loop."""
+        next_check = 0
+        while not self.stopping:
+            if time() >= next_check:
+                try:
+                    self.check()
+                except Exception:
+                    log.exception("retention check failed")
+                next_check = time() + interval
+            threading.Event().wait(0.5)
+
+
+#
+# unittests
+#
+#
+class RetentionTest(unittest.TestCase):
+
+    """Usage tracking and retention tests."""
+
+    def setUp(self):
+        """make a base_dir with two collections."""
+        self.base_dir = ".unittest-retention"
+        self.now = time()
+        for collection in ("a", "b"):
+            os.makedirs(os.path.join(self.base_dir, collection))
+        for i in range(5):
+            self.write("a", "a%d.json" % i, 1000, age=100 - i)
+        self.write("b", "b0.json", 500, age=200)
+        self.write("a", "a9.json.tmp", 300, age=0)
+
+    def tearDown(self):
+        """remove the base_dir."""
+        import shutil
+        shutil.rmtree(self.base_dir)
+
+    def write(self, collection, name, size, age):
+        """write a file of size bytes, age seconds old."""
+        path = os.path.join(self.base_dir, collection, name)
+        with open(path, "w") as f:
+            f.write('{"id": 1}\n' * (size // 10))
+        os.utime(path, (self.now - age, self.now - age))
+        return path
+
+    def test_incremental_usage(self):
+        """only changed directories are listed again."""
+        tracker = UsageTracker(self.base_dir)
+        tracker.update()
+        self.assertEqual(tracker.usage(), (5800, {"a": 5300, "b": 500}))
+
+        tracker.update()
+        self.assertEqual(tracker.rescanned, 0)
+
+        # the open file grows without a directory change
+        with open(os.path.join(self.base_dir, "a", "a9.json.tmp"), "a") as f:
+            f.write("x" * 100)
+        tracker.update()
+        self.assertEqual(tracker.rescanned, 0)
+        self.assertEqual(tracker.usage()[1]["a"], 5400)
+
+    def test_delete_oldest(self):
+        """the oldest finished files go first, open files stay."""
+        manager = RetentionManager(
+            self.base_dir,
+            collection_quota=4000,
+            high_water=1.0,
+            low_water=0.8)
+        manager.check()
+
+        remaining = sorted(os.listdir(os.path.join(self.base_dir, "a")))
+        self.assertEqual(remaining, ["a3.json", "a4.json", "a9.json.tmp"])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.base_dir, "b", "b0.json")))
+        self.assertEqual(manager.deleted, 3)
+
+    def test_only_capture_files(self):
+        """other files and files waiting for compression are kept."""
+        kept = [
+            self.write("a", "tap.sock", 100, age=500),
+            self.write("a", "sink.db", 100, age=500),
+            self.write("a", "sink.db-wal", 100, age=500),
+            self.write("a", "notes.txt", 100, age=500),
+            self.write("a", "a0.json", 1000, age=500),
+        ]
+        with open(os.path.join(self.base_dir, "stray.json"), "w") as f:
+            f.write("{}\n")
+        kept.append(os.path.join(self.base_dir, "stray.json"))
+        journal = CompressionJournal(
+            os.path.join(self.base_dir, "a", ".a" + JOURNAL_EXTENSION))
+        journal.record("add", os.path.join(self.base_dir, "a", "a0.json"))
+
+        manager = RetentionManager(
+            self.base_dir,
+            collection_quota=1,
+            global_quota=1)
+        manager.check()
+
+        for path in kept:
+            self.assertTrue(os.path.exists(path), path)
+        self.assertEqual(manager.deleted, 5)
+
+    def test_compress_and_notify(self):
+        """compress runs before delete and notify hears about it."""
+        messages = []
+        manager = RetentionManager(
+            self.base_dir,
+            global_quota=5000,
+            policy=POLICY_COMPRESS,
+            high_water=1.0,
+            low_water=0.9,
+            notify=lambda level, message: messages.append(level))
+        manager.check()
+
+        # compression happens in the pool
+        compressed = os.path.join(self.base_dir, "b", "b0.json.gz")
+        for _ in range(100):
+            if os.path.exists(compressed):
+                break
+            threading.Event().wait(0.1)
+        manager.stop()
+
+        self.assertTrue(os.path.exists(compressed))
+        self.assertEqual(manager.compressed, 3)
+        self.assertEqual(manager.deleted, 0)
+        self.assertEqual(messages, [logging.WARNING])
+
+
+if __name__ == '__main__':
+    unittest.main()
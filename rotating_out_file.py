@@ -2,9 +2,144 @@
 """Rotating outfile class used to store files."""
 
 import os
-from datetime import datetime
+import re
+import logging
+from datetime import datetime, timedelta
+from time import time, mktime
 import unittest
 import threading
+from multiprocessing.dummy import Pool as ThreadPool
+
+from utils.compression import (
+    check_compression, compression_extension, open_compressed)
+from utils.sniff import status_id
+from capture_index import IndexWriter, index_filename, trim_index
+
+
+# no-clobber suffix at the end of a filename (before the extension)
+SUFFIX_REGEX = re.compile(r"^(.*)_(\d\d)$")
+
+# bytes read at a time when looking for a torn last line
+TAIL_CHUNK_SIZE = 64 * 1024
+
+# when data is forced to disk
+DURABILITY_NONE = "none"
+DURABILITY_ROTATE = "rotate"
+DURABILITY_GROUP = "group"
+
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_ROTATE, DURABILITY_GROUP)
+
+# joins the collection and stream names in a stream's filenames
+STREAM_SEPARATOR = "-"
+
+
+log = logging.getLogger(__name__)
+
+
+def stream_path(base_dir, collection_name, stream_name=None):
+    """return (directory, filename prefix) for a collection's stream.
+
+    The main stream lives in base_dir/collection/collection*; a named
+    stream in base_dir/collection/stream/collection-stream*, so its
+    files never parse as the main stream's.
+    """
+    if stream_name is None:
+        return (os.path.join(base_dir, collection_name), collection_name)
+    return (
+        os.path.join(base_dir, collection_name, stream_name),
+        collection_name + STREAM_SEPARATOR + stream_name)
+
+
+def split_suffix(time_str, filename_timefmt):
+    """split a _NN no-clobber suffix off the time part of a filename.
+
+    Returns (time string, suffix or None). Trailing _NN only counts as a
+    suffix when time_str isn't a whole timestamp itself and what's left
+    is, so a format ending in _%H keeps its hour.
+    """
+    m = SUFFIX_REGEX.match(time_str)
+    if m is None:
+        return time_str, None
+    try:
+        datetime.strptime(time_str, filename_timefmt)
+        return time_str, None
+    except ValueError:
+        pass
+    try:
+        datetime.strptime(m.group(1), filename_timefmt)
+    except ValueError:
+        return time_str, None
+    return m.group(1), int(m.group(2))
+
+
+def sync_directory(path):
+    """fsync a directory so renames in it are durable."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # not supported for directories everywhere
+        pass
+    finally:
+        os.close(fd)
+
+
+def round_datetime(datetime_, minute_interval):
+    """round datetime_ down to the start of its minute_interval."""
+    minute = datetime_.minute // minute_interval
+    minute *= minute_interval
+    return datetime_.replace(minute=minute, second=0, microsecond=0)
+
+
+def rotation_window(timestamp, minute_interval):
+    """return (start datetime, start, end) of the window for timestamp.
+
+    start and end are epoch seconds, [start, end). Windows restart at the
+    top of each hour, so an interval that doesn't divide 60 gets a short
+    last window.
+    """
+    start = round_datetime(datetime.fromtimestamp(timestamp), minute_interval)
+    end = start + timedelta(minutes=minute_interval)
+    next_hour = (start.replace(minute=0) + timedelta(hours=1))
+    end = min(end, next_hour)
+
+    window_start = mktime(start.timetuple())
+    window_end = mktime(end.timetuple())
+    if window_end <= timestamp:
+        # dst transitions, keep moving
+        window_end = timestamp + 1
+
+    return start, window_start, window_end
+
+
+def truncate_partial_line(filename):
+    """cut a file back to the end of its last complete line.
+
+    Returns the number of bytes removed.
+    """
+    with open(filename, "r+b") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+
+        # walk backwards until we find a newline
+        end = 0
+        pos = size
+        while pos > 0:
+            step = min(TAIL_CHUNK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            newline = f.read(step).rfind(b"\n")
+            if newline >= 0:
+                end = pos + newline + 1
+                break
+
+        if end < size:
+            f.truncate(end)
+
+    return size - end
 
 
 
@@ -24,18 +159,117 @@ class RotatingOutFile(object):
             extension=".json",
             temporary_extension=".tmp",
             minute_interval=10,
-            filename_timefmt="%Y%m%d_%H%M"):
-        """construct rotating out file."""
+            filename_timefmt="%Y%m%d_%H%M",
+            buffer_size=0,
+            flush_interval=None,
+            compression=None,
+            compression_level=None,
+            index_interval=None,
+            max_bytes=None,
+            max_records=None,
+            partition_format=None,
+            durability=DURABILITY_NONE,
+            sync_interval=None,
+            sync_bytes=None,
+            fdatasync=True,
+            stream_name=None):
+        """construct rotating out file.
+
+        If buffer_size is > 0, lines are collected in memory and written
+        in one call once buffer_size bytes are pending, once
+        flush_interval seconds have passed since the last flush, or when
+        the file rotates. Those are only checked on write, so something
+        has to call flush() while the stream is quiet: a QueuedWriter
+        does when it's idle, otherwise use a FileFlusher.
+
+        compression is one of gzip, bz2, lzma or zstd. Files are
+        compressed as they're written and get the matching extension
+        after extension (eg. .json.gz).
+
+        If index_interval is set, every index_interval-th status also
+        gets an entry (id, receive time, byte offset) in a sidecar index
+        next to the file. Offsets are into the uncompressed data.
+
+        max_bytes and max_records also rotate the file once it holds that
+        many (uncompressed) bytes or lines. Extra files in the same time
+        window get the usual _NN suffix.
+
+        partition_format puts files in dated subdirectories of the
+        collection directory, eg. "%Y/%m/%d" for collection/YYYY/MM/DD/.
+
+        durability controls when data is forced to disk. "none" leaves it
+        to the os. "rotate" syncs each file (and its directory) when it's
+        finished. "group" also syncs the open file once sync_interval
+        milliseconds have passed or sync_bytes have been written since
+        the last sync, so one sync covers every line in between. fdatasync
+        is used instead of fsync where the os has it.
+
+        stream_name writes a separate stream of the collection (eg.
+        "deletes") in its own subdirectory, see stream_path.
+        """
 
-        self.extension = extension
+        check_compression(compression)
+        if durability not in DURABILITY_MODES:
+            raise ValueError("invalid durability: %s" % durability)
+        if (durability == DURABILITY_GROUP and
+                not sync_interval and not sync_bytes):
+            raise ValueError(
+                "group durability needs sync_interval or sync_bytes")
+
+        self.compression = compression
+        self.compression_level = compression_level
+        self.extension = extension + compression_extension(compression)
         self.temporary_extension = temporary_extension
         self.base_dir = None    # gets officially set in set_collection
         self.collection_name = None
+        self.stream_name = stream_name
         self.cur_name = None
         self.minute_interval = minute_interval
         self.filename_timefmt = filename_timefmt
         self.file = None
 
+        # position in the current file, tracked without stat calls
+        self.bytes_written = 0
+        self.lines_written = 0
+
+        self.index_interval = index_interval
+        self.index = None
+
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+
+        # directories we know exist, so we don't check them again
+        self.partition_format = partition_format
+        self.made_dirs = set()
+
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.last_flush = time()
+
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.sync_bytes = sync_bytes
+        if fdatasync and hasattr(os, "fdatasync"):
+            self.fsync = os.fdatasync
+        else:
+            self.fsync = os.fsync
+        self.synced_bytes = 0
+        self.last_sync = time()
+        self.sync_count = 0
+
+        # called with the final filename whenever a file is finished
+        self.finished_callback = None
+
+        # current rotation window as epoch seconds [start, end)
+        self.window_start = 0
+        self.window_end = 0
+        self.window_datetime = None
+
+        # next no-clobber suffix for a file in this window (-1 is none)
+        self.window_suffix = -1
+
         self.rlock = threading.RLock()
 
         self.set_collection(base_dir=base_dir, collection_name=collection_name)
@@ -47,9 +281,25 @@ class RotatingOutFile(object):
         self.rlock.acquire()
 
         try:
-            path = os.path.join(self.base_dir, self.collection_name)
+            path = self.collection_dir
             if not os.path.exists(path):
                 os.makedirs(path)
+            self.made_dirs.add(path)
+        finally:
+            self.rlock.release()
+
+
+    def make_dir(self, path):
+        """make a partition directory once."""
+        if path in self.made_dirs:
+            return
+
+        self.rlock.acquire()
+
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.made_dirs.add(path)
         finally:
             self.rlock.release()
 
@@ -65,8 +315,22 @@ class RotatingOutFile(object):
             # update our filename
             self.cur_name = filename
 
+            # partition directories are made as they're needed
+            if self.partition_format is not None:
+                self.make_dir(os.path.dirname(filename))
+
             # open the file
-            self.file = open(self.cur_name, "w+")
+            self.file = open_compressed(
+                self.cur_name,
+                self.compression,
+                self.compression_level)
+            self.bytes_written = 0
+            self.lines_written = 0
+            self.synced_bytes = 0
+            self.last_sync = time()
+
+            if self.index_interval:
+                self.index = IndexWriter(self.get_index_filename(filename))
 
         finally:
             # release the lock
@@ -81,10 +345,18 @@ class RotatingOutFile(object):
 
         try:
             if self.file is not None:
-                self.file.close()
+                self.write_buffer()
+                if self.durability == DURABILITY_NONE:
+                    self.file.close()
+                else:
+                    self.close_synced()
 
             self.file = None
 
+            if self.index is not None:
+                self.index.close()
+            self.index = None
+
 
         finally:
             # release the lock
@@ -105,42 +377,206 @@ class RotatingOutFile(object):
             # close the file
             self.close_file()
 
-            # check to see if we need to rename it
-            finished_filename = self.cur_name
+            if self.cur_name is not None:
+                finished_filename = self.finish_file(self.cur_name)
+                renamed = finished_filename != self.cur_name
 
-            if finished_filename is not None:
-                # strip off the temporary extension
-                if (self.temporary_extension and
-                        finished_filename.endswith(self.temporary_extension)):
-                    temp_ext_length = len(self.temporary_extension)
-                    finished_filename = finished_filename[:-temp_ext_length]
+                # the file is finished, don't end it again
+                self.cur_name = None
 
-                # check if the file already exists (os.rename can clobber)
-                if os.path.exists(finished_filename):
-                    # split into path and extension
+                if renamed and self.finished_callback is not None:
+                    self.finished_callback(finished_filename)
+
+        finally:
+            # release the lock
+            self.rlock.release()
+
+
+    def finish_file(self, temp_filename):
+        """Rename a closed temporary file (and its index) to a free name.
+
+        Returns the finished filename, or temp_filename if every suffix
+        is taken and the file was left where it is.
+        """
+
+        # acquire the lock
+        self.rlock.acquire()
+
+        try:
+            # strip off the temporary extension
+            finished_filename = self.strip_temporary_extension(temp_filename)
+
+            # check if the file already exists (os.rename can clobber)
+            # (only happens across restarts, normally the window's
+            # suffix counter already gave this file a free name)
+            if os.path.exists(finished_filename):
+                # split into path and extension (which may have
+                # more than one dot, eg. .json.gz)
+                if finished_filename.endswith(self.extension):
+                    base_path = (
+                        finished_filename[:-len(self.extension)],
+                        self.extension)
+                else:
                     base_path = os.path.splitext(finished_filename)
 
-                    for suffix_id in range(100):
-                        # format the base path
-                        base_name = base_path[0] + "_%02d" % (suffix_id)
-                        # add suffix back
-                        finished_filename = base_name + base_path[1]
-                        # if the filename doesn't exist, break
-                        if not os.path.exists(finished_filename):
-                            break
-
-                # rename the file if necessary
-                if self.cur_name != finished_filename:
-                    # attempt not to clobber in case we failed to find a
-                    # valid name
+                # carry on from a suffix we added, if there is one
+                first_suffix = 0
+                name = os.path.basename(base_path[0])
+                if name.startswith(self.file_prefix):
+                    suffix = split_suffix(
+                        name[len(self.file_prefix):],
+                        self.filename_timefmt)[1]
+                    if suffix is not None:
+                        base_path = (base_path[0][:-3], base_path[1])
+                        first_suffix = suffix + 1
+
+                free_suffix = None
+                for suffix_id in range(first_suffix, 100):
+                    # format the base path
+                    base_name = base_path[0] + "_%02d" % (suffix_id)
+                    # add suffix back
+                    finished_filename = base_name + base_path[1]
+                    # if the filename doesn't exist, break
                     if not os.path.exists(finished_filename):
-                        #print "\nEND FILENAME: ", finished_filename
-                        os.rename(self.cur_name, finished_filename)
+                        free_suffix = suffix_id
+                        break
+
+                if free_suffix is None:
+                    log.error(
+                        "no free name for %s, leaving it", temp_filename)
+                    return temp_filename
+
+                # don't hand out that suffix again in this window
+                self.window_suffix = max(
+                    self.window_suffix,
+                    free_suffix + 1)
+
+            # rename the file if necessary
+            if temp_filename != finished_filename:
+                # attempt not to clobber in case we failed to find a
+                # valid name
+                if not os.path.exists(finished_filename):
+                    #print "\nEND FILENAME: ", finished_filename
+                    os.rename(temp_filename, finished_filename)
+
+                    # the index follows the data file's name
+                    index_name = self.get_index_filename(temp_filename)
+                    if os.path.exists(index_name):
+                        os.rename(
+                            index_name,
+                            index_filename(finished_filename))
+
+                    if self.durability != DURABILITY_NONE:
+                        sync_directory(os.path.dirname(finished_filename))
 
         finally:
             # release the lock
             self.rlock.release()
 
+        return finished_filename
+
+
+    def find_orphans(self):
+        """return temporary data files in the collection not in use.
+
+        One directory walk, no per-file stat calls. Files of other streams
+        in the collection are left alone.
+        """
+        orphans = []
+        index_suffix = index_filename("") + self.temporary_extension
+        for dirpath, dirnames, filenames in os.walk(self.collection_dir):
+            for filename in filenames:
+                if (not filename.endswith(self.temporary_extension) or
+                        filename.endswith(index_suffix) or
+                        filename.startswith(".") or
+                        not self.is_own_filename(filename)):
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                if full_path != self.cur_name:
+                    orphans.append(full_path)
+        return orphans
+
+
+    def is_own_filename(self, filename):
+        """return True if filename (no directory) is one of our files."""
+        name = self.strip_temporary_extension(filename)
+        if (not name.startswith(self.file_prefix) or
+                not name.endswith(self.extension)):
+            return False
+
+        time_str = split_suffix(
+            name[len(self.file_prefix):-len(self.extension)],
+            self.filename_timefmt)[0]
+        try:
+            datetime.strptime(time_str, self.filename_timefmt)
+        except ValueError:
+            return False
+        return True
+
+
+    def recover_file(self, temp_filename):
+        """truncate a torn last line and finish an orphaned file.
+
+        Returns (finished filename, bytes truncated).
+        """
+        truncated = 0
+        if self.compression is None:
+            truncated = truncate_partial_line(temp_filename)
+
+            index_name = self.get_index_filename(temp_filename)
+            if os.path.exists(index_name):
+                trim_index(index_name, os.path.getsize(temp_filename))
+        else:
+            log.warning(
+                "%s is compressed, its last record may be torn",
+                temp_filename)
+
+        finished_filename = self.finish_file(temp_filename)
+        if (finished_filename != temp_filename and
+                self.finished_callback is not None):
+            self.finished_callback(finished_filename)
+        return finished_filename, truncated
+
+
+    def recover_orphans(self, workers=8):
+        """finish temporary files left behind by a process that died.
+
+        Files are recovered in parallel; only picking the final name is
+        serialized. Returns the list of finished filenames.
+        """
+        orphans = self.find_orphans()
+        if not orphans:
+            return []
+
+        pool = ThreadPool(min(workers, len(orphans)))
+        try:
+            results = pool.map(self.recover_file, orphans)
+        finally:
+            pool.close()
+            pool.join()
+
+        for temp_filename, (finished_filename, truncated) in zip(
+                orphans, results):
+            log.info(
+                "recovered %s -> %s (truncated %d bytes)",
+                temp_filename,
+                finished_filename,
+                truncated)
+        return [finished_filename for finished_filename, _ in results]
+
+
+    def strip_temporary_extension(self, filename):
+        """return filename without the temporary extension."""
+        if (self.temporary_extension and
+                filename.endswith(self.temporary_extension)):
+            return filename[:-len(self.temporary_extension)]
+        return filename
+
+
+    def get_index_filename(self, filename):
+        """return the temporary index filename for a temporary file."""
+        return (index_filename(self.strip_temporary_extension(filename)) +
+                self.temporary_extension)
 
 
     def set_collection(self, base_dir=None, collection_name=None):
@@ -183,25 +619,74 @@ class RotatingOutFile(object):
 
         try:
             # update the base_filename
-            self.base_filename = os.path.join(
+            self.collection_dir, self.file_prefix = stream_path(
                 self.base_dir,
                 self.collection_name,
-                self.collection_name
+                self.stream_name)
+            self.base_filename = os.path.join(
+                self.collection_dir,
+                self.file_prefix
             )
 
             # make our initial path
             self.make_path()
+
+            # force the next write to recompute its window
+            self.window_end = 0
         finally:
             # release the rlock
             self.rlock.release()
 
 
-    def get_filename(self, datetime_, temp=False):
+    def round_datetime(self, datetime_):
+        """round datetime_ down to the start of its minute_interval."""
+        return round_datetime(datetime_, self.minute_interval)
+
+
+    def start_window(self, timestamp):
+        """end the current file and compute the window for timestamp.
+
+        Windows restart at the top of each hour, so an interval that
+        doesn't divide 60 gets a short last window like get_filename
+        always has.
+        """
+
+        # acquire the lock
+        self.rlock.acquire()
+
+        try:
+            # if the old file is a valid name, "end" it
+            if self.cur_name is not None:
+                self.end_file()
+
+            (self.window_datetime,
+             self.window_start,
+             self.window_end) = rotation_window(
+                timestamp,
+                self.minute_interval)
+            self.window_suffix = -1
+        finally:
+            # release the rlock
+            self.rlock.release()
+
+
+    def next_filename(self):
+        """return the temporary name for the next file in this window."""
+        suffix = self.window_suffix
+        self.window_suffix += 1
+        return self.get_filename(
+            self.window_datetime,
+            True,
+            suffix if suffix >= 0 else None)
+
+
+    def get_filename(self, datetime_, temp=False, suffix=None):
         """get the current filename.
 
         calculates and returns a new filename based on current time
         it rounds the minute to minute_interval, so 12:12 with a
-        10-minute interval, will be 12:10
+        10-minute interval, will be 12:10. suffix adds a _NN no-clobber
+        suffix.
         """
 
         name = None
@@ -210,15 +695,17 @@ class RotatingOutFile(object):
         self.rlock.acquire()
 
         try:
-            # round the da
-            base_time = datetime_.time()
-            minute = (base_time.minute / self.minute_interval)
-            minute *= self.minute_interval
-            rounded_time = base_time.replace(minute=minute)
-            rounded_datetime = datetime.combine(datetime_.date(), rounded_time)
-
+            rounded_datetime = self.round_datetime(datetime_)
             time_str = rounded_datetime.strftime(self.filename_timefmt)
-            name = self.base_filename + time_str + self.extension
+            if suffix is not None:
+                time_str += "_%02d" % (suffix)
+            base_filename = self.base_filename
+            if self.partition_format is not None:
+                base_filename = os.path.join(
+                    self.collection_dir,
+                    rounded_datetime.strftime(self.partition_format),
+                    self.file_prefix)
+            name = base_filename + time_str + self.extension
             if temp is True:
                 name += self.temporary_extension
         finally:
@@ -229,41 +716,210 @@ class RotatingOutFile(object):
 
 
 
-    def write(self, line, datetime_=None):
-        """write the specified line to the file.
+    def write_buffer(self):
+        """write buffered lines to the file and flush it to the os."""
 
-        If datetime_ is None, then it uses datetime.now
-        """
+        # acquire the lock
+        self.rlock.acquire()
+
+        try:
+            if self.buffer and self.file is not None:
+                self.file.write("".join(self.buffer))
+                self.file.flush()
+
+            self.buffer = []
+            self.buffered_bytes = 0
+            self.last_flush = time()
+
+        finally:
+            # release the lock
+            self.rlock.release()
+
+
+    def flush(self):
+        """write out any buffered lines (and sync if one is due)."""
 
         # acquire the lock
         self.rlock.acquire()
 
         try:
-            # adjust datetime_ to be now, if it's None
-            if datetime_ is None:
-                datetime_ = datetime.now()
+            self.write_buffer()
+            self.check_sync()
 
-            # test if the filenames have changed
-            fn = self.get_filename(datetime_, True)
-            if fn != self.cur_name:
+        finally:
+            # release the lock
+            self.rlock.release()
 
-                # if the old file is a valid name, "end" it
-                if self.cur_name is not None:
-                    self.end_file()
 
-                self.start_file(fn)
+    def sync(self):
+        """write out buffered lines and force the file to disk."""
+
+        # acquire the lock
+        self.rlock.acquire()
+
+        try:
+            if self.file is not None:
+                self.write_buffer()
+                self.file.flush()
+                self.fsync(self.file.fileno())
+                self.sync_count += 1
+
+            self.synced_bytes = self.bytes_written
+            self.last_sync = time()
+
+        finally:
+            # release the lock
+            self.rlock.release()
+
+
+    def check_sync(self):
+        """sync if group durability is due. lock must be held.
+
+        Called after writes and when the writer is idle, so lines never
+        wait much longer than sync_interval to reach the disk.
+        """
+        if self.durability != DURABILITY_GROUP or self.file is None:
+            return
+
+        pending = self.bytes_written - self.synced_bytes
+        if not pending:
+            return
+
+        if ((self.sync_bytes and pending >= self.sync_bytes) or
+                (self.sync_interval and
+                 (time() - self.last_sync) * 1000 >= self.sync_interval)):
+            self.sync()
+
+
+    def close_synced(self):
+        """close the file after forcing all of it to disk."""
+        if self.compression is None:
+            self.file.flush()
+            self.fsync(self.file.fileno())
+            self.file.close()
+        else:
+            # the compressed stream's trailer has to be synced too
+            self.file.close(sync=self.fsync)
+        self.sync_count += 1
+
+
+    def index_lines(self, lines, timestamp):
+        """add index entries for lines about to be written."""
+        offset = self.bytes_written
+        count = self.lines_written
+        for line in lines:
+            if count % self.index_interval == 0:
+                line_id = status_id(line)
+                if line_id is not None:
+                    self.index.add(line_id, timestamp, offset)
+            offset += len(line) + 1
+            count += 1
+
+
+    def write(self, line, datetime_=None, timestamp=None):
+        """write the specified line to the file.
+
+        If datetime_ is None, then it uses timestamp (epoch seconds) or
+        the current time.
+        """
+
+        self.write_lines((line,), datetime_, timestamp)
+
+
+    def write_lines(self, lines, datetime_=None, timestamp=None):
+        """write a list of lines to the file.
+
+        All of the lines go to the file for datetime_. If datetime_ is
+        None, then it uses timestamp (epoch seconds) or the current time.
+        """
+
+        if not lines:
+            return
+
+        # acquire the lock
+        self.rlock.acquire()
+
+        try:
+            # work out the time as epoch seconds
+            if datetime_ is not None:
+                timestamp = (mktime(datetime_.timetuple()) +
+                             datetime_.microsecond / 1e6)
+            elif timestamp is None:
+                timestamp = time()
+
+            # only rebuild the filename when the window rolls over
+            if not self.window_start <= timestamp < self.window_end:
+                self.start_window(timestamp)
 
             if self.file is None:
-                self.start_file(fn)
+                self.start_file(self.next_filename())
+
+            # index every index_interval-th line
+            if self.index is not None:
+                self.index_lines(lines, timestamp)
 
             # write the data
-            self.file.write(line + "\n")
+            data = "\n".join(lines) + "\n"
+            self.bytes_written += len(data)
+            self.lines_written += len(lines)
+            if self.buffer_size <= 0:
+                self.file.write(data)
+            else:
+                self.buffer.append(data)
+                self.buffered_bytes += len(data)
+
+                if self.buffered_bytes >= self.buffer_size:
+                    self.write_buffer()
+                elif (self.flush_interval is not None and
+                        time() - self.last_flush >= self.flush_interval):
+                    self.write_buffer()
+
+            # group commit, one sync for everything since the last
+            self.check_sync()
+
+            # rotate early on size or count
+            if ((self.max_bytes and self.bytes_written >= self.max_bytes) or
+                    (self.max_records and
+                     self.lines_written >= self.max_records)):
+                self.end_file()
 
         finally:
             # release the rlock
             self.rlock.release()
 
 
+class FileFlusher(object):
+
+    """Flush RotatingOutFiles every interval seconds on a thread.
+
+    For files written directly rather than through a QueuedWriter, so
+    buffered lines (and group syncs) don't wait for the next write.
+    """
+
+    def __init__(self, files, interval):
+        """construct the flusher and start its thread."""
+        self.files = list(files)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="FileFlusher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """flush every file each interval until closed."""
+        while not self.stopped.wait(self.interval):
+            for out_file in self.files:
+                try:
+                    out_file.flush()
+                except Exception:
+                    log.exception("failed to flush %s", out_file.cur_name)
+
+    def close(self):
+        """stop the flusher thread."""
+        self.stopped.set()
+        self.thread.join()
+
+
 #
 # unittests
 #
@@ -481,5 +1137,435 @@ class NoClobberTest(RotatingTestCaseBase):
                 os.path.getsize(filename_3), 4))
 
 
+    def test_hour_format(self):
+        """a format ending in _%H keeps its hour when a suffix is added."""
+        out = RotatingOutFile(
+            base_dir=self.base_dir,
+            collection_name=self.collection,
+            minute_interval=60,
+            filename_timefmt="%Y%m%d_%H")
+        base = self.filename + "19971030_12"
+        open(base + self.ext, "w").close()
+
+        out.write("a", datetime_=self.dt)
+        out.end_file()
+
+        self.assertTrue(os.path.exists(base + "_00" + self.ext))
+        self.assertFalse(
+            os.path.exists(self.filename + "19971030_13" + self.ext))
+        self.assertTrue(out.is_own_filename("test19971030_12_00.json"))
+
+
+class BufferedWriteTest(RotatingTestCaseBase):
+
+    """Buffered and batched write tests."""
+
+    def setUp(self):
+        """set up a buffered file."""
+        super(BufferedWriteTest, self).setUp()
+        self.file.buffer_size = 16
+
+    def test_buffer_until_size(self):
+        """lines stay in memory until buffer_size bytes are pending."""
+        self.file.write("abc", datetime_=self.dt)
+        tmp_filename = self.file.get_filename(self.dt, True)
+        self.assertEqual(os.path.getsize(tmp_filename), 0)
+
+        self.file.write("0123456789abcdef", datetime_=self.dt)
+        self.assertEqual(os.path.getsize(tmp_filename), 21)
+        self.assertEqual(self.file.buffered_bytes, 0)
+
+    def test_flush_on_rotate(self):
+        """ending the file writes out the buffer."""
+        self.file.write_lines(["a", "b", "c"], datetime_=self.dt)
+        self.file.end_file()
+
+        with open(self.file.get_filename(self.dt)) as f:
+            self.assertEqual(f.read(), "a\nb\nc\n")
+
+    def test_flush_on_interval(self):
+        """buffered lines are written once flush_interval has passed."""
+        self.file.flush_interval = 0
+        self.file.write("a", datetime_=self.dt)
+        tmp_filename = self.file.get_filename(self.dt, True)
+        self.assertEqual(os.path.getsize(tmp_filename), 2)
+
+    def test_flusher(self):
+        """a FileFlusher writes out buffered lines with no more writes."""
+        import time as time_module
+
+        self.file.flush_interval = 0.05
+        self.file.write("a", datetime_=self.dt)
+        tmp_filename = self.file.get_filename(self.dt, True)
+        self.assertEqual(os.path.getsize(tmp_filename), 0)
+
+        flusher = FileFlusher([self.file], 0.05)
+        try:
+            deadline = time() + 5
+            while os.path.getsize(tmp_filename) == 0 and time() < deadline:
+                time_module.sleep(0.01)
+        finally:
+            flusher.close()
+        self.assertEqual(os.path.getsize(tmp_filename), 2)
+
+
+class WindowTest(RotatingTestCaseBase):
+
+    """Rotation window tests."""
+
+    def test_window_bounds(self):
+        """the window covers the rounded interval."""
+        self.file.write("a", datetime_=self.dt)
+        start = datetime.fromtimestamp(self.file.window_start)
+        end = datetime.fromtimestamp(self.file.window_end)
+        self.assertEqual(start, datetime(1997, 10, 30, 12, 30))
+        self.assertEqual(end, datetime(1997, 10, 30, 12, 40))
+
+    def test_uneven_interval(self):
+        """windows stop at the top of the hour."""
+        self.file.minute_interval = 7
+        self.file.write("a", datetime_=datetime(1997, 10, 30, 12, 58))
+        end = datetime.fromtimestamp(self.file.window_end)
+        self.assertEqual(end, datetime(1997, 10, 30, 13, 0))
+        self.assertEqual(
+            self.file.window_datetime,
+            datetime(1997, 10, 30, 12, 56))
+
+    def test_rotate_on_window_change(self):
+        """crossing the window end finishes the old file."""
+        self.file.write("a", datetime_=self.dt)
+        self.file.write("b", datetime_=datetime(1997, 10, 30, 12, 39, 59))
+        self.file.write("c", datetime_=datetime(1997, 10, 30, 12, 40))
+        self.file.end_file()
+
+        first = self.file.get_filename(self.dt)
+        second = self.file.get_filename(datetime(1997, 10, 30, 12, 40))
+        with open(first) as f:
+            self.assertEqual(f.read(), "a\nb\n")
+        with open(second) as f:
+            self.assertEqual(f.read(), "c\n")
+
+    def test_timestamp(self):
+        """epoch timestamps pick the same file as datetimes."""
+        self.file.write("a", timestamp=mktime(self.dt.timetuple()))
+        self.file.end_file()
+        self.assertTrue(os.path.exists(self.file.get_filename(self.dt)))
+
+
+class CompressionTest(RotatingTestCaseBase):
+
+    """Compressed output tests."""
+
+    def setUp(self):
+        """set up a gzip file."""
+        super(CompressionTest, self).setUp()
+        self.file = RotatingOutFile(
+            base_dir=self.base_dir,
+            collection_name=self.collection,
+            extension=self.ext,
+            temporary_extension=self.tmp_ext,
+            minute_interval=10,
+            compression="gzip")
+
+    def test_extension(self):
+        """finished files get the compression extension."""
+        self.file.write("abc", datetime_=self.dt)
+        self.file.end_file()
+
+        filename = self.filename + self.dt_string + self.ext + ".gz"
+        self.assertTrue(os.path.exists(filename))
+
+        import gzip
+        with gzip.open(filename) as f:
+            self.assertEqual(f.read(), "abc\n")
+
+    def test_no_clobber_suffix(self):
+        """clobber suffixes go before the whole extension."""
+        self.file.write("a", datetime_=self.dt)
+        self.file.end_file()
+        self.file.write("b", datetime_=self.dt)
+        self.file.end_file()
+
+        filename = self.filename + self.dt_string + "_00" + self.ext + ".gz"
+        self.assertTrue(os.path.exists(filename))
+
+    def test_unknown_compression(self):
+        """unknown compressions are rejected up front."""
+        self.assertRaises(
+            ValueError,
+            RotatingOutFile,
+            base_dir=self.base_dir,
+            collection_name=self.collection,
+            compression="rar")
+
+
+class IndexSidecarTest(RotatingTestCaseBase):
+
+    """Index sidecar tests."""
+
+    def test_index_offsets(self):
+        """index entries point at the start of their lines."""
+        from capture_index import CaptureIndex
+
+        self.file.index_interval = 2
+        lines = ['{"created_at":"x","id":%d}' % (100 + i) for i in range(5)]
+        for line in lines:
+            self.file.write(line, datetime_=self.dt)
+        self.file.end_file()
+
+        filename = self.file.get_filename(self.dt)
+        index = CaptureIndex(index_filename(filename))
+        self.assertEqual(index.ids, [100, 102, 104])
+
+        with open(filename) as f:
+            for status_id_, offset in zip(index.ids, index.offsets):
+                f.seek(offset)
+                self.assertEqual(status_id(f.readline()), status_id_)
+
+
+class SizeRotationTest(RotatingTestCaseBase):
+
+    """Size and count rotation tests."""
+
+    def finished_files(self):
+        """return the finished files in the collection, sorted."""
+        path = os.path.join(self.base_dir, self.collection)
+        return sorted(
+            fn for fn in os.listdir(path) if fn.endswith(self.ext))
+
+    def test_max_records(self):
+        """files rotate every max_records lines within a window."""
+        self.file.max_records = 2
+        for i in range(5):
+            self.file.write(str(i), datetime_=self.dt)
+        self.file.end_file()
+
+        base = self.collection + self.dt_string
+        self.assertEqual(self.finished_files(), [
+            base + self.ext,
+            base + "_00" + self.ext,
+            base + "_01" + self.ext])
+
+    def test_max_bytes(self):
+        """files rotate once max_bytes have been written."""
+        self.file.max_bytes = 10
+        self.file.write("0123456789", datetime_=self.dt)
+        self.file.write("a", datetime_=self.dt)
+        self.file.end_file()
+
+        base = self.filename + self.dt_string
+        self.assertEqual(os.path.getsize(base + self.ext), 11)
+        self.assertEqual(os.path.getsize(base + "_00" + self.ext), 2)
+
+    def test_new_window_resets_suffix(self):
+        """the suffix counter starts over in the next window."""
+        self.file.max_records = 1
+        self.file.write("a", datetime_=self.dt)
+        self.file.write("b", datetime_=self.dt)
+        self.file.write("c", datetime_=datetime(1997, 10, 30, 12, 41))
+
+        self.assertTrue(os.path.exists(
+            self.file.get_filename(datetime(1997, 10, 30, 12, 41))))
+
+
+class RecoveryTest(RotatingTestCaseBase):
+
+    """Orphaned temporary file recovery tests."""
+
+    def test_recover_torn_file(self):
+        """orphans are cut back to whole lines and finished."""
+        temp_filename = self.file.get_filename(self.dt, True)
+        with open(temp_filename, "w") as f:
+            f.write('{"a": 1}\n{"a": 2}\n{"a"')
+
+        finished = self.file.recover_orphans()
+
+        filename = self.file.get_filename(self.dt)
+        self.assertEqual(finished, [filename])
+        self.assertFalse(os.path.exists(temp_filename))
+        with open(filename) as f:
+            self.assertEqual(f.read(), '{"a": 1}\n{"a": 2}\n')
+
+    def test_recover_does_not_clobber(self):
+        """orphans get a suffix if their window already has a file."""
+        self.file.write("a", datetime_=self.dt)
+        self.file.end_file()
+
+        temp_filename = self.file.get_filename(self.dt, True)
+        with open(temp_filename, "w") as f:
+            f.write("b\n")
+        self.file.recover_orphans()
+
+        base = self.filename + self.dt_string
+        self.assertEqual(os.path.getsize(base + self.ext), 2)
+        self.assertEqual(os.path.getsize(base + "_00" + self.ext), 2)
+
+    def test_no_free_name(self):
+        """with every suffix taken the temporary file is left alone."""
+        base = self.filename + self.dt_string
+        existing = [base + self.ext] + [
+            base + "_%02d" % i + self.ext for i in range(100)]
+        for filename in existing:
+            with open(filename, "w") as f:
+                f.write("old\n")
+
+        finished = []
+        self.file.finished_callback = finished.append
+        self.file.write("new", datetime_=self.dt)
+        temp_filename = self.file.cur_name
+        self.file.end_file()
+
+        self.assertEqual(finished, [])
+        self.assertTrue(os.path.exists(temp_filename))
+        for filename in existing:
+            self.assertEqual(os.path.getsize(filename), 4)
+
+    def test_no_suffix_after_99(self):
+        """an orphan already at _99 is left alone if that name is taken."""
+        base = self.filename + self.dt_string
+        with open(base + "_99" + self.ext, "w") as f:
+            f.write("old\n")
+        temp_filename = base + "_99" + self.ext + self.tmp_ext
+        with open(temp_filename, "w") as f:
+            f.write("new\n")
+
+        self.assertEqual(
+            self.file.recover_orphans(), [temp_filename])
+        self.assertTrue(os.path.exists(temp_filename))
+
+    def test_open_file_is_skipped(self):
+        """the file being written isn't an orphan."""
+        self.file.write("a", datetime_=self.dt)
+        self.assertEqual(self.file.find_orphans(), [])
+
+
+class PartitionTest(RotatingTestCaseBase):
+
+    """Partitioned directory tests."""
+
+    def setUp(self):
+        """set up a partitioned file."""
+        super(PartitionTest, self).setUp()
+        self.file.partition_format = "%Y/%m/%d"
+
+    def test_partition_path(self):
+        """files land in dated directories."""
+        self.file.write("a", datetime_=self.dt)
+        self.file.end_file()
+
+        filename = os.path.join(
+            self.base_dir,
+            self.collection,
+            "1997", "10", "30",
+            self.collection + self.dt_string + self.ext)
+        self.assertEqual(self.file.get_filename(self.dt), filename)
+        self.assertTrue(os.path.exists(filename))
+        self.assertTrue(os.path.dirname(filename) in self.file.made_dirs)
+
+    def test_recover_partitioned(self):
+        """orphans in partition directories are found."""
+        self.file.write("a", datetime_=self.dt)
+        orphan = self.file.cur_name
+        self.file.close_file()
+        self.file.cur_name = None
+
+        self.assertEqual(self.file.find_orphans(), [orphan])
+
+
+class DurabilityTest(RotatingTestCaseBase):
+
+    """Durability mode tests."""
+
+    def test_invalid_mode(self):
+        """unknown modes and group without a threshold are rejected."""
+        self.assertRaises(
+            ValueError,
+            RotatingOutFile,
+            base_dir=self.base_dir,
+            collection_name=self.collection,
+            durability="always")
+        self.assertRaises(
+            ValueError,
+            RotatingOutFile,
+            base_dir=self.base_dir,
+            collection_name=self.collection,
+            durability=DURABILITY_GROUP)
+
+    def test_rotate(self):
+        """rotate syncs once per finished file."""
+        self.file.durability = DURABILITY_ROTATE
+        self.file.write("a", datetime_=self.dt)
+        self.file.write("b", datetime_=self.dt)
+        self.assertEqual(self.file.sync_count, 0)
+        self.file.end_file()
+        self.assertEqual(self.file.sync_count, 1)
+
+    def test_group_bytes(self):
+        """group syncs once sync_bytes are pending, covering the buffer."""
+        self.file.durability = DURABILITY_GROUP
+        self.file.sync_bytes = 4
+        self.file.buffer_size = 1024
+        self.file.write("a", datetime_=self.dt)
+        self.assertEqual(self.file.sync_count, 0)
+        self.file.write("b", datetime_=self.dt)
+        self.assertEqual(self.file.sync_count, 1)
+        self.assertEqual(self.file.buffer, [])
+
+        with open(self.file.cur_name) as f:
+            self.assertEqual(f.read(), "a\nb\n")
+
+    def test_group_compressed(self):
+        """compressed files can be synced and closed synced."""
+        self.file.compression = "gzip"
+        self.file.extension = self.ext + ".gz"
+        self.file.durability = DURABILITY_GROUP
+        self.file.sync_bytes = 1
+        self.file.write("a", datetime_=self.dt)
+        self.file.end_file()
+        self.assertEqual(self.file.sync_count, 2)
+
+
+class StreamTest(RotatingTestCaseBase):
+
+    """Named stream tests."""
+
+    def setUp(self):
+        """set up a second stream in the same collection."""
+        super(StreamTest, self).setUp()
+        self.stream = RotatingOutFile(
+            base_dir=self.base_dir,
+            collection_name=self.collection,
+            extension=self.ext,
+            temporary_extension=self.tmp_ext,
+            minute_interval=10,
+            stream_name="deletes")
+
+    def test_stream_path(self):
+        """stream files go in their own directory with their own prefix."""
+        self.assertEqual(
+            self.stream.get_filename(self.dt),
+            os.path.join(
+                self.base_dir,
+                self.collection,
+                "deletes",
+                self.collection + "-deletes" + self.dt_string + self.ext))
+
+    def test_orphans_stay_in_stream(self):
+        """each stream only recovers its own files."""
+        self.file.write("a", datetime_=self.dt)
+        self.stream.write("b", datetime_=self.dt)
+        self.assertEqual(self.file.find_orphans(), [])
+        self.assertEqual(self.stream.find_orphans(), [])
+
+        main_orphan = self.file.cur_name
+        stream_orphan = self.stream.cur_name
+        for out in (self.file, self.stream):
+            out.close_file()
+            out.cur_name = None
+
+        self.assertEqual(self.file.find_orphans(), [main_orphan])
+        self.assertEqual(self.stream.find_orphans(), [stream_orphan])
+
+
 if __name__ == '__main__':
     unittest.main()
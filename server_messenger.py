@@ -188,20 +188,24 @@ class ServerMessenger(object):
     # this isn't the best way to do this
     # this is hardcoded :\
     @cached_function_ttl(timedelta(seconds=3))
-    def getStatus(self):
-        """get current job status."""
+    def getStatus(self, job_id=None):
+        """get a job's status (the active job's by default)."""
 
-        if self.active_job_id is None:
+        if job_id is None:
+            job_id = self.active_job_id
+        if job_id is None:
             return None
 
-        endpoint = "jobs/%d/" % (self.active_job_id)
+        endpoint = "jobs/%d/" % (job_id)
         return self.doSimpleJSONGet(endpoint)
 
 
-    def putStatus(self, status_obj):
+    def putStatus(self, status_obj, job_id=None):
         """update the status."""
 
-        endpoint = "jobs/%d/" % (self.active_job_id)
+        if job_id is None:
+            job_id = self.active_job_id
+        endpoint = "jobs/%d/" % (job_id)
         resp = self.doPut(endpoint=endpoint, data=status_obj)
 
         if resp is not None:
@@ -220,17 +224,17 @@ class ServerMessenger(object):
 
 
 
-    def updateStatus(self, status):
+    def updateStatus(self, status, job_id=None):
         """update the status."""
 
-        status_msg = self.getStatus()
+        status_msg = self.getStatus(job_id)
         if status_msg is not None:
             if "status" in status_msg:
                 old_status = status_msg["status"]
 
                 if old_status != status:
                     status_msg["status"] = status
-                    self.putStatus(status_msg)
+                    self.putStatus(status_msg, job_id)
                 else:
                     log.warn("attempt to update status and its already set")
             else:
@@ -272,8 +276,10 @@ class ServerMessenger(object):
         return resp
 
 
-    def pingServer(self, total_tweets, rate):
+    def pingServer(self, total_tweets, rate, job_id=None):
         """ping the server."""
+        if job_id is None:
+            job_id = self.active_job_id
         decimal_rate = Decimal(rate).quantize(
             Decimal('0.001'),
             rounding=ROUND_DOWN)
@@ -282,7 +288,7 @@ class ServerMessenger(object):
             "rate": decimal_rate
         }
 
-        endpoint = "jobs/%d/" % (self.active_job_id)
+        endpoint = "jobs/%d/" % (job_id)
         resp = self.doPatch(endpoint=endpoint, data=update_msg)
 
         if resp is not None:
@@ -301,8 +307,14 @@ class ServerMessenger(object):
         return resp
 
 
-    def putLogMessage(self, message):
-        """put log message on server."""
+    def putLogMessage(self, message, level=logging.INFO, job_id=None):
+        """put log message on server.
+
+        The server has no endpoint for log messages yet, so this does
+        nothing; callers log the message locally as well. Until it does,
+        retention quota warnings (see clients.multiprocess.on_retention)
+        never reach the server.
+        """
         pass
 
 
@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+"""Split a job's terms and geo boxes across several stream connections.
+
+Twitter caps a filter connection at 400 track terms and 25 location
+boxes, and allows one standing connection per set of credentials.
+ShardPlanner assigns terms and boxes to shards, one per credential set.
+Replanning after the terms change leaves every surviving term where it
+was, so only the shards that actually gained or lost something have to
+reconnect.
+
+ShardedStream runs the shards as StreamConnections on one StreamEngine,
+all feeding the same listener, so a collection still gets a single
+output; the listener's id filter drops statuses that matched on more
+than one shard. Each shard keeps its own connected and error state (see
+ShardListener), so one shard's errors only make that shard back off.
+"""
+
+import logging
+import unittest
+
+from stream_engine import StreamEngine, StreamConnection, STREAM_VERSION
+
+
+log = logging.getLogger(__name__)
+
+
+# per-connection limits of the filter endpoint
+MAX_TERMS = 400
+MAX_LOCATIONS = 25
+
+
+class Shard(object):
+
+    """The terms and boxes one connection filters on."""
+
+    def __init__(self, credential, terms=None, locations=None):
+        """construct the shard.
+
+        credential is the index of the credential set it connects with;
+        locations is a list of (west, south, east, north) boxes.
+        """
+        self.credential = credential
+        self.terms = list(terms or [])
+        self.locations = list(locations or [])
+
+    def __len__(self):
+        return len(self.terms) + len(self.locations)
+
+    def __eq__(self, other):
+        return (isinstance(other, Shard) and
+                self.credential == other.credential and
+                set(self.terms) == set(other.terms) and
+                set(self.locations) == set(other.locations))
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __repr__(self):
+        return "Shard(%d, %d terms, %d locations)" % (
+            self.credential,
+            len(self.terms),
+            len(self.locations))
+
+    def filter_args(self):
+        """return the shard's filter() keyword arguments."""
+        args = {}
+        if self.terms:
+            args["track"] = list(self.terms)
+        if self.locations:
+            args["locations"] = [
+                value for box in self.locations for value in box]
+        return args
+
+
+class ShardPlan(object):
+
+    """The result of planning: shards plus anything that didn't fit."""
+
+    def __init__(self, shards, dropped_terms, dropped_locations):
+        """construct the plan."""
+        self.shards = shards
+        self.dropped_terms = dropped_terms
+        self.dropped_locations = dropped_locations
+
+    def changed(self, previous):
+        """return the credentials whose shard differs from previous."""
+        before = dict((shard.credential, shard) for shard in previous or [])
+        after = dict((shard.credential, shard) for shard in self.shards)
+        return set(
+            credential for credential in set(before) | set(after)
+            if before.get(credential) != after.get(credential))
+
+
+class ShardPlanner(object):
+
+    """Assign terms and boxes to shards with minimal churn."""
+
+    def __init__(
+            self,
+            credentials=1,
+            max_terms=MAX_TERMS,
+            max_locations=MAX_LOCATIONS):
+        """construct the planner.
+
+        credentials is the number of credential sets, and so the most
+        shards a plan can have.
+        """
+        if credentials < 1:
+            raise ValueError("invalid credentials: %s" % credentials)
+        self.credentials = credentials
+        self.max_terms = max_terms
+        self.max_locations = max_locations
+
+    def plan(self, terms, locations=None, previous=None):
+        """return a ShardPlan for terms and locations.
+
+        Terms and boxes already in a previous shard stay there; new ones
+        go to the emptiest shard with room, and a shard is only added
+        once the existing ones are full. Whatever doesn't fit in every
+        credential's shard is returned as dropped.
+        """
+        terms = unique(terms)
+        locations = unique(tuple(box) for box in locations or [])
+        term_set = set(terms)
+        location_set = set(locations)
+
+        shards = []
+        for shard in previous or []:
+            shards.append(Shard(
+                shard.credential,
+                [term for term in shard.terms if term in term_set],
+                [box for box in shard.locations if box in location_set]))
+        placed_terms = set(term for shard in shards for term in shard.terms)
+        placed_locations = set(
+            box for shard in shards for box in shard.locations)
+
+        dropped_terms = self.place(
+            shards,
+            [term for term in terms if term not in placed_terms],
+            "terms",
+            self.max_terms)
+        dropped_locations = self.place(
+            shards,
+            [box for box in locations if box not in placed_locations],
+            "locations",
+            self.max_locations)
+
+        shards = [shard for shard in shards if len(shard) > 0]
+        shards.sort(key=lambda shard: shard.credential)
+
+        if dropped_terms or dropped_locations:
+            log.error(
+                "%d terms and %d locations don't fit in %d connections",
+                len(dropped_terms),
+                len(dropped_locations),
+                self.credentials)
+        return ShardPlan(shards, dropped_terms, dropped_locations)
+
+    def place(self, shards, items, attribute, limit):
+        """add items to shards, returning the ones that don't fit."""
+        dropped = []
+        for item in items:
+            open_shards = [
+                shard for shard in shards
+                if len(getattr(shard, attribute)) < limit]
+            if open_shards:
+                shard = min(
+                    open_shards,
+                    key=lambda s: (len(getattr(s, attribute)), s.credential))
+            else:
+                shard = self.new_shard(shards)
+                if shard is None:
+                    dropped.append(item)
+                    continue
+            getattr(shard, attribute).append(item)
+        return dropped
+
+    def new_shard(self, shards):
+        """add a shard on the lowest free credential, None if none left."""
+        used = set(shard.credential for shard in shards)
+        for credential in range(self.credentials):
+            if credential not in used:
+                shard = Shard(credential)
+                shards.append(shard)
+                return shard
+        return None
+
+
+def unique(items):
+    """return items without repeats, in order."""
+    seen = set()
+    result = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+
+def location_boxes(locations):
+    """group a flat [w, s, e, n, ...] list into 4-tuples."""
+    if len(locations) % 4 != 0:
+        raise ValueError("invalid locations: %s" % locations)
+    return [tuple(locations[i:i + 4]) for i in range(0, len(locations), 4)]
+
+
+class ShardListener(object):
+
+    """One shard's view of the listener the shards share.
+
+    BaseListener keeps a single connected/error state, and on_data stops
+    the stream once it's in error. The proxy keeps that state per shard,
+    swapping it into the shared listener for each call, so an error on
+    one shard doesn't stop the others. A reconnect clears the error.
+    """
+
+    def __init__(self, listener, shards):
+        """construct the proxy.
+
+        shards is every shard's ShardListener, including this one; the
+        shared listener's state is left as their combined state.
+        """
+        self.listener = listener
+        self.shards = shards
+        self.connected = False
+        self.error = False
+
+    def call(self, method, *args):
+        """call a listener method with this shard's state."""
+        listener = self.listener
+        listener.connected = self.connected
+        listener.error = self.error
+        try:
+            return getattr(listener, method)(*args)
+        finally:
+            self.connected = listener.connected
+            self.error = listener.error
+            shards = list(self.shards.values())
+            listener.connected = any(shard.connected for shard in shards)
+            listener.error = all(shard.error for shard in shards)
+
+    def on_connect(self):
+        self.error = False
+        return self.call("on_connect")
+
+    def keep_alive(self):
+        return self.call("keep_alive")
+
+    def on_data(self, raw_data):
+        return self.call("on_data", raw_data)
+
+    def on_error(self, status_code):
+        return self.call("on_error", status_code)
+
+    def on_timeout(self):
+        return self.call("on_timeout")
+
+    def on_exception(self, exception):
+        return self.call("on_exception", exception)
+
+
+class ShardedStream(object):
+
+    """EngineStream lookalike that shards a filter across credentials.
+
+    Every shard connects with its own credential set. update() replans
+    and only reconnects the shards that changed.
+    """
+
+    def __init__(
+            self,
+            auths,
+            listener,
+            source_addr=None,
+            stall_warnings=False,
+            max_terms=MAX_TERMS,
+            max_locations=MAX_LOCATIONS,
+            **options):
+        """store the credentials and connection options.
+
+        auths is a list of tweepy OAuthHandlers; options are passed to
+        each StreamConnection.
+        """
+        if not auths:
+            raise ValueError("ShardedStream needs at least one credential")
+        self.auths = auths
+        self.listener = listener
+        self.source_addr = source_addr
+        self.stall_warnings = stall_warnings
+        self.options = options
+        self.planner = ShardPlanner(
+            len(auths),
+            max_terms=max_terms,
+            max_locations=max_locations)
+        self.engine = None
+        self.shards = []
+        self.connections = {}
+        # credential -> ShardListener
+        self.shard_listeners = {}
+
+    @property
+    def running(self):
+        """return True while the engine is running."""
+        return self.engine is not None and self.engine.running
+
+    def filter(self, track=None, locations=None, **kwargs):
+        """stream the filter over as many shards as it needs."""
+        self.engine = StreamEngine()
+        try:
+            self.update(track, locations)
+            self.engine.run()
+        finally:
+            self.engine.close()
+            self.engine = None
+
+    def sample(self, **kwargs):
+        """stream the sample on the first credentials."""
+        self.engine = StreamEngine()
+        try:
+            self.engine.add(self.make_connection(
+                0,
+                "/%s/statuses/sample.json" % STREAM_VERSION,
+                self.stream_params({}),
+                "GET"))
+            self.engine.run()
+        finally:
+            self.engine.close()
+            self.engine = None
+
+    def stream_params(self, params):
+        """add the shared stream options to params."""
+        if self.stall_warnings:
+            params["stall_warnings"] = "true"
+        return params
+
+    def make_connection(self, credential, path, params, method):
+        """return a connection on one credential set."""
+        listener = ShardListener(self.listener, self.shard_listeners)
+        self.shard_listeners[credential] = listener
+        return StreamConnection(
+            listener,
+            path,
+            params=params,
+            method=method,
+            auth=self.auths[credential],
+            source_addr=self.source_addr,
+            name="shard %d" % credential,
+            **self.options)
+
+    def shard_params(self, shard):
+        """return the filter body for a shard."""
+        params = {}
+        args = shard.filter_args()
+        if "track" in args:
+            params["track"] = u",".join(args["track"]).encode("utf8")
+        if "locations" in args:
+            params["locations"] = ",".join(
+                "%.4f" % value for value in args["locations"])
+        return self.stream_params(params)
+
+    def update(self, track=None, locations=None):
+        """replan for new terms, reconnecting only changed shards."""
+        plan = self.planner.plan(
+            track or [],
+            location_boxes(locations or []),
+            previous=self.shards)
+        changed = plan.changed(self.shards)
+        self.shards = plan.shards
+
+        wanted = dict((shard.credential, shard) for shard in plan.shards)
+        for credential in sorted(changed):
+            connection = self.connections.get(credential)
+            shard = wanted.get(credential)
+            if shard is None:
+                log.info("closing shard %d", credential)
+                connection.stop()
+                del self.connections[credential]
+                del self.shard_listeners[credential]
+            elif connection is None:
+                log.info("opening %s", shard)
+                connection = self.make_connection(
+                    credential,
+                    "/%s/statuses/filter.json" % STREAM_VERSION,
+                    self.shard_params(shard),
+                    "POST")
+                self.connections[credential] = connection
+                if self.engine is not None:
+                    self.engine.add(connection)
+            else:
+                log.info("reconnecting %s", shard)
+                connection.params = self.shard_params(shard)
+                connection.restart()
+        return plan
+
+    def disconnect(self):
+        """stop every shard."""
+        engine = self.engine
+        if engine is not None:
+            engine.stop()
+
+
+#
+# unittests
+#
+#
+class ShardPlannerTest(unittest.TestCase):
+
+    """ShardPlanner tests."""
+
+    def terms(self, start, stop):
+        """return terms t<start>..t<stop - 1>."""
+        return ["t%d" % i for i in range(start, stop)]
+
+    def test_split(self):
+        """terms and boxes are split by the per-connection limits."""
+        planner = ShardPlanner(3, max_terms=10, max_locations=2)
+        boxes = [(i, i, i + 1, i + 1) for i in range(3)]
+        plan = planner.plan(self.terms(0, 25), boxes)
+
+        self.assertEqual(
+            [len(shard.terms) for shard in plan.shards], [10, 10, 5])
+        self.assertEqual(
+            [len(shard.locations) for shard in plan.shards], [1, 1, 1])
+        self.assertEqual(plan.dropped_terms, [])
+
+    def test_overflow(self):
+        """terms beyond every credential's shard are dropped."""
+        planner = ShardPlanner(2, max_terms=10)
+        plan = planner.plan(self.terms(0, 25))
+        self.assertEqual(plan.dropped_terms, self.terms(20, 25))
+
+    def test_minimal_churn(self):
+        """only shards that lose or gain terms change."""
+        planner = ShardPlanner(3, max_terms=10)
+        first = planner.plan(self.terms(0, 25))
+
+        # drop a term from the first shard, add one
+        terms = self.terms(1, 25) + ["new"]
+        second = planner.plan(terms, previous=first.shards)
+
+        for before, after in zip(first.shards, second.shards):
+            self.assertTrue(
+                set(after.terms) >= set(before.terms) - set(["t0"]))
+        self.assertEqual(second.changed(first.shards), set([0, 2]))
+        self.assertTrue("new" in second.shards[2].terms)
+
+    def test_remove_shard(self):
+        """a shard that loses everything goes away."""
+        planner = ShardPlanner(2, max_terms=10)
+        first = planner.plan(self.terms(0, 15))
+        second = planner.plan(self.terms(0, 10), previous=first.shards)
+        self.assertEqual(len(second.shards), 1)
+        self.assertEqual(second.changed(first.shards), set([1]))
+
+    def test_stream_update(self):
+        """a term change only reconnects the shards it touched."""
+        stream = ShardedStream(
+            [None, None, None],
+            listener=None,
+            max_terms=10)
+        stream.engine = StreamEngine()
+        try:
+            stream.update(self.terms(0, 25))
+            connections = dict(stream.connections)
+            self.assertEqual(sorted(connections), [0, 1, 2])
+
+            for connection in connections.values():
+                connection.reconnect_at = 1
+            stream.update(self.terms(0, 10) + self.terms(20, 30))
+
+            # shard 1 lost its terms and took the new ones
+            self.assertEqual(connections[0].reconnect_at, 1)
+            self.assertEqual(connections[1].reconnect_at, 0)
+            self.assertEqual(connections[2].reconnect_at, 1)
+            self.assertEqual(
+                connections[1].params["track"],
+                ",".join(self.terms(25, 30)))
+
+            stream.update(self.terms(0, 10))
+            self.assertEqual(sorted(stream.connections), [0])
+            self.assertEqual(connections[2].state, "stopped")
+        finally:
+            stream.engine.close()
+
+    def test_shard_error_is_isolated(self):
+        """a shard rate limited with 420 doesn't stop the others."""
+        from listeners.base import BaseListener, CLASSIFY_SNIFF
+        from stream_engine import FakeStreamServer, StreamEngineTest
+
+        messages = StreamEngineTest("test_parser").messages
+        server = FakeStreamServer([
+            (420, []),
+            (200, messages("a", 10)),
+            (200, messages("b", 10))])
+        listener = BaseListener(classify_mode=CLASSIFY_SNIFF)
+        stream = ShardedStream(
+            [None, None, None],
+            listener,
+            max_terms=1,
+            host="127.0.0.1",
+            port=server.port,
+            use_ssl=False,
+            timeout=5.0,
+            retry_count=0)
+        try:
+            stream.filter(track=["a", "b", "c"])
+        finally:
+            server.close()
+
+        self.assertEqual(listener.stats.total, 20)
+        errors = [shard.error for shard in stream.shard_listeners.values()]
+        self.assertEqual(sorted(errors), [False, False, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Output sinks for the fan-out listener.
+
+Each sink is built from a config dict with a "type" (file, stdout,
+unix_socket, sqlite or null) and that sink's options, eg.
+
+    {"type": "unix_socket", "name": "tap", "path": "/tmp/collection.sock"}
+"""
+
+from .base import Sink
+from .file import FileSink
+from .null import NullSink
+from .stdout import StdoutSink
+from .sqlite import SQLiteSink
+from .unix_socket import UnixSocketSink
+
+
+# sinks that write into the collection directory get base_dir and
+# collection_name from the listener
+COLLECTION_SINKS = {
+    "file": FileSink,
+    "sqlite": SQLiteSink,
+}
+
+OTHER_SINKS = {
+    "stdout": StdoutSink,
+    "unix_socket": UnixSocketSink,
+    "null": NullSink,
+}
+
+SINK_TYPES = tuple(sorted(list(COLLECTION_SINKS) + list(OTHER_SINKS)))
+
+
+def make_sink(config, base_dir, collection_name):
+    """build a sink from its config dict.
+
+    Keys other than type (and the listener's queue_size/overflow_policy)
+    are passed to the sink's constructor. The sink is named after its
+    type if the config doesn't name it.
+    """
+    options = dict(config)
+    sink_type = options.pop("type", None)
+    options.pop("queue_size", None)
+    options.pop("overflow_policy", None)
+    options.setdefault("name", sink_type)
+
+    if sink_type in COLLECTION_SINKS:
+        options.setdefault("base_dir", base_dir)
+        return COLLECTION_SINKS[sink_type](
+            collection_name=collection_name,
+            **options)
+    elif sink_type in OTHER_SINKS:
+        return OTHER_SINKS[sink_type](**options)
+
+    raise ValueError("invalid sink type: %s" % sink_type)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""Base class for output sinks."""
+
+
+class Sink(object):
+
+    """Destination for captured lines.
+
+    A sink has the same interface as RotatingOutFile, so it can sit behind
+    a QueuedWriter: write() is called with each line and its receive time,
+    end_file() when the stream disconnects, flush() when the writer is
+    idle and close() on shutdown.
+
+    dropped counts lines the sink itself couldn't deliver (eg. while its
+    destination is down), as opposed to the queue's overflow drops.
+    """
+
+    def __init__(self, name=None):
+        """construct the sink."""
+        self.name = name
+        self.dropped = 0
+
+    def write(self, line, datetime_=None, timestamp=None):
+        """write one line."""
+        raise NotImplementedError()
+
+    def end_file(self):
+        """finish the current output unit, if the sink has one."""
+        pass
+
+    def flush(self):
+        """push out anything buffered."""
+        pass
+
+    def close(self):
+        """finish and release the sink."""
+        self.end_file()
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.name)
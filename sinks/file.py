@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Sink that writes rotating capture files."""
+
+from .base import Sink
+from rotating_out_file import RotatingOutFile
+
+
+class FileSink(Sink):
+
+    """RotatingOutFile as a sink."""
+
+    def __init__(
+            self,
+            base_dir,
+            collection_name,
+            name=None,
+            recover_orphans=True,
+            **file_options):
+        """construct the sink.
+
+        file_options are passed to RotatingOutFile (extension,
+        minute_interval, compression, stream_name and so on).
+        """
+        super(FileSink, self).__init__(name)
+        self.file = RotatingOutFile(
+            base_dir=base_dir,
+            collection_name=collection_name,
+            **file_options)
+        if recover_orphans:
+            self.file.recover_orphans()
+
+    def write(self, line, datetime_=None, timestamp=None):
+        """write the line to the current file."""
+        self.file.write(line, datetime_, timestamp)
+
+    def end_file(self):
+        """finish the current file."""
+        self.file.end_file()
+
+    def flush(self):
+        """write out buffered lines."""
+        self.file.flush()
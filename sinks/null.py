@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+"""Sink that throws lines away (for benchmarks and dry runs)."""
+
+from .base import Sink
+
+
+class NullSink(Sink):
+
+    """Count lines and discard them."""
+
+    def __init__(self, name=None):
+        """construct the sink."""
+        super(NullSink, self).__init__(name)
+        self.lines = 0
+        self.bytes = 0
+
+    def write(self, line, datetime_=None, timestamp=None):
+        """count the line."""
+        self.lines += 1
+        self.bytes += len(line) + 1
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+"""Sink that stores statuses in rotating SQLite databases."""
+
+import os
+import time
+import logging
+import sqlite3
+import calendar
+import unittest
+from datetime import datetime
+
+from .base import Sink
+from rotating_out_file import rotation_window, round_datetime, split_suffix
+from utils.sniff import status_id, created_at
+
+
+log = logging.getLogger(__name__)
+
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS statuses ("
+    "id INTEGER PRIMARY KEY, "
+    "created_at INTEGER, "
+    "received REAL, "
+    "data TEXT)",
+    "CREATE INDEX IF NOT EXISTS statuses_created_at "
+    "ON statuses (created_at)",
+)
+
+INSERT = (
+    "INSERT OR IGNORE INTO statuses (id, created_at, received, data) "
+    "VALUES (?, ?, ?, ?)")
+
+# month abbreviations in twitter's created_at ("%a %b %d %H:%M:%S +0000
+# %Y"), which is always english whatever the host's locale
+MONTHS = dict(
+    (name, i + 1) for i, name in enumerate((
+        "Jan", "Feb", "Mar", "Apr", "May", "Jun",
+        "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")))
+
+
+def created_at_timestamp(value):
+    """return a created_at string as epoch seconds.
+
+    Parsed by hand: time.strptime depends on the locale, and its lazy
+    import isn't thread safe on python 2, while this runs on the sink's
+    writer thread.
+    """
+    try:
+        _, month, day, clock, offset, year = value.split()
+        hour, minute, second = clock.split(":")
+        timestamp = calendar.timegm((
+            int(year), MONTHS[month], int(day),
+            int(hour), int(minute), int(second)))
+        sign = -1 if offset[0] == "-" else 1
+        return timestamp - sign * (
+            int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+    except (KeyError, IndexError):
+        raise ValueError("invalid created_at: %s" % value)
+
+
+class SQLiteSink(Sink):
+
+    """Insert statuses into one SQLite database per rotation window.
+
+    Databases rotate on the same schedule as RotatingOutFile and are
+    named after the sink as well as the collection, so several sqlite
+    sinks can share a collection, eg.
+    collection/collection-sqlite20150101_1210.sqlite. They're written in WAL
+    mode under a temporary name and renamed once closed. Rows are
+    inserted with executemany, batch_size rows per transaction; a
+    partial batch is committed when the writer goes idle.
+
+    The id column is the table's primary key; created_at (epoch
+    seconds) is indexed too.
+    """
+
+    def __init__(
+            self,
+            base_dir,
+            collection_name,
+            name=None,
+            batch_size=1000,
+            minute_interval=10,
+            filename_timefmt="%Y%m%d_%H%M",
+            extension=".sqlite",
+            temporary_extension=".tmp",
+            synchronous="NORMAL",
+            recover_orphans=True):
+        """construct the sink.
+
+        synchronous is the SQLite synchronous pragma; NORMAL is durable
+        to the last checkpoint in WAL mode and much faster than FULL.
+        """
+        super(SQLiteSink, self).__init__(name)
+        self.collection_dir = os.path.join(base_dir, collection_name)
+        if not os.path.isdir(self.collection_dir):
+            os.makedirs(self.collection_dir)
+        self.collection_name = collection_name
+        self.file_prefix = collection_name
+        if name is not None:
+            self.file_prefix += "-" + name
+        self.batch_size = batch_size
+        self.minute_interval = minute_interval
+        self.filename_timefmt = filename_timefmt
+        self.extension = extension
+        self.temporary_extension = temporary_extension
+        self.synchronous = synchronous
+
+        self.db = None
+        self.cur_name = None
+        self.rows = []
+        self.inserted = 0
+
+        self.window_start = 0
+        self.window_end = 0
+        self.window_datetime = None
+
+        # statuses arrive in created_at order, cache the last conversion
+        self.last_created_at = None
+        self.last_created_ts = None
+
+        if recover_orphans:
+            self.recover_orphans()
+
+    def get_filename(self, datetime_, temp=False):
+        """return the database name for datetime_'s window."""
+        rounded_datetime = round_datetime(datetime_, self.minute_interval)
+        name = os.path.join(
+            self.collection_dir,
+            self.file_prefix +
+            rounded_datetime.strftime(self.filename_timefmt) +
+            self.extension)
+        if temp:
+            name += self.temporary_extension
+        return name
+
+    def open_db(self):
+        """open (and set up) the database for the current window."""
+        self.cur_name = self.get_filename(self.window_datetime, True)
+
+        # opened on the writer thread, closed from the shutdown thread
+        self.db = sqlite3.connect(self.cur_name, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=%s" % self.synchronous)
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def parse_created_at(self, value):
+        """return created_at as epoch seconds, or None."""
+        if value != self.last_created_at:
+            self.last_created_at = value
+            try:
+                self.last_created_ts = created_at_timestamp(value)
+            except (AttributeError, TypeError, ValueError):
+                self.last_created_ts = None
+        return self.last_created_ts
+
+    def write(self, line, datetime_=None, timestamp=None):
+        """queue a row, inserting the batch once it's full."""
+        line_id = status_id(line)
+        if line_id is None:
+            return
+
+        if datetime_ is not None:
+            timestamp = (time.mktime(datetime_.timetuple()) +
+                         datetime_.microsecond / 1e6)
+        elif timestamp is None:
+            timestamp = time.time()
+
+        if not self.window_start <= timestamp < self.window_end:
+            self.end_file()
+            (self.window_datetime,
+             self.window_start,
+             self.window_end) = rotation_window(
+                timestamp,
+                self.minute_interval)
+
+        self.rows.append((
+            line_id,
+            self.parse_created_at(created_at(line)),
+            timestamp,
+            line))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """insert the pending rows in one transaction."""
+        if not self.rows:
+            return
+        if self.db is None:
+            self.open_db()
+        self.db.executemany(INSERT, self.rows)
+        self.db.commit()
+        self.inserted += len(self.rows)
+        self.rows = []
+
+    def end_file(self):
+        """insert the pending rows, close the database and rename it."""
+        self.flush()
+        if self.db is None:
+            return
+
+        # closing the last connection checkpoints and removes the wal
+        self.db.close()
+        self.db = None
+        self.finish_file(self.cur_name)
+        self.cur_name = None
+
+    def finish_file(self, temp_filename):
+        """rename a closed database to a free final name."""
+        finished = temp_filename[:-len(self.temporary_extension)]
+        base = finished[:-len(self.extension)]
+        first_suffix = 0
+        suffix = split_suffix(
+            os.path.basename(base)[len(self.file_prefix):],
+            self.filename_timefmt)[1]
+        if suffix is not None:
+            base = base[:-3]
+            first_suffix = suffix + 1
+
+        suffix_id = first_suffix
+        while os.path.exists(finished) and suffix_id < 100:
+            finished = base + "_%02d" % suffix_id + self.extension
+            suffix_id += 1
+
+        if os.path.exists(finished):
+            log.error("no free name for %s, leaving it", temp_filename)
+            return temp_filename
+
+        os.rename(temp_filename, finished)
+        return finished
+
+    def is_own_filename(self, filename):
+        """return True if filename is one of this sink's open databases.
+
+        Another sink's prefix can start with ours (eg. "db" and "db2"),
+        so what's between the prefix and the extension has to be a time.
+        """
+        suffix = self.extension + self.temporary_extension
+        if (not filename.startswith(self.file_prefix) or
+                not filename.endswith(suffix)):
+            return False
+
+        time_str = split_suffix(
+            filename[len(self.file_prefix):-len(suffix)],
+            self.filename_timefmt)[0]
+        try:
+            datetime.strptime(time_str, self.filename_timefmt)
+        except ValueError:
+            return False
+        return True
+
+    def recover_orphans(self):
+        """finish databases left open by a process that died.
+
+        Opening each one first replays its write-ahead log, so nothing
+        committed is lost in the rename.
+        """
+        recovered = []
+        for filename in sorted(os.listdir(self.collection_dir)):
+            path = os.path.join(self.collection_dir, filename)
+            if not self.is_own_filename(filename) or path == self.cur_name:
+                continue
+
+            db = sqlite3.connect(path)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.close()
+            finished = self.finish_file(path)
+            log.info("recovered %s -> %s", path, finished)
+            recovered.append(finished)
+        return recovered
+
+    def close(self):
+        """insert the pending rows and finish the database."""
+        self.end_file()
+
+
+#
+# unittests
+#
+#
+class SQLiteSinkTest(unittest.TestCase):
+
+    """SQLiteSink tests."""
+
+    def setUp(self):
+        """set up the sink."""
+        self.base_dir = ".unittest-sqlite"
+        self.collection = "test"
+        self.sink = SQLiteSink(
+            self.base_dir,
+            self.collection,
+            batch_size=2)
+        self.dt = datetime(1997, 10, 30, 12, 36)
+
+    def tearDown(self):
+        """remove the databases."""
+        import shutil
+        shutil.rmtree(self.base_dir)
+
+    def status(self, status_id):
+        """return a raw status."""
+        return ('{"created_at":"Thu Oct 30 12:36:%02d +0000 1997",'
+                '"id":%d,"text":"x"}' % (status_id, status_id))
+
+    def query(self, datetime_, sql):
+        """run sql against a finished database."""
+        db = sqlite3.connect(self.sink.get_filename(datetime_))
+        try:
+            return db.execute(sql).fetchall()
+        finally:
+            db.close()
+
+    def test_batches_and_rotation(self):
+        """rows land in the database for their window."""
+        for i in range(5):
+            self.sink.write(self.status(i), datetime_=self.dt)
+        self.assertEqual(self.sink.inserted, 4)
+        self.sink.write(self.status(9), datetime_=datetime(1997, 10, 30, 13))
+        self.sink.close()
+
+        self.assertEqual(
+            self.query(self.dt, "SELECT id FROM statuses ORDER BY id"),
+            [(i,) for i in range(5)])
+        self.assertEqual(
+            self.query(
+                datetime(1997, 10, 30, 13),
+                "SELECT created_at FROM statuses"),
+            [(calendar.timegm((1997, 10, 30, 12, 36, 9)),)])
+
+    def test_created_at(self):
+        """created_at parses without strptime, bad values are None."""
+        self.assertEqual(
+            created_at_timestamp("Thu Oct 30 12:36:09 +0000 1997"),
+            calendar.timegm((1997, 10, 30, 12, 36, 9)))
+        self.assertEqual(
+            created_at_timestamp("Thu Oct 30 12:36:09 -0130 1997"),
+            calendar.timegm((1997, 10, 30, 14, 6, 9)))
+        self.assertEqual(self.sink.parse_created_at("Thu Okt 30"), None)
+        self.assertEqual(self.sink.parse_created_at(None), None)
+
+    def test_duplicate_ids(self):
+        """a status id is only stored once."""
+        self.sink.write(self.status(1), datetime_=self.dt)
+        self.sink.write(self.status(1), datetime_=self.dt)
+        self.sink.close()
+        self.assertEqual(
+            self.query(self.dt, "SELECT COUNT(*) FROM statuses"),
+            [(1,)])
+
+    def test_recover_orphan(self):
+        """a database left open is finished on the next start."""
+        self.sink.write(self.status(1), datetime_=self.dt)
+        self.sink.flush()
+        self.sink.db.close()
+
+        SQLiteSink(self.base_dir, self.collection)
+        self.assertEqual(
+            self.query(self.dt, "SELECT id FROM statuses"),
+            [(1,)])
+
+    def test_named_sinks(self):
+        """sinks in one collection write their own databases."""
+        first = SQLiteSink(self.base_dir, self.collection, name="db")
+        second = SQLiteSink(self.base_dir, self.collection, name="db2")
+        first.write(self.status(1), datetime_=self.dt)
+        second.write(self.status(2), datetime_=self.dt)
+        second.flush()
+
+        # second's open database isn't an orphan of first
+        self.assertEqual(first.recover_orphans(), [])
+        first.close()
+        second.close()
+
+        self.assertNotEqual(
+            first.get_filename(self.dt), second.get_filename(self.dt))
+        for sink, status_id in ((first, 1), (second, 2)):
+            db = sqlite3.connect(sink.get_filename(self.dt))
+            try:
+                self.assertEqual(
+                    db.execute("SELECT id FROM statuses").fetchall(),
+                    [(status_id,)])
+            finally:
+                db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+"""Sink that writes lines to stdout (or any file object)."""
+
+import sys
+
+from .base import Sink
+
+
+class StdoutSink(Sink):
+
+    """Write one line per message to a stream."""
+
+    def __init__(self, name=None, stream=None):
+        """construct the sink. stream defaults to sys.stdout."""
+        super(StdoutSink, self).__init__(name)
+        self.stream = stream if stream is not None else sys.stdout
+
+    def write(self, line, datetime_=None, timestamp=None):
+        """write the line."""
+        self.stream.write(line + "\n")
+
+    def flush(self):
+        """flush the stream."""
+        self.stream.flush()
+
+    def end_file(self):
+        """flush the stream."""
+        self.flush()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Sink that streams lines to a Unix domain socket."""
+
+import socket
+import logging
+from time import time
+
+from .base import Sink
+
+
+log = logging.getLogger(__name__)
+
+
+class UnixSocketSink(Sink):
+
+    """Send newline-delimited lines to a listening Unix socket.
+
+    Lines are dropped (and counted) while the socket is down; we try to
+    reconnect at most once every retry_interval seconds.
+    """
+
+    def __init__(self, path, name=None, timeout=5.0, retry_interval=5.0):
+        """construct the sink. connects on the first write."""
+        super(UnixSocketSink, self).__init__(name)
+        self.path = path
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.sock = None
+        self.last_attempt = 0
+
+    def connect(self):
+        """connect if we're not, returns True if connected."""
+        if self.sock is not None:
+            return True
+
+        now = time()
+        if now - self.last_attempt < self.retry_interval:
+            return False
+        self.last_attempt = now
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error, e:
+            log.warning("can't connect to %s: %s", self.path, e)
+            sock.close()
+            return False
+
+        log.info("connected to %s", self.path)
+        self.sock = sock
+        return True
+
+    def disconnect(self):
+        """close the socket."""
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+    def write(self, line, datetime_=None, timestamp=None):
+        """send the line, or drop it if the socket is down."""
+        if not self.connect():
+            self.dropped += 1
+            return
+
+        try:
+            self.sock.sendall(line + "\n")
+        except socket.error, e:
+            log.warning("lost %s: %s", self.path, e)
+            self.disconnect()
+            self.dropped += 1
+
+    def close(self):
+        """close the socket."""
+        self.disconnect()
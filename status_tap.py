@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+"""Publish live statuses to local subscribers over a Unix socket.
+
+Each message is sent as a 4-byte big-endian length followed by the raw
+bytes. Any number of subscribers can connect to the socket. Publishing
+never blocks the capture: every subscriber has a bounded queue, and a
+subscriber that falls behind has messages dropped (sample policy) or is
+disconnected (drop policy).
+"""
+
+import os
+import errno
+import select
+import socket
+import struct
+import logging
+import threading
+import unittest
+from collections import deque
+from time import time
+
+
+log = logging.getLogger(__name__)
+
+
+# what to do with a subscriber whose queue is full
+SLOW_SAMPLE = "sample"
+SLOW_DROP = "drop"
+
+SLOW_POLICIES = (SLOW_SAMPLE, SLOW_DROP)
+
+FRAME_HEADER = struct.Struct(">I")
+
+# bytes handed to send() at a time
+SEND_SIZE = 64 * 1024
+
+
+class Subscriber(object):
+
+    """One connected subscriber and its queue."""
+
+    def __init__(self, sock, address, max_queue):
+        """construct the subscriber."""
+        self.sock = sock
+        self.address = address
+        self.queue = deque()
+        self.max_queue = max_queue
+        self.pending = b""
+        self.sent = 0
+        self.dropped = 0
+        self.lag = 0.0
+        self.closing = False
+        self.connected_at = time()
+
+    def as_dict(self):
+        """return the subscriber's stats."""
+        return {
+            "depth": len(self.queue),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "lag": self.lag,
+        }
+
+
+class StatusTap(object):
+
+    """Unix socket publisher fed from the listener's on_status."""
+
+    def __init__(self, path, max_queue=1000, slow_policy=SLOW_SAMPLE):
+        """bind the socket and start the publishing thread."""
+        if slow_policy not in SLOW_POLICIES:
+            raise ValueError("invalid slow_policy: %s" % slow_policy)
+
+        self.path = path
+        self.max_queue = max_queue
+        self.slow_policy = slow_policy
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.published = 0
+
+        # remove a socket left behind by a previous run
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(16)
+        self.server.setblocking(False)
+
+        # publish() wakes the thread through this pipe
+        self.wake_read, self.wake_write = os.pipe()
+        self.wake_pending = False
+
+        self.thread = threading.Thread(target=self.run, name="StatusTap")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, raw_data):
+        """queue a message for every subscriber. never blocks."""
+        if not self.subscribers:
+            return
+
+        if not isinstance(raw_data, bytes):
+            raw_data = raw_data.encode("utf-8")
+        frame = FRAME_HEADER.pack(len(raw_data)) + raw_data
+        now = time()
+
+        self.lock.acquire()
+        try:
+            self.published += 1
+            for subscriber in self.subscribers:
+                if len(subscriber.queue) >= subscriber.max_queue:
+                    subscriber.dropped += 1
+                    if self.slow_policy == SLOW_DROP:
+                        subscriber.closing = True
+                    continue
+                subscriber.queue.append((frame, now))
+
+            wake = not self.wake_pending
+            self.wake_pending = True
+        finally:
+            self.lock.release()
+
+        if wake:
+            os.write(self.wake_write, b"x")
+
+    def stats(self):
+        """return a list of per-subscriber stats dicts."""
+        self.lock.acquire()
+        try:
+            return [subscriber.as_dict() for subscriber in self.subscribers]
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """stop publishing, disconnect everyone and remove the socket."""
+        self.stopping = True
+        os.write(self.wake_write, b"x")
+        self.thread.join()
+
+        for subscriber in self.subscribers:
+            subscriber.sock.close()
+        self.subscribers = []
+        self.server.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def accept(self):
+        """accept waiting subscribers."""
+        while True:
+            try:
+                sock, address = self.server.accept()
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            sock.setblocking(False)
+            subscriber = Subscriber(sock, address, self.max_queue)
+            self.lock.acquire()
+            try:
+                self.subscribers.append(subscriber)
+            finally:
+                self.lock.release()
+            log.info("tap subscriber connected (%d)", len(self.subscribers))
+
+    def remove(self, subscriber):
+        """disconnect a subscriber."""
+        self.lock.acquire()
+        try:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+        finally:
+            self.lock.release()
+        subscriber.sock.close()
+        log.info(
+            "tap subscriber disconnected (sent %d, dropped %d)",
+            subscriber.sent,
+            subscriber.dropped)
+
+    def send(self, subscriber):
+        """send as much of a subscriber's queue as the socket takes."""
+        while True:
+            if not subscriber.pending:
+                self.lock.acquire()
+                try:
+                    frames = []
+                    size = 0
+                    while subscriber.queue and size < SEND_SIZE:
+                        frame, published = subscriber.queue.popleft()
+                        frames.append(frame)
+                        size += len(frame)
+                        subscriber.lag = time() - published
+                        subscriber.sent += 1
+                finally:
+                    self.lock.release()
+                if not frames:
+                    return
+                subscriber.pending = b"".join(frames)
+
+            try:
+                count = subscriber.sock.send(subscriber.pending)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.remove(subscriber)
+                return
+            subscriber.pending = subscriber.pending[count:]
+
+    def run(self):
+        """publishing thread loop."""
+        while not self.stopping:
+            self.lock.acquire()
+            try:
+                subscribers = list(self.subscribers)
+            finally:
+                self.lock.release()
+
+            # anyone over their queue with the drop policy goes
+            for subscriber in subscribers:
+                if subscriber.closing:
+                    self.remove(subscriber)
+            subscribers = [s for s in subscribers if not s.closing]
+
+            readable = [self.server, self.wake_read] + [
+                s.sock for s in subscribers]
+            writable = [
+                s.sock for s in subscribers if s.queue or s.pending]
+            try:
+                ready, can_write, _ = select.select(
+                    readable, writable, [], 1.0)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if self.wake_read in ready:
+                self.lock.acquire()
+                try:
+                    os.read(self.wake_read, 4096)
+                    self.wake_pending = False
+                finally:
+                    self.lock.release()
+
+            if self.server in ready:
+                self.accept()
+
+            for subscriber in subscribers:
+                if subscriber.sock in ready:
+                    # subscribers don't talk, readable means closed
+                    try:
+                        data = subscriber.sock.recv(4096)
+                    except socket.error:
+                        data = b""
+                    if not data:
+                        self.remove(subscriber)
+                        continue
+                if subscriber.sock in can_write:
+                    self.send(subscriber)
+
+
+def subscribe(path):
+    """connect to a tap and yield each message's raw bytes."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    buf = b""
+    try:
+        while True:
+            data = sock.recv(SEND_SIZE)
+            if not data:
+                return
+            buf += data
+            while len(buf) >= FRAME_HEADER.size:
+                length = FRAME_HEADER.unpack_from(buf)[0]
+                end = FRAME_HEADER.size + length
+                if len(buf) < end:
+                    break
+                yield buf[FRAME_HEADER.size:end]
+                buf = buf[end:]
+    finally:
+        sock.close()
+
+
+#
+# unittests
+#
+#
+class StatusTapTest(unittest.TestCase):
+
+    """StatusTap tests."""
+
+    def setUp(self):
+        """set up the tap."""
+        self.path = "/tmp/.unittest-tap-%d.sock" % os.getpid()
+
+    def wait_for_subscribers(self, tap, count):
+        """wait until count subscribers are connected."""
+        from time import sleep
+        for _ in range(200):
+            if len(tap.subscribers) >= count:
+                return
+            sleep(0.01)
+        self.fail("subscribers didn't connect")
+
+    def test_publish(self):
+        """every subscriber gets every message, in order."""
+        tap = StatusTap(self.path)
+        try:
+            subscriptions = [subscribe(self.path) for _ in range(2)]
+            # generators connect on their first next()
+            results = [[] for _ in subscriptions]
+            threads = []
+            for subscription, result in zip(subscriptions, results):
+                thread = threading.Thread(
+                    target=lambda s=subscription, r=result: r.extend(
+                        next(s) for _ in range(100)))
+                thread.start()
+                threads.append(thread)
+            self.wait_for_subscribers(tap, 2)
+
+            for i in range(100):
+                tap.publish('{"id": %d}' % i)
+            for thread in threads:
+                thread.join(5)
+
+            expected = [b'{"id": %d}' % i for i in range(100)]
+            self.assertEqual(results, [expected, expected])
+        finally:
+            tap.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_slow_subscriber(self):
+        """a subscriber that doesn't read is sampled, not waited on."""
+        tap = StatusTap(self.path, max_queue=10)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            self.wait_for_subscribers(tap, 1)
+
+            payload = "x" * 10000
+            for i in range(1000):
+                tap.publish(payload)
+            stats = tap.stats()[0]
+            self.assertTrue(stats["dropped"] > 0)
+            self.assertTrue(stats["depth"] <= 10)
+        finally:
+            sock.close()
+            tap.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1015 @@
+#!/usr/bin/env python
+"""Single-threaded streaming engine for many concurrent connections.
+
+tweepy.Stream ties up a thread per connection and reads through requests.
+StreamEngine instead multiplexes any number of StreamConnections over
+non-blocking sockets with poll(), so holding many streams in one process
+costs a socket and a couple of small buffers each.
+
+A connection does its own HTTP: it binds the source address (like
+streamer.SourceAddressAdapter), does the SSL handshake, sends an
+OAuth-signed request, decodes the chunked response and splits the
+length-delimited (delimited=length) messages out of it. Messages go to
+the listener's on_data, so any BaseListener works unchanged; errors,
+timeouts and reconnect backoff follow tweepy.Stream.
+"""
+
+import os
+import ssl
+import errno
+import fcntl
+import select
+import socket
+import urllib
+import logging
+import threading
+import unittest
+from time import time, sleep
+
+
+log = logging.getLogger(__name__)
+
+
+STREAM_HOST = "stream.twitter.com"
+STREAM_VERSION = "1.1"
+
+USER_AGENT = "twitter-capture"
+
+# bytes read per recv() call
+RECV_SIZE = 64 * 1024
+
+# connection states
+STATE_IDLE = "idle"
+STATE_CONNECTING = "connecting"
+STATE_HANDSHAKE = "handshake"
+STATE_SENDING = "sending"
+STATE_HEADERS = "headers"
+STATE_STREAMING = "streaming"
+STATE_STOPPED = "stopped"
+
+# errors that mean "try again when the socket is ready"
+RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class ChunkedDecoder(object):
+
+    """Incremental decoder for a chunked transfer-encoded body."""
+
+    def __init__(self):
+        """construct the decoder."""
+        self.buf = b""
+        self.remaining = 0
+        self.done = False
+
+    def feed(self, data):
+        """return the body bytes contained in data."""
+        self.buf += data
+        out = []
+        while self.buf and not self.done:
+            if self.remaining > 0:
+                piece = self.buf[:self.remaining]
+                out.append(piece)
+                self.buf = self.buf[len(piece):]
+                self.remaining -= len(piece)
+                if self.remaining == 0:
+                    # the chunk's trailing crlf
+                    self.remaining = -2
+                continue
+
+            if self.remaining < 0:
+                skip = min(-self.remaining, len(self.buf))
+                self.buf = self.buf[skip:]
+                self.remaining += skip
+                continue
+
+            end = self.buf.find(b"\r\n")
+            if end < 0:
+                break
+            size = self.buf[:end].split(b";", 1)[0].strip()
+            self.buf = self.buf[end + 2:]
+            try:
+                self.remaining = int(size, 16)
+            except ValueError:
+                raise ValueError("invalid chunk size: %r" % size)
+            if self.remaining == 0:
+                self.done = True
+        return b"".join(out)
+
+
+class MessageParser(object):
+
+    """Split a delimited=length body into messages.
+
+    Each message is preceded by its length in bytes on a line of its own;
+    blank lines are keep-alives.
+    """
+
+    def __init__(self):
+        """construct the parser."""
+        self.buf = b""
+        self.length = None
+
+    def feed(self, data):
+        """return the messages completed by data.
+
+        A keep-alive is returned as None.
+        """
+        self.buf += data
+        messages = []
+        while True:
+            if self.length is None:
+                end = self.buf.find(b"\n")
+                if end < 0:
+                    break
+                line = self.buf[:end].strip()
+                self.buf = self.buf[end + 1:]
+                if not line:
+                    messages.append(None)
+                elif line.isdigit():
+                    self.length = int(line)
+                else:
+                    raise ValueError("invalid message length: %r" % line)
+            else:
+                if len(self.buf) < self.length:
+                    break
+                message = self.buf[:self.length].strip()
+                self.buf = self.buf[self.length:]
+                self.length = None
+                if message:
+                    messages.append(message)
+        return messages
+
+
+def oauth_header(auth, method, url, body=None):
+    """return the Authorization header for a request.
+
+    auth is a tweepy OAuthHandler (or anything with the same four key
+    attributes).
+    """
+    from oauthlib.oauth1 import Client
+
+    client = Client(
+        unicode(auth.consumer_key),
+        client_secret=unicode(auth.consumer_secret),
+        resource_owner_key=unicode(auth.access_token),
+        resource_owner_secret=unicode(auth.access_token_secret))
+    headers = {}
+    if body:
+        headers[u"Content-Type"] = u"application/x-www-form-urlencoded"
+    _, headers, _ = client.sign(
+        unicode(url),
+        http_method=unicode(method),
+        body=unicode(body) if body else None,
+        headers=headers)
+    return str(headers["Authorization"])
+
+
+class StreamConnection(object):
+
+    """One streaming HTTP connection driven by a StreamEngine."""
+
+    def __init__(
+            self,
+            listener,
+            path,
+            params=None,
+            method="POST",
+            host=STREAM_HOST,
+            port=None,
+            auth=None,
+            source_addr=None,
+            use_ssl=True,
+            ssl_context=None,
+            timeout=90.0,
+            retry_count=None,
+            retry_time=5.0,
+            retry_420=60.0,
+            retry_time_cap=320.0,
+            snooze_time=0.25,
+            snooze_time_cap=16.0,
+            name=None):
+        """construct the connection.
+
+        params are sent as the form body of a POST (or the query string of
+        a GET); delimited=length is always added to the query string.
+        The retry options match tweepy.Stream's: http errors back off
+        exponentially from retry_time (retry_420 for rate limiting),
+        network errors and timeouts linearly by snooze_time.
+        """
+        self.listener = listener
+        self.path = path
+        self.params = params or {}
+        self.method = method
+        self.host = host
+        self.port = port or (443 if use_ssl else 80)
+        self.auth = auth
+        self.source_addr = source_addr
+        self.use_ssl = use_ssl
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.retry_count = retry_count
+        self.retry_time_start = retry_time
+        self.retry_420_start = retry_420
+        self.retry_time_cap = retry_time_cap
+        self.snooze_time_step = snooze_time
+        self.snooze_time_cap = snooze_time_cap
+        self.name = name or path
+
+        self.retry_time = retry_time
+        self.snooze_time = snooze_time
+        self.error_counter = 0
+
+        self.sock = None
+        self.state = STATE_IDLE
+        self.reconnect_at = 0
+        self.last_activity = 0
+        self.ssl_want_write = False
+        self.out = b""
+        self.header_buf = b""
+        self.decoder = None
+        self.parser = None
+
+        self.connects = 0
+        self.messages = 0
+        self.bytes_received = 0
+
+    @property
+    def running(self):
+        """return True until the connection has stopped for good."""
+        return self.state != STATE_STOPPED
+
+    def fileno(self):
+        """return the socket's file descriptor."""
+        return self.sock.fileno()
+
+    def wants_write(self):
+        """return True if the connection is waiting to write."""
+        return (self.state in (STATE_CONNECTING, STATE_SENDING) or
+                self.ssl_want_write)
+
+    def build_request(self):
+        """return the request bytes."""
+        query = {"delimited": "length"}
+        body = None
+        if self.method == "GET":
+            query.update(self.params)
+        elif self.params:
+            body = urllib.urlencode(sorted(self.params.items()))
+        path = self.path + "?" + urllib.urlencode(sorted(query.items()))
+
+        headers = [
+            ("Host", self.host),
+            ("User-Agent", USER_AGENT),
+            ("Accept-Encoding", "identity"),
+        ]
+        if self.auth is not None:
+            scheme = "https" if self.use_ssl else "http"
+            url = "%s://%s%s" % (scheme, self.host, path)
+            headers.append(
+                ("Authorization", oauth_header(
+                    self.auth, self.method, url, body)))
+        if body is not None:
+            headers.append(
+                ("Content-Type", "application/x-www-form-urlencoded"))
+            headers.append(("Content-Length", str(len(body))))
+
+        lines = ["%s %s HTTP/1.1" % (self.method, path)]
+        lines.extend("%s: %s" % header for header in headers)
+        return "\r\n".join(lines) + "\r\n\r\n" + (body or "")
+
+    def connect(self, now):
+        """start connecting."""
+        self.connects += 1
+        self.header_buf = b""
+        self.decoder = None
+        self.parser = MessageParser()
+        self.out = self.build_request()
+        self.last_activity = now
+
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(False)
+        if self.source_addr is not None:
+            self.sock.bind((self.source_addr, 0))
+
+        result = self.sock.connect_ex(address)
+        if result not in (0, errno.EINPROGRESS) + RETRY_ERRNOS:
+            raise socket.error(result, os.strerror(result))
+        self.state = STATE_CONNECTING
+
+    def close(self):
+        """close the socket."""
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+        self.ssl_want_write = False
+
+    def stop(self):
+        """close the connection for good."""
+        self.close()
+        self.state = STATE_STOPPED
+
+    def restart(self):
+        """reconnect right away, eg. after changing params."""
+        self.close()
+        self.state = STATE_IDLE
+        self.reconnect_at = 0
+
+    def handle_write(self, now):
+        """the socket is writable."""
+        if self.state == STATE_CONNECTING:
+            result = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if result != 0:
+                raise socket.error(result, os.strerror(result))
+            if self.use_ssl:
+                self.start_ssl()
+            else:
+                self.state = STATE_SENDING
+
+        if self.state == STATE_HANDSHAKE:
+            self.handshake()
+        elif self.state == STATE_SENDING:
+            self.send(now)
+
+    def handle_read(self, now):
+        """the socket is readable."""
+        if self.state == STATE_HANDSHAKE:
+            self.handshake()
+            return
+        if self.state not in (STATE_HEADERS, STATE_STREAMING):
+            return
+
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except ssl.SSLError, e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    return
+                raise
+            except socket.error, e:
+                if e.args[0] in RETRY_ERRNOS:
+                    return
+                raise
+
+            if not data:
+                self.retry("connection closed")
+                return
+
+            self.last_activity = now
+            self.bytes_received += len(data)
+            if self.state == STATE_HEADERS:
+                self.read_headers(data)
+            else:
+                self.read_body(data)
+
+    def start_ssl(self):
+        """wrap the connected socket for the handshake."""
+        context = self.ssl_context
+        if context is None:
+            context = ssl.create_default_context()
+        self.sock = context.wrap_socket(
+            self.sock,
+            server_hostname=self.host,
+            do_handshake_on_connect=False)
+        self.state = STATE_HANDSHAKE
+
+    def handshake(self):
+        """continue the ssl handshake."""
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.ssl_want_write = False
+                return
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.ssl_want_write = True
+                return
+            raise
+        self.ssl_want_write = False
+        self.state = STATE_SENDING
+
+    def send(self, now):
+        """send as much of the request as the socket takes."""
+        try:
+            count = self.sock.send(self.out)
+        except ssl.SSLError, e:
+            if e.args[0] in (
+                    ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        except socket.error, e:
+            if e.args[0] in RETRY_ERRNOS:
+                return
+            raise
+        self.out = self.out[count:]
+        self.last_activity = now
+        if not self.out:
+            self.state = STATE_HEADERS
+
+    def read_headers(self, data):
+        """buffer the response headers and check the status."""
+        self.header_buf += data
+        end = self.header_buf.find(b"\r\n\r\n")
+        if end < 0:
+            return
+
+        lines = self.header_buf[:end].split(b"\r\n")
+        rest = self.header_buf[end + 4:]
+        self.header_buf = b""
+
+        try:
+            status_code = int(lines[0].split(None, 2)[1])
+        except (IndexError, ValueError):
+            raise ValueError("invalid status line: %r" % lines[0])
+
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(b":")
+            headers[key.strip().lower()] = value.strip()
+
+        if status_code != 200:
+            self.http_error(status_code)
+            return
+
+        self.error_counter = 0
+        self.retry_time = self.retry_time_start
+        self.snooze_time = self.snooze_time_step
+        if "chunked" in headers.get(b"transfer-encoding", b"").lower():
+            self.decoder = ChunkedDecoder()
+        self.state = STATE_STREAMING
+        log.info("%s connected", self.name)
+        self.listener.on_connect()
+        if rest:
+            self.read_body(rest)
+
+    def read_body(self, data):
+        """pass the messages in data to the listener."""
+        if self.decoder is not None:
+            data = self.decoder.feed(data)
+        for message in self.parser.feed(data):
+            if message is None:
+                self.listener.keep_alive()
+                continue
+            self.messages += 1
+            if self.listener.on_data(message) is False:
+                log.info("%s stopped by listener", self.name)
+                self.stop()
+                return
+        if self.decoder is not None and self.decoder.done:
+            self.retry("stream ended")
+
+    def http_error(self, status_code):
+        """back off exponentially after an http error."""
+        self.close()
+        if self.listener.on_error(status_code) is False:
+            self.stop()
+            return
+        self.error_counter += 1
+        if status_code == 420:
+            self.retry_time = max(self.retry_420_start, self.retry_time)
+        self.schedule(self.retry_time)
+        self.retry_time = min(self.retry_time * 2, self.retry_time_cap)
+
+    def timed_out(self):
+        """back off linearly after a stall."""
+        self.close()
+        if self.listener.on_timeout() is False:
+            self.stop()
+            return
+        self.retry("timed out")
+
+    def retry(self, reason):
+        """back off linearly after a network error."""
+        log.warn("%s: %s", self.name, reason)
+        self.close()
+        self.error_counter += 1
+        self.schedule(self.snooze_time)
+        self.snooze_time = min(
+            self.snooze_time + self.snooze_time_step,
+            self.snooze_time_cap)
+
+    def schedule(self, delay):
+        """reconnect after delay seconds, unless out of retries."""
+        if (self.retry_count is not None and
+                self.error_counter > self.retry_count):
+            log.error("%s: out of retries", self.name)
+            self.stop()
+            return
+        self.state = STATE_IDLE
+        self.reconnect_at = time() + delay
+
+    def check(self, now):
+        """connect if it's time and time out a stalled connection."""
+        if self.state == STATE_IDLE:
+            if now >= self.reconnect_at:
+                self.connect(now)
+        elif (self.state != STATE_STOPPED and
+                now - self.last_activity > self.timeout):
+            self.timed_out()
+
+
+class StreamEngine(object):
+
+    """Drive many StreamConnections from one thread with poll()."""
+
+    def __init__(self, poll_interval=1.0):
+        """construct the engine.
+
+        poll_interval bounds how long a poll waits, which is how often
+        timeouts and reconnects are checked.
+        """
+        self.poll_interval = poll_interval
+        self.connections = []
+        self.running = False
+        self.poller = select.poll()
+        self.registered = {}
+
+        # connections added since the loop last looked, under lock
+        self.lock = threading.Lock()
+        self.added = []
+
+        # stop() and add() wake the loop through this pipe; a full pipe
+        # already wakes it, so writes never block
+        self.wake_read, self.wake_write = os.pipe()
+        fcntl.fcntl(
+            self.wake_write,
+            fcntl.F_SETFL,
+            fcntl.fcntl(self.wake_write, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.wake_read, select.POLLIN)
+        self.closed = False
+
+    def add(self, connection):
+        """add a connection; it connects on the next loop. thread safe."""
+        with self.lock:
+            self.added.append(connection)
+            self.wake()
+
+    def wake(self):
+        """wake the loop if the pipe is still open. lock must be held."""
+        if self.closed:
+            return
+        try:
+            os.write(self.wake_write, b"x")
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def take_added(self):
+        """move the added connections into the loop's list."""
+        with self.lock:
+            added = self.added
+            self.added = []
+        self.connections.extend(added)
+
+    def stop(self):
+        """stop the loop and close every connection. thread safe.
+
+        Does nothing but clear running once the engine is closed.
+        """
+        self.running = False
+        with self.lock:
+            self.wake()
+
+    def close(self):
+        """release the engine's wake pipe. safe to call more than once."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            os.close(self.wake_read)
+            os.close(self.wake_write)
+
+    def call(self, connection, method, now):
+        """run a connection step, turning socket errors into retries."""
+        try:
+            method(now)
+        except (socket.error, ssl.SSLError, ValueError), e:
+            connection.retry("%s: %s" % (e.__class__.__name__, e))
+        except Exception, e:
+            connection.stop()
+            log.exception("%s failed", connection.name)
+            connection.listener.on_exception(e)
+
+    def update_registrations(self):
+        """register each open socket for the events it needs.
+
+        Returns {fd: connection}.
+        """
+        by_fd = {}
+        for connection in self.connections:
+            if connection.sock is None:
+                continue
+            fd = connection.fileno()
+            events = select.POLLIN
+            if connection.wants_write():
+                events |= select.POLLOUT
+            by_fd[fd] = connection
+            if self.registered.get(fd) != events:
+                self.poller.register(fd, events)
+                self.registered[fd] = events
+
+        for fd in list(self.registered):
+            if fd not in by_fd:
+                try:
+                    self.poller.unregister(fd)
+                except (KeyError, ValueError):
+                    pass
+                del self.registered[fd]
+        return by_fd
+
+    def run(self):
+        """run until stopped or every connection has stopped."""
+        self.running = True
+        while self.running:
+            self.take_added()
+            now = time()
+            for connection in self.connections:
+                self.call(connection, connection.check, now)
+            self.connections = [c for c in self.connections if c.running]
+            if not self.connections:
+                break
+
+            by_fd = self.update_registrations()
+            timeout = self.poll_interval
+            for connection in self.connections:
+                if connection.state == STATE_IDLE:
+                    timeout = min(
+                        timeout, max(connection.reconnect_at - now, 0))
+
+            try:
+                events = self.poller.poll(timeout * 1000)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            now = time()
+            for fd, event in events:
+                if fd == self.wake_read:
+                    os.read(self.wake_read, 4096)
+                    continue
+                connection = by_fd.get(fd)
+                if connection is None or connection.sock is None:
+                    continue
+                if event & (select.POLLOUT | select.POLLERR):
+                    self.call(connection, connection.handle_write, now)
+                if connection.sock is not None and event & (
+                        select.POLLIN | select.POLLHUP | select.POLLERR):
+                    self.call(connection, connection.handle_read, now)
+
+        self.take_added()
+        for connection in self.connections:
+            connection.stop()
+        self.update_registrations()
+        self.running = False
+
+
+class EngineStream(object):
+
+    """tweepy.Stream lookalike that runs on a StreamEngine.
+
+    TwitterClient uses it in place of SourceAddrStreamer when the
+    stream_engine config is "engine".
+    """
+
+    def __init__(
+            self, auth, listener, source_addr=None, stall_warnings=False,
+            **options):
+        """store the connection options (see StreamConnection).
+
+        stall_warnings is the default for filter() and sample().
+        """
+        self.auth = auth
+        self.listener = listener
+        self.source_addr = source_addr
+        self.stall_warnings = stall_warnings
+        self.options = options
+        self.engine = None
+
+    @property
+    def running(self):
+        """return True while the engine is running."""
+        return self.engine is not None and self.engine.running
+
+    def filter(
+            self, follow=None, track=None, locations=None,
+            stall_warnings=None, languages=None, encoding='utf8'):
+        """stream statuses matching the filter."""
+        params = {}
+        if follow:
+            params["follow"] = u",".join(follow).encode(encoding)
+        if track:
+            params["track"] = u",".join(track).encode(encoding)
+        if locations:
+            if len(locations) % 4 != 0:
+                raise ValueError("invalid locations: %s" % locations)
+            params["locations"] = ",".join("%.4f" % l for l in locations)
+        if stall_warnings or (
+                stall_warnings is None and self.stall_warnings):
+            params["stall_warnings"] = "true"
+        if languages:
+            params["language"] = ",".join(map(str, languages))
+        self.run("/%s/statuses/filter.json" % STREAM_VERSION, params, "POST")
+
+    def sample(self, stall_warnings=None, languages=None):
+        """stream the sample."""
+        params = {}
+        if stall_warnings or (
+                stall_warnings is None and self.stall_warnings):
+            params["stall_warnings"] = "true"
+        if languages:
+            params["language"] = ",".join(map(str, languages))
+        self.run("/%s/statuses/sample.json" % STREAM_VERSION, params, "GET")
+
+    def run(self, path, params, method):
+        """connect and block until the stream stops."""
+        self.engine = StreamEngine()
+        try:
+            self.engine.add(StreamConnection(
+                self.listener,
+                path,
+                params=params,
+                method=method,
+                auth=self.auth,
+                source_addr=self.source_addr,
+                **self.options))
+            self.engine.run()
+        finally:
+            self.engine.close()
+            self.engine = None
+
+    def disconnect(self):
+        """stop the stream."""
+        engine = self.engine
+        if engine is not None:
+            engine.stop()
+
+
+#
+# unittests
+#
+#
+class FakeStreamServer(object):
+
+    """Local plain-http streaming server for tests.
+
+    Each accepted connection takes the next (status code, messages) from
+    responses and sends them length-delimited in small chunks with
+    keep-alives between, then ends the stream.
+    """
+
+    def __init__(self, responses, chunk_size=7):
+        """listen on a free localhost port."""
+        self.responses = list(responses)
+        self.chunk_size = chunk_size
+        self.requests = []
+        self.threads = []
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(64)
+        self.port = self.server.getsockname()[1]
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """accept connections until closed."""
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except socket.error:
+                return
+            if not self.responses:
+                sock.close()
+                continue
+            thread = threading.Thread(
+                target=self.serve,
+                args=(sock, self.responses.pop(0)))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def serve(self, sock, response):
+        """answer one request."""
+        status_code, messages = response
+        request = b""
+        while b"\r\n\r\n" not in request:
+            data = sock.recv(4096)
+            if not data:
+                sock.close()
+                return
+            request += data
+        self.requests.append(request)
+
+        if status_code != 200:
+            sock.sendall(
+                b"HTTP/1.1 %d Error\r\nContent-Length: 0\r\n\r\n" %
+                status_code)
+            sock.close()
+            return
+
+        body = b""
+        for i, message in enumerate(messages):
+            if i % 3 == 0:
+                body += b"\r\n"
+            body += b"%d\r\n%s\r\n" % (len(message) + 2, message)
+
+        sock.sendall(
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+        try:
+            for start in range(0, len(body), self.chunk_size):
+                chunk = body[start:start + self.chunk_size]
+                sock.sendall(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            sock.sendall(b"0\r\n\r\n")
+        except socket.error:
+            pass
+        sleep(0.1)
+        sock.close()
+
+    def close(self):
+        """stop listening and wait for open responses."""
+        self.server.close()
+        for thread in self.threads:
+            thread.join()
+
+
+class RecordingListener(object):
+
+    """Listener that records what the engine calls."""
+
+    def __init__(self, stop_after=None):
+        """construct the listener."""
+        self.stop_after = stop_after
+        self.data = []
+        self.errors = []
+        self.connects = 0
+        self.keep_alives = 0
+
+    def on_connect(self):
+        self.connects += 1
+
+    def keep_alive(self):
+        self.keep_alives += 1
+
+    def on_data(self, raw_data):
+        self.data.append(raw_data)
+        return self.stop_after is None or len(self.data) < self.stop_after
+
+    def on_error(self, status_code):
+        self.errors.append(status_code)
+        return True
+
+    def on_timeout(self):
+        return True
+
+    def on_exception(self, exception):
+        pass
+
+
+class StreamEngineTest(unittest.TestCase):
+
+    """StreamEngine tests."""
+
+    def messages(self, prefix, count):
+        """return count raw statuses."""
+        return [b'{"created_at": "Thu Oct 30 12:36:00 +0000 1997", '
+                b'"id": %d, "text": "%s"}' % (i, prefix)
+                for i in range(count)]
+
+    def connection(self, listener, port, **kwargs):
+        """return a plain-http connection to the fake server."""
+        kwargs.setdefault("retry_count", 0)
+        return StreamConnection(
+            listener,
+            "/1.1/statuses/filter.json",
+            params={"track": "a,b"},
+            host="127.0.0.1",
+            port=port,
+            use_ssl=False,
+            timeout=5.0,
+            **kwargs)
+
+    def test_parser(self):
+        """messages split at any byte boundary come out whole."""
+        body = b"\r\n5\r\nabc\r\n\r\n7\r\n{\"a\":1}"
+        parser = MessageParser()
+        messages = []
+        for i in range(len(body)):
+            messages.extend(parser.feed(body[i:i + 1]))
+        self.assertEqual(messages, [None, b"abc", None, b'{"a":1}'])
+
+    def test_many_connections(self):
+        """one engine streams several connections concurrently."""
+        count = 20
+        server = FakeStreamServer(
+            [(200, self.messages("s%d" % i, 50)) for i in range(count)])
+        engine = StreamEngine(poll_interval=0.1)
+        listeners = [RecordingListener(stop_after=50) for _ in range(count)]
+        try:
+            for listener in listeners:
+                engine.add(self.connection(listener, server.port))
+            engine.run()
+        finally:
+            engine.close()
+            server.close()
+
+        for i, listener in enumerate(listeners):
+            self.assertEqual(listener.connects, 1)
+            self.assertTrue(listener.keep_alives > 0)
+            self.assertEqual(listener.data, self.messages("s%d" % i, 50))
+        self.assertTrue(all(
+            b"POST /1.1/statuses/filter.json?delimited=length" in request
+            and request.endswith(b"track=a%2Cb")
+            for request in server.requests))
+
+    def test_http_error_retry(self):
+        """an http error is reported and the connection retried."""
+        server = FakeStreamServer([
+            (503, []),
+            (200, self.messages("ok", 3))])
+        engine = StreamEngine(poll_interval=0.1)
+        listener = RecordingListener(stop_after=3)
+        try:
+            engine.add(self.connection(
+                listener, server.port, retry_count=1, retry_time=0.05))
+            engine.run()
+        finally:
+            engine.close()
+            server.close()
+
+        self.assertEqual(listener.errors, [503])
+        self.assertEqual(listener.data, self.messages("ok", 3))
+
+    def test_add_wakes_poll(self):
+        """a connection added from another thread starts right away."""
+        server = FakeStreamServer([(200, self.messages("late", 3))])
+        engine = StreamEngine(poll_interval=30.0)
+
+        # keeps the engine waiting in poll() for its whole interval
+        idle = self.connection(RecordingListener(), server.port)
+        idle.reconnect_at = time() + 60
+        engine.add(idle)
+
+        listener = RecordingListener(stop_after=3)
+        thread = threading.Thread(target=engine.run)
+        thread.start()
+        try:
+            sleep(0.2)
+            engine.add(self.connection(listener, server.port))
+            for _ in range(50):
+                if len(listener.data) == 3:
+                    break
+                sleep(0.1)
+        finally:
+            engine.stop()
+            thread.join()
+            engine.close()
+            server.close()
+
+        self.assertEqual(listener.data, self.messages("late", 3))
+
+    def test_stop_after_close(self):
+        """stop() on a closed engine doesn't write to its old fds."""
+        engine = StreamEngine()
+        engine.close()
+
+        # the next pipe reuses the engine's fd numbers
+        read_fd, write_fd = os.pipe()
+        try:
+            engine.stop()
+            engine.close()
+            fcntl.fcntl(read_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+            try:
+                data = os.read(read_fd, 1)
+            except OSError, e:
+                self.assertEqual(e.errno, errno.EAGAIN)
+                data = b""
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        self.assertEqual(data, b"")
+
+    def test_listener_base(self):
+        """messages reach a BaseListener's on_status."""
+        from listeners.base import BaseListener, CLASSIFY_SNIFF
+
+        server = FakeStreamServer([(200, self.messages("base", 10))])
+        engine = StreamEngine(poll_interval=0.1)
+        listener = BaseListener(classify_mode=CLASSIFY_SNIFF)
+        try:
+            engine.add(self.connection(listener, server.port))
+            engine.run()
+        finally:
+            engine.close()
+            server.close()
+
+        self.assertEqual(listener.stats.total, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+"""Find which track terms and location boxes a status matched.
+
+The stream only says a status matched something in the filter.
+TermMatcher works out what, the way the filter endpoint does: a term
+matches when each of its words appears as a whole word (case-insensitive)
+in the text, screen name, hashtags, mentions or urls of the status or of
+the status it retweets or quotes. A box matches when the status's point
+is inside it, or, without a point, when its place's bounding box
+overlaps it.
+
+Words are found in one pass over the text with an Aho-Corasick automaton,
+so the cost doesn't grow with the number of terms. Boxes are checked all
+at once with numpy when it's installed.
+"""
+
+import logging
+import unittest
+from collections import OrderedDict
+
+from utils.jsoncodec import get_codec
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+log = logging.getLogger(__name__)
+
+
+# how RotatingFileListener records matches
+MATCH_ANNOTATE = "annotate"
+MATCH_SIDECAR = "sidecar"
+
+MATCH_MODES = (MATCH_ANNOTATE, MATCH_SIDECAR)
+
+# key added to annotated statuses
+ANNOTATION_KEY = "_matched"
+
+
+def is_word_char(ch):
+    """return True if ch is part of a word."""
+    return ch.isalnum() or ch == u"_"
+
+
+class AhoCorasick(object):
+
+    """Multi-pattern whole-word matcher.
+
+    Patterns can be added and removed at any time; the trie is updated in
+    place and its failure links are rebuilt on the next search.
+    """
+
+    def __init__(self):
+        """construct an empty automaton."""
+        # per node: {char: node}, failure node, patterns ending here
+        self.goto = [{}]
+        self.fail = [0]
+        self.own = [None]
+        self.outputs = [()]
+        self.nodes = {}
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, pattern):
+        return pattern in self.nodes
+
+    def add(self, pattern):
+        """add a pattern."""
+        if pattern in self.nodes or not pattern:
+            return
+        node = 0
+        for ch in pattern:
+            child = self.goto[node].get(ch)
+            if child is None:
+                child = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.own.append(None)
+                self.outputs.append(())
+                self.goto[node][ch] = child
+            node = child
+        self.own[node] = pattern
+        self.nodes[pattern] = node
+        self.dirty = True
+
+    def remove(self, pattern):
+        """remove a pattern; its trie nodes are left for reuse."""
+        node = self.nodes.pop(pattern, None)
+        if node is not None:
+            self.own[node] = None
+            self.dirty = True
+
+    def relink(self):
+        """rebuild failure links and outputs breadth first."""
+        queue = []
+        for child in self.goto[0].values():
+            self.fail[child] = 0
+            queue.append(child)
+        self.outputs[0] = ()
+
+        i = 0
+        while i < len(queue):
+            node = queue[i]
+            i += 1
+            fail_outputs = self.outputs[self.fail[node]]
+            if self.own[node] is not None:
+                self.outputs[node] = (self.own[node],) + fail_outputs
+            else:
+                self.outputs[node] = fail_outputs
+
+            for ch, child in self.goto[node].items():
+                state = self.fail[node]
+                while state and ch not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(ch, 0)
+                queue.append(child)
+        self.dirty = False
+
+    def search(self, text):
+        """return the set of patterns found as whole words in text."""
+        if self.dirty:
+            self.relink()
+
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        found = set()
+        node = 0
+        end = len(text)
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if outputs[node]:
+                after = i + 1
+                if after < end and is_word_char(text[after]):
+                    continue
+                for pattern in outputs[node]:
+                    start = after - len(pattern)
+                    if start == 0 or not is_word_char(text[start - 1]):
+                        found.add(pattern)
+        return found
+
+
+def status_texts(status):
+    """return the strings of a status the track filter looks at."""
+    texts = []
+    for item in (status,
+                 status.get("retweeted_status"),
+                 status.get("quoted_status")):
+        if not item:
+            continue
+        extended = item.get("extended_tweet") or {}
+        texts.append(extended.get("full_text") or item.get("text") or u"")
+        user = item.get("user") or {}
+        texts.append(user.get("screen_name") or u"")
+
+        entities = extended.get("entities") or item.get("entities") or {}
+        for hashtag in entities.get("hashtags") or ():
+            texts.append(hashtag.get("text") or u"")
+        for mention in entities.get("user_mentions") or ():
+            texts.append(mention.get("screen_name") or u"")
+        for url in entities.get("urls") or ():
+            texts.append(url.get("expanded_url") or u"")
+            texts.append(url.get("display_url") or u"")
+    return texts
+
+
+def status_location(status):
+    """return (west, south, east, north) for a status, or None.
+
+    A point is returned as a zero-size box.
+    """
+    coordinates = status.get("coordinates") or {}
+    point = coordinates.get("coordinates")
+    if point:
+        return (point[0], point[1], point[0], point[1])
+
+    place = status.get("place") or {}
+    bounding_box = place.get("bounding_box") or {}
+    polygon = bounding_box.get("coordinates")
+    if polygon:
+        longitudes = [p[0] for p in polygon[0]]
+        latitudes = [p[1] for p in polygon[0]]
+        return (min(longitudes), min(latitudes),
+                max(longitudes), max(latitudes))
+    return None
+
+
+class TermMatcher(object):
+
+    """Tag statuses with the track terms and boxes they matched.
+
+    term_counts and box_counts count matches per term and box; counts of
+    terms that stay across an update() are kept.
+    """
+
+    def __init__(self, json_codec=None):
+        """construct an empty matcher."""
+        self.codec = get_codec(json_codec)
+        self.automaton = AhoCorasick()
+        # term -> its lower case words, word -> terms using it
+        self.terms = {}
+        self.word_terms = {}
+        self.boxes = []
+        self.box_array = None
+        self.term_counts = {}
+        self.box_counts = []
+        self.matched = 0
+        self.unmatched = 0
+
+    def update(self, track=None, locations=None):
+        """change the terms and boxes, touching only what changed.
+
+        locations is a flat [west, south, east, north, ...] list, as for
+        the filter endpoint.
+        """
+        track = [term for term in track or () if term.strip()]
+        for term in set(self.terms) - set(track):
+            for word in self.terms.pop(term):
+                self.word_terms[word].discard(term)
+                if not self.word_terms[word]:
+                    del self.word_terms[word]
+                    self.automaton.remove(word)
+            del self.term_counts[term]
+        for term in track:
+            if term in self.terms:
+                continue
+            words = tuple(set(unicode(term).lower().split()))
+            self.terms[term] = words
+            self.term_counts[term] = 0
+            for word in words:
+                self.word_terms.setdefault(word, set()).add(term)
+                self.automaton.add(word)
+
+        locations = list(locations or ())
+        boxes = [tuple(locations[i:i + 4])
+                 for i in range(0, len(locations) - 3, 4)]
+        if boxes != self.boxes:
+            counts = dict(zip(self.boxes, self.box_counts))
+            self.boxes = boxes
+            self.box_counts = [counts.get(box, 0) for box in boxes]
+            self.box_array = None
+            if numpy is not None and boxes:
+                self.box_array = numpy.array(boxes, dtype=float)
+
+    def match_terms(self, status):
+        """return the sorted terms a status matched."""
+        if not self.terms:
+            return []
+        # one search over every field; newlines keep words apart
+        text = u"\n".join(status_texts(status)).lower()
+        words = self.automaton.search(text)
+        if not words:
+            return []
+        candidates = set()
+        for word in words:
+            candidates |= self.word_terms[word]
+        return sorted(
+            term for term in candidates
+            if all(word in words for word in self.terms[term]))
+
+    def match_boxes(self, status):
+        """return the indexes of the boxes a status matched."""
+        if not self.boxes:
+            return []
+        location = status_location(status)
+        if location is None:
+            return []
+        west, south, east, north = location
+
+        if self.box_array is not None:
+            boxes = self.box_array
+            mask = ((boxes[:, 0] <= east) & (west <= boxes[:, 2]) &
+                    (boxes[:, 1] <= north) & (south <= boxes[:, 3]))
+            return [int(i) for i in numpy.flatnonzero(mask)]
+
+        return [i for i, (w, s, e, n) in enumerate(self.boxes)
+                if w <= east and west <= e and s <= north and south <= n]
+
+    def match(self, status):
+        """return (terms, box indexes) for a status and count them."""
+        terms = self.match_terms(status)
+        boxes = self.match_boxes(status)
+        for term in terms:
+            self.term_counts[term] += 1
+        for i in boxes:
+            self.box_counts[i] += 1
+        if terms or boxes:
+            self.matched += 1
+        else:
+            self.unmatched += 1
+        return terms, boxes
+
+    def tags(self, status):
+        """return a status's match dict: id, terms and boxes."""
+        terms, boxes = self.match(status)
+        return OrderedDict([
+            ("id", status.get("id")),
+            ("terms", terms),
+            ("boxes", [list(self.boxes[i]) for i in boxes]),
+        ])
+
+    def annotate_raw(self, raw_data, status=None):
+        """return raw_data with the match dict added, and the dict.
+
+        status is the decoded raw_data, if the caller has it.
+        """
+        if status is None:
+            status = self.codec.loads(raw_data)
+        tags = self.tags(status)
+
+        # splice the key in rather than re-encode, so the rest of the
+        # status keeps its bytes (and created_at stays first)
+        annotation = self.codec.dumps(OrderedDict([
+            ("terms", tags["terms"]),
+            ("boxes", tags["boxes"])]))
+        raw_data = raw_data.rstrip()
+        raw_data = '%s,"%s":%s}' % (raw_data[:-1], ANNOTATION_KEY, annotation)
+        return raw_data, tags
+
+    def top_terms(self, count=10):
+        """return the count most matched (term, matches)."""
+        return sorted(
+            self.term_counts.items(),
+            key=lambda item: (-item[1], item[0]))[:count]
+
+
+#
+# unittests
+#
+#
+class TermMatcherTest(unittest.TestCase):
+
+    """TermMatcher tests."""
+
+    def status(self, text, **fields):
+        """return a status dict."""
+        status = {"id": 1, "text": text, "user": {"screen_name": "someone"}}
+        status.update(fields)
+        return status
+
+    def test_whole_words(self):
+        """patterns only match whole words, overlaps included."""
+        automaton = AhoCorasick()
+        for word in ("he", "she", "hers", "cat"):
+            automaton.add(word)
+        self.assertEqual(
+            automaton.search(u"she said hers, not his. #cat cats"),
+            set(["she", "hers", "cat"]))
+
+        automaton.remove("she")
+        automaton.add("said")
+        self.assertEqual(
+            automaton.search(u"she said hers"),
+            set(["said", "hers"]))
+
+    def test_terms(self):
+        """phrases need every word; entities count."""
+        matcher = TermMatcher()
+        matcher.update(["Seattle rain", "coffee", "sonics"])
+
+        self.assertEqual(
+            matcher.match_terms(self.status(u"Rain again in #seattle")),
+            ["Seattle rain"])
+        self.assertEqual(
+            matcher.match_terms(self.status(
+                u"look",
+                entities={"urls": [{"expanded_url": "http://coffee.com/"}]})),
+            ["coffee"])
+        self.assertEqual(
+            matcher.match_terms(self.status(
+                u"RT", retweeted_status=self.status(u"go Sonics!"))),
+            ["sonics"])
+        self.assertEqual(
+            matcher.match_terms(self.status(u"seattle coffeehouse")), [])
+
+    def test_update_keeps_counts(self):
+        """terms that survive an update keep their counts."""
+        matcher = TermMatcher()
+        matcher.update(["a b", "c"])
+        matcher.match(self.status(u"a b c"))
+        matcher.update(["c", "b"])
+
+        self.assertEqual(matcher.term_counts, {"c": 1, "b": 0})
+        self.assertEqual(
+            matcher.match_terms(self.status(u"a b")), ["b"])
+        self.assertEqual(len(matcher.automaton), 2)
+
+    def test_boxes(self):
+        """points must be inside a box, places overlap one."""
+        matcher = TermMatcher()
+        matcher.update(locations=[-123, 47, -122, 48, 0, 0, 10, 10])
+
+        point = self.status(
+            u"x", coordinates={"coordinates": [-122.3, 47.6]})
+        place = self.status(u"x", place={"bounding_box": {"coordinates": [
+            [[9, 9], [9, 11], [11, 11], [11, 9]]]}})
+        self.assertEqual(matcher.match_boxes(point), [0])
+        self.assertEqual(matcher.match_boxes(place), [1])
+        self.assertEqual(matcher.match_boxes(self.status(u"x")), [])
+
+    def test_annotate(self):
+        """annotated raw data carries the matches."""
+        matcher = TermMatcher()
+        matcher.update(["hello"])
+        raw, tags = matcher.annotate_raw('{"id": 5, "text": "hello"}')
+        self.assertEqual(tags["terms"], ["hello"])
+        self.assertTrue(raw.startswith('{"id": 5, "text": "hello",'))
+        self.assertEqual(
+            matcher.codec.loads(raw)[ANNOTATION_KEY],
+            {"terms": ["hello"], "boxes": []})
+
+
+if __name__ == '__main__':
+    unittest.main()
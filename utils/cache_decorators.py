@@ -2,39 +2,92 @@
 """cached decorators."""
 
 import threading
-from datetime import datetime
+import unittest
+from datetime import datetime, timedelta
 
 
 class cached_function_ttl(object):
 
-    """cached function wrapper"""
+    """cached function wrapper
+
+    values are cached per set of arguments, so a method caches separately
+    for each instance and each argument (eg. getStatus per job id).
+    """
 
     def __init__(self, ttl=None):
         """initialize function decorator.
 
         ttl = timedelta for ttl
         """
-        self.last_call = None
         self.lock = threading.RLock()
         self.ttl = ttl
-        self.cached_val = None
+        self.cache = {}
 
 
-    def __call__(self, fn, *args, **kwargs):
+    def __call__(self, fn):
         """wrapper for function call"""
-        def wrapped_func(*args):
+        def wrapped_func(*args, **kwargs):
+            bypass_cache = kwargs.pop('bypass_cache', False)
+            key = args + tuple(sorted(kwargs.items()))
             self.lock.acquire()
             try:
-                bypass_cache = kwargs.pop('bypass_cache', False)
-                if not bypass_cache:
-                    if self.last_call is not None:
-                        if self.ttl is not None:
-                            delta = datetime.now() - self.last_call
-                            if delta <= self.ttl:
-                                return self.cached_val
-                self.cached_val = fn(*args, **kwargs)
-                self.last_call = datetime.now()
-                return self.cached_val
+                now = datetime.now()
+                if not bypass_cache and self.ttl is not None:
+                    if key in self.cache:
+                        last_call, cached_val = self.cache[key]
+                        if now - last_call <= self.ttl:
+                            return cached_val
+
+                    # drop anything else that's expired
+                    for old_key, (last_call, _) in self.cache.items():
+                        if now - last_call > self.ttl:
+                            del self.cache[old_key]
+
+                cached_val = fn(*args, **kwargs)
+                self.cache[key] = (datetime.now(), cached_val)
+                return cached_val
             finally:
                 self.lock.release()
         return wrapped_func
+
+
+#
+# unittests
+#
+#
+class CachedFunctionTest(unittest.TestCase):
+
+    """cached_function_ttl tests."""
+
+    def test_keyed(self):
+        """each set of arguments is cached separately."""
+        calls = []
+
+        @cached_function_ttl(timedelta(seconds=60))
+        def lookup(job_id):
+            calls.append(job_id)
+            return job_id * 2
+
+        self.assertEqual(lookup(1), 2)
+        self.assertEqual(lookup(2), 4)
+        self.assertEqual(lookup(1), 2)
+        self.assertEqual(calls, [1, 2])
+
+        self.assertEqual(lookup(1, bypass_cache=True), 2)
+        self.assertEqual(calls, [1, 2, 1])
+
+    def test_no_ttl(self):
+        """without a ttl every call goes through."""
+        calls = []
+
+        @cached_function_ttl()
+        def lookup():
+            calls.append(None)
+
+        lookup()
+        lookup()
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""Streaming compression for output files."""
+
+import io
+import gzip
+import bz2
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# file extension added for each compression
+EXTENSIONS = {
+    "gzip": ".gz",
+    "bz2": ".bz2",
+    "lzma": ".xz",
+    "zstd": ".zst",
+}
+
+# level used when none is given
+DEFAULT_LEVELS = {
+    "gzip": 6,
+    "bz2": 9,
+    "lzma": 6,
+    "zstd": 3,
+}
+
+
+class CompressedFile(object):
+
+    """Write-only compressed file with the same interface for every codec.
+
+    The compressor writes into a plain file we own, so fileno() always
+    works (for fsync) and closing can sync before the file is closed.
+    """
+
+    def __init__(self, raw, compressor=None, stream=None):
+        """wrap raw with either a one-shot compressor or a stream."""
+        self.raw = raw
+        self.compressor = compressor
+        self.stream = stream
+
+    def write(self, data):
+        """compress and write data."""
+        if self.stream is not None:
+            self.stream.write(data)
+        else:
+            self.raw.write(self.compressor.compress(data))
+
+    def flush(self):
+        """push compressed data to the os.
+
+        Stream compressors (gzip, zstd) flush their pending block; bz2 and
+        lzma can only flush what they've already emitted.
+        """
+        if self.stream is not None:
+            self.stream.flush()
+        self.raw.flush()
+
+    def fileno(self):
+        """return the underlying file descriptor."""
+        return self.raw.fileno()
+
+    def close(self, sync=None):
+        """finish the compressed stream and close the file.
+
+        sync is called with the file descriptor after the stream is
+        finished and before it's closed.
+        """
+        if self.stream is not None:
+            if isinstance(self.stream, gzip.GzipFile):
+                self.stream.close()
+            else:
+                self.stream.flush(zstandard.FLUSH_FRAME)
+        else:
+            self.raw.write(self.compressor.flush())
+
+        self.raw.flush()
+        if sync is not None:
+            sync(self.raw.fileno())
+        self.raw.close()
+
+
+class DecompressedFile(io.BufferedReader):
+
+    """Buffered reader over a zstd stream reader.
+
+    python-zstandard's reader can't be read by line and doesn't close
+    the file it reads from; this does both.
+    """
+
+    def __init__(self, reader, source):
+        """wrap reader, which decompresses source."""
+        io.BufferedReader.__init__(self, reader)
+        self.source = source
+
+    def close(self):
+        """close the reader and the compressed file."""
+        try:
+            io.BufferedReader.close(self)
+        finally:
+            self.source.close()
+
+
+def available_compressions():
+    """return the names of the usable compressions."""
+    names = ["gzip", "bz2"]
+    if lzma is not None:
+        names.append("lzma")
+    if zstandard is not None:
+        names.append("zstd")
+    return names
+
+
+def check_compression(compression):
+    """raise ValueError if compression isn't usable here."""
+    if compression is None:
+        return
+    if compression not in EXTENSIONS:
+        raise ValueError("unknown compression: %s" % compression)
+    if compression not in available_compressions():
+        raise ValueError("compression is not installed: %s" % compression)
+
+
+def compression_extension(compression):
+    """return the extension to append for compression ('' for none)."""
+    if compression is None:
+        return ""
+    return EXTENSIONS[compression]
+
+
+def open_compressed(filename, compression=None, level=None):
+    """open filename for writing through compression.
+
+    With no compression this is a plain file opened for writing.
+    """
+    if compression is None:
+        return open(filename, "w+")
+
+    check_compression(compression)
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+
+    raw = open(filename, "wb")
+    if compression == "gzip":
+        return CompressedFile(
+            raw,
+            stream=gzip.GzipFile(
+                filename=filename,
+                mode="wb",
+                compresslevel=level,
+                fileobj=raw))
+    elif compression == "bz2":
+        return CompressedFile(raw, compressor=bz2.BZ2Compressor(level))
+    elif compression == "lzma":
+        return CompressedFile(
+            raw,
+            compressor=lzma.LZMACompressor(preset=level))
+
+    compressor = zstandard.ZstdCompressor(level=level)
+    return CompressedFile(raw, stream=compressor.stream_writer(raw))
+
+
+def open_decompressed(filename, compression=None):
+    """open filename for reading, undoing compression."""
+    if compression is None:
+        return open(filename, "rb")
+
+    check_compression(compression)
+    if compression == "gzip":
+        return gzip.GzipFile(filename, "rb")
+    elif compression == "bz2":
+        return bz2.BZ2File(filename, "r")
+    elif compression == "lzma":
+        return lzma.LZMAFile(filename, "r")
+
+    source = open(filename, "rb")
+    try:
+        reader = zstandard.ZstdDecompressor().stream_reader(source)
+    except Exception:
+        source.close()
+        raise
+    return DecompressedFile(reader, source)
+
+
+def compression_for_filename(filename):
+    """guess the compression from a filename's extension."""
+    for compression, extension in EXTENSIONS.items():
+        if filename.endswith(extension):
+            return compression
+    return None
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Pluggable JSON codecs.
+
+Wraps whichever of orjson, ujson, simplejson or the stdlib json module
+are installed behind the same loads/dumps interface, for the listeners'
+per-message parsing. The default codec is the first installed backend in
+BACKEND_NAMES, a fixed preference order that isn't measured at runtime;
+benchmarks/json_codecs.py compares the installed backends on a capture.
+
+The backends disagree on edge cases (duplicate keys, big ints, error
+types), so config and other cold paths stay on simplejson.
+"""
+
+import importlib
+
+
+# backends in order of preference (usually fastest first)
+BACKEND_NAMES = ("orjson", "ujson", "simplejson", "json")
+
+
+class JSONCodec(object):
+
+    """JSON encoder/decoder pair for one backend."""
+
+    def __init__(self, name, loads, dumps):
+        """construct the codec."""
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def load(self, f):
+        """decode json from a file object."""
+        return self.loads(f.read())
+
+    def __repr__(self):
+        return "JSONCodec(%s)" % (self.name)
+
+
+def _orjson_dumps(module):
+    """wrap orjson.dumps so it returns text like the others."""
+    def dumps(obj):
+        return module.dumps(obj).decode("utf-8")
+    return dumps
+
+
+def make_codec(name):
+    """build the codec for a backend, or None if it isn't installed."""
+    if name not in BACKEND_NAMES:
+        raise ValueError("unknown json backend: %s" % name)
+
+    try:
+        module = importlib.import_module(name)
+    except ImportError:
+        return None
+
+    if name == "orjson":
+        return JSONCodec(name, module.loads, _orjson_dumps(module))
+
+    return JSONCodec(name, module.loads, module.dumps)
+
+
+def available_codecs():
+    """return the installed codecs in order of preference."""
+    codecs = []
+    for name in BACKEND_NAMES:
+        codec = make_codec(name)
+        if codec is not None:
+            codecs.append(codec)
+    return codecs
+
+
+def get_codec(name=None):
+    """return the codec for name, or the default codec.
+
+    Raises ValueError if the named backend isn't installed.
+    """
+    if name is None:
+        return default_codec
+
+    codec = make_codec(name)
+    if codec is None:
+        raise ValueError("json backend is not installed: %s" % name)
+    return codec
+
+
+default_codec = available_codecs()[0]
+
+loads = default_codec.loads
+dumps = default_codec.dumps
+load = default_codec.load
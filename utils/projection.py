@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""Field projection for writing slimmed statuses.
+
+A projection is a list of dotted paths like the ones ConfigFile.getValue
+takes, eg. ["id_str", "text", "user.screen_name", "entities.hashtags.text"].
+The paths are compiled once into nested extractors; a path that runs into
+a list applies the rest of the path to each item of the list.
+"""
+
+import unittest
+from collections import OrderedDict
+
+from utils.jsoncodec import get_codec
+
+
+# always kept, first, so projected files can still be sniffed and indexed
+LEADING_FIELDS = ("created_at", "id")
+
+_MISSING = object()
+
+
+def build_tree(paths):
+    """return a nested OrderedDict of the fields named by paths.
+
+    A None leaf keeps the whole value. A shorter path wins over a longer
+    one through it ("user" beats "user.id").
+    """
+    tree = OrderedDict()
+    for path in paths:
+        parts = path.split(".")
+        if not all(parts):
+            raise ValueError("invalid projection path: %s" % path)
+
+        node = tree
+        for part in parts[:-1]:
+            child = node.get(part, _MISSING)
+            if child is None:
+                # the whole value is already kept
+                node = None
+                break
+            if child is _MISSING:
+                child = node[part] = OrderedDict()
+            node = child
+
+        if node is not None:
+            node[parts[-1]] = None
+    return tree
+
+
+def compile_tree(tree):
+    """return a function that projects a value onto tree."""
+    fields = [
+        (key, None if subtree is None else compile_tree(subtree))
+        for key, subtree in tree.items()]
+
+    def extract(value):
+        if isinstance(value, list):
+            return [extract(item) for item in value]
+        if not isinstance(value, dict):
+            # null or a scalar where we expected an object
+            return value
+
+        out = {}
+        for key, sub in fields:
+            if key in value:
+                out[key] = value[key] if sub is None else sub(value[key])
+        return out
+
+    return extract
+
+
+class Projection(object):
+
+    """Compiled projection of a status onto a list of dotted paths."""
+
+    def __init__(self, paths, json_codec=None):
+        """compile the projection."""
+        if not paths:
+            raise ValueError("projection needs at least one path")
+
+        self.paths = list(paths)
+        self.codec = get_codec(json_codec)
+
+        tree = build_tree(self.paths)
+        leading = OrderedDict((key, None) for key in LEADING_FIELDS)
+        for key, subtree in tree.items():
+            if key not in leading:
+                leading[key] = subtree
+        tree = leading
+
+        # top-level key prefixes are encoded once
+        dumps = self.codec.dumps
+        self.fields = [
+            (key, dumps(key) + ":",
+             None if subtree is None else compile_tree(subtree))
+            for key, subtree in tree.items()]
+
+    def project(self, status):
+        """return the projected status as a dict."""
+        out = {}
+        for key, _, sub in self.fields:
+            if key in status:
+                value = status[key]
+                out[key] = value if sub is None else sub(value)
+        return out
+
+    def dumps(self, status):
+        """return the projected status as a json line.
+
+        The top level is written by hand so created_at and id stay first
+        whatever the json backend does with key order.
+        """
+        dumps = self.codec.dumps
+        parts = []
+        for key, prefix, sub in self.fields:
+            if key in status:
+                value = status[key]
+                if sub is not None:
+                    value = sub(value)
+                parts.append(prefix + dumps(value))
+        return "{" + ",".join(parts) + "}"
+
+    def project_raw(self, raw_data):
+        """return the projected json line for a raw status."""
+        return self.dumps(self.codec.loads(raw_data))
+
+
+#
+# unittests
+#
+#
+class ProjectionTest(unittest.TestCase):
+
+    """Projection tests."""
+
+    def setUp(self):
+        """set up a status."""
+        self.status = {
+            "created_at": "Thu Oct 30 12:36:00 +0000 1997",
+            "id": 42,
+            "text": "hello #a #b",
+            "user": {"id": 7, "screen_name": "someone", "lang": "en"},
+            "entities": {
+                "hashtags": [
+                    {"text": "a", "indices": [6, 8]},
+                    {"text": "b", "indices": [9, 11]}],
+                "urls": []},
+            "place": None,
+        }
+
+    def test_paths(self):
+        """nested paths, lists and nulls are projected."""
+        projection = Projection([
+            "text",
+            "user.screen_name",
+            "entities.hashtags.text",
+            "place.full_name",
+            "missing.field"])
+        self.assertEqual(projection.project(self.status), {
+            "created_at": "Thu Oct 30 12:36:00 +0000 1997",
+            "id": 42,
+            "text": "hello #a #b",
+            "user": {"screen_name": "someone"},
+            "entities": {"hashtags": [{"text": "a"}, {"text": "b"}]},
+            "place": None,
+        })
+
+    def test_shorter_path_wins(self):
+        """a whole object beats a field of it, in either order."""
+        for paths in (["user.id", "user"], ["user", "user.id"]):
+            projected = Projection(paths).project(self.status)
+            self.assertEqual(projected["user"], self.status["user"])
+
+    def test_dumps_order(self):
+        """created_at and id lead the line so it can be sniffed."""
+        from utils.sniff import is_status, status_id
+
+        projection = Projection(["user.id", "text"])
+        line = projection.project_raw(projection.codec.dumps(self.status))
+        self.assertTrue(is_status(line))
+        self.assertEqual(status_id(line), 42)
+        self.assertEqual(
+            projection.codec.loads(line),
+            projection.project(self.status))
+
+    def test_invalid_path(self):
+        """empty path parts are rejected."""
+        self.assertRaises(ValueError, Projection, ["user..id"])
+        self.assertRaises(ValueError, Projection, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
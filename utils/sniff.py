@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Cheap inspection of raw stream messages without parsing them."""
+
+import unittest
+
+
+# first key twitter emits for a status object
+STATUS_FIRST_KEY = "created_at"
+
+
+def first_key(raw_data):
+    """return the first top-level key of a raw json object.
+
+    Only looks at the first few bytes of the message. Returns None if the
+    message doesn't start like a json object with a string key.
+    """
+    start = raw_data.find('"')
+    if start < 0 or raw_data[:start].strip() != "{":
+        return None
+
+    end = raw_data.find('"', start + 1)
+    if end < 0:
+        return None
+
+    return raw_data[start + 1:end]
+
+
+def is_status(raw_data):
+    """return True if the raw message looks like a status.
+
+    Twitter always serializes statuses with created_at first. Anything
+    else (including messages we can't classify) returns False so the
+    caller falls back to a full parse.
+    """
+    return first_key(raw_data) == STATUS_FIRST_KEY
+
+
+def status_id(raw_data):
+    """return the top-level id of a raw status without parsing it.
+
+    Relies on twitter putting id right after created_at, before any
+    nested objects. Returns None if there's no id where it's expected.
+    """
+    key = raw_data.find('"id"', 0, 128)
+    if key < 0:
+        return None
+
+    start = raw_data.find(":", key + 4)
+    if start < 0:
+        return None
+    start += 1
+    while raw_data[start:start + 1] == " ":
+        start += 1
+
+    end = start
+    while raw_data[end:end + 1].isdigit():
+        end += 1
+
+    if end == start:
+        return None
+    return int(raw_data[start:end])
+
+
+def created_at(raw_data):
+    """return the created_at string of a raw status without parsing it.
+
+    Only works when created_at is the first key (see is_status). Returns
+    None otherwise.
+    """
+    key = raw_data.find('"%s"' % STATUS_FIRST_KEY, 0, 32)
+    if key < 0:
+        return None
+
+    start = raw_data.find('"', key + len(STATUS_FIRST_KEY) + 2)
+    if start < 0:
+        return None
+    end = raw_data.find('"', start + 1)
+    if end < 0:
+        return None
+    return raw_data[start + 1:end]
+
+
+#
+# unittests
+#
+#
+class SniffTest(unittest.TestCase):
+
+    """Sniffing tests."""
+
+    def test_status(self):
+        """statuses are detected from their first key."""
+        self.assertTrue(is_status('{"created_at":"Thu Oct 30","id":1}'))
+        self.assertTrue(is_status(' { "created_at": "Thu Oct 30"}'))
+
+    def test_control(self):
+        """control messages are not statuses."""
+        self.assertFalse(is_status('{"delete":{"status":{"id":1}}}'))
+        self.assertFalse(is_status('{"limit":{"track":5}}'))
+        self.assertEqual(first_key('{"warning":{}}'), "warning")
+
+    def test_garbage(self):
+        """unclassifiable data falls back to a full parse."""
+        self.assertFalse(is_status(''))
+        self.assertFalse(is_status('[{"created_at":1}]'))
+        self.assertIsNone(first_key('{"unterminated'))
+
+    def test_status_id(self):
+        """ids come from the top-level id field."""
+        self.assertEqual(
+            status_id('{"created_at":"Thu Oct 30","id":520000000000000001,'
+                      '"user":{"id":5}}'),
+            520000000000000001)
+        self.assertEqual(status_id('{"created_at": "x", "id": 12}'), 12)
+        self.assertIsNone(status_id('{"limit":{"track":5}}'))
+
+    def test_created_at(self):
+        """created_at comes from the leading key."""
+        self.assertEqual(
+            created_at('{"created_at": "Thu Oct 30 12:36:00 +0000 1997",'
+                       '"id":1}'),
+            "Thu Oct 30 12:36:00 +0000 1997")
+        self.assertIsNone(created_at('{"limit":{"track":5}}'))
+
+
+if __name__ == '__main__':
+    unittest.main()